@@ -33,14 +33,15 @@ import dcm.agent.dispatcher as dispatcher
 import dcm.agent.exceptions as exceptions
 import dcm.agent.handshake as handshake
 import dcm.agent.logger as logger
-import dcm.agent.messaging as messaging
 import dcm.agent.messaging.persistence as persistence
 import dcm.agent.messaging.reply as reply
 import dcm.agent.ossec as ossec
+import dcm.agent.plugins.loader as plugin_loader
 import dcm.agent.utils as utils
 import dcm.agent.systemstats as systemstats
 
 import dcm.agent.events.globals as events
+import dcm.agent.events.pubsub as pubsub
 
 
 class DCMAgent(object):
@@ -53,19 +54,54 @@ class DCMAgent(object):
         self.intrusion_detection = None
         self.request_listener = None
         self.g_logger = logging.getLogger(__name__)
-        self._db = persistence.SQLiteAgentDB(conf.storage_dbfile)
+        events.use_event_space(conf.system_event_space)
+        self._db = conf.get_db()
         self.db_cleaner = None
         self.handshaker = handshake.HandshakeManager(self.conf, self._db)
+        # cleaning the db and the logs blocks so keep it off the main loop
         events.global_pubsub.subscribe(
-            events.DCMAgentTopics.CLEANUP, self.clean_db_handler)
+            events.DCMAgentTopics.CLEANUP, self.clean_db_handler,
+            mode=pubsub.DeliveryMode.EXECUTOR)
 
     def clean_db_handler(self, request_id=None, *args, **kwargs):
         self._db.clean_all(request_id)
         logger.delete_logs()
 
+    def preload_plugins(self):
+        # the dispatcher holds requests until the failures are reported
+        try:
+            self._preload_plugins()
+        finally:
+            plugin_loader.end_preload()
+
+    def _preload_plugins(self):
+        try:
+            failures = plugin_loader.preload_plugins(self.conf)
+        except Exception:
+            self.g_logger.exception("Failed to preload the plugins")
+            return
+        for name, error in sorted(failures.items()):
+            self.g_logger.warning("The plugin %s could not be loaded: %s"
+                                  % (name, error))
+        if failures:
+            # one report, plugins from extras that are not installed
+            # would otherwise flood the console
+            logger.log_to_dcm_console_plugins_load_failed(
+                plugin_names=", ".join(sorted(failures)))
+        results = plugin_loader.get_preload_results()
+        for module_name in sorted(results,
+                                  key=lambda m: -results[m]["import_time"]):
+            self.g_logger.debug("Plugin module %s imported in %.4f seconds"
+                                % (module_name,
+                                   results[module_name]["import_time"]))
+
     def kill_handler(self, signum, frame):
         self.shutdown_main_loop()
 
+    def reload_handler(self, signum, frame):
+        # parse the plugin configuration again at the next command
+        plugin_loader.invalidate_plugin_registries()
+
     def stack_trace_handler(self, signum, frame):
         utils.build_assertion_exception(self.g_logger, "signal stack")
 
@@ -77,6 +113,7 @@ class DCMAgent(object):
         signal.signal(signal.SIGINT, self.kill_handler)
         signal.signal(signal.SIGTERM, self.kill_handler)
         signal.signal(signal.SIGUSR2, self.stack_trace_handler)
+        signal.signal(signal.SIGHUP, self.reload_handler)
 
         if self.conf.pydev_host:
             utils.setup_remote_pydev(self.conf.pydev_host,
@@ -97,8 +134,17 @@ class DCMAgent(object):
 
     def run_agent(self):
         try:
+            events.global_space.configure_workers(
+                max_workers=self.conf.workers_callback_threads,
+                max_queue=self.conf.workers_callback_queue)
+
             self.db_cleaner = persistence.DBCleaner(
-                self._db, self.conf.storage_db_timeout, 100000, 3600)
+                self._db, self.conf.storage_db_timeout,
+                self.conf.storage_db_max_rows,
+                self.conf.storage_db_clean_interval,
+                max_bytes=self.conf.storage_db_max_bytes,
+                alert_max_age=self.conf.storage_db_alert_max_age,
+                alert_max_rows=self.conf.storage_db_alert_max_rows)
             self.db_cleaner.start()
 
             # def get a connection object
@@ -122,6 +168,10 @@ class DCMAgent(object):
 
             self.conn.connect(self.request_listener.incoming_parent_q_message,
                               self.handshaker)
+            if self.conf.plugin_preload:
+                plugin_loader.begin_preload()
+                events.global_space.register_callback(
+                    self.preload_plugins, in_thread=True)
             self.disp.start_workers(self.request_listener)
 
             rc = self.agent_main_loop()
@@ -156,6 +206,8 @@ class DCMAgent(object):
         if self.disp:
             self.g_logger.debug("Stopping the dispatcher")
             self.disp.stop()
+        self.g_logger.debug("Shutting down the plugin processes")
+        self.conf.stop_plugin_pool()
         if self.conn:
             self.g_logger.debug("Closing the connection")
             self.conn.close()
@@ -163,7 +215,14 @@ class DCMAgent(object):
         self.g_logger.debug("Waiting for all threads and callbacks in the "
                             "event system.")
         events.global_space.reset()
+        self.g_logger.debug("Event loop statistics: %s"
+                            % str(events.global_space.get_poll_stats()))
+        self.g_logger.debug("Plugin registry statistics: %s"
+                            % str(plugin_loader.get_plugin_registry_stats()))
+        self.g_logger.debug("Closing the database")
+        self.conf.close_db()
         self.g_logger.debug("Service closed")
+        logger.stop_log_writer()
 
 
 def console_log(cli_args, level, msg, **kwargs):
@@ -286,6 +345,7 @@ def start_main_service(cli_args):
 
         utils.verify_config_file(conf)
         conf.start_job_runner()
+        conf.start_plugin_pool()
         agent.run_agent()
     except exceptions.AgentOptionException as aoex:
         console_log(cli_args, 0, "The agent is not configured properly. "
@@ -311,7 +371,7 @@ def get_status(cli_args):
     config_files = config.get_config_files(conffile=cli_args.conffile)
     conf = config.AgentConfig(config_files)
 
-    db_obj = messaging.persistence.SQLiteAgentDB(conf.storage_dbfile)
+    db_obj = config.get_db_object(conf, read_only=True)
 
     complete = db_obj.get_all_complete()
     replied = db_obj.get_all_reply()
@@ -376,6 +436,20 @@ def get_status(cli_args):
             clint.textui.puts(
                 clint.textui.columns([k, label_col_width], [str(len(v)), 5]))
 
+    counters = db_obj.get_counters()
+    db_vals = [
+        (db_obj.get_db_size(), "Database size (bytes): "),
+        (counters.get(persistence.DBCounters.EVICTED_BY_COUNT, 0),
+         "Evicted for row limit: "),
+        (counters.get(persistence.DBCounters.EVICTED_BY_SIZE, 0),
+         "Evicted for size limit: "),
+        (counters.get(persistence.DBCounters.ALERTS_REMOVED, 0),
+         "Alerts removed: ")]
+    with clint.textui.indent(4):
+        for v, k in db_vals:
+            clint.textui.puts(
+                clint.textui.columns([k, label_col_width], [str(v), 12]))
+
     try:
         pid_file = os.path.join(conf.storage_base_dir, "dcm-agent.pid")
         if not os.path.exists(pid_file):
@@ -416,6 +490,21 @@ def get_status(cli_args):
     return 1
 
 
+def vacuum_db(cli_args):
+    config_files = config.get_config_files(conffile=cli_args.conffile)
+    conf = config.AgentConfig(config_files)
+
+    db_obj = config.get_db_object(conf)
+    try:
+        size = db_obj.get_db_size()
+        db_obj.vacuum()
+        clint.textui.puts("The agent database was %d bytes and is now %d "
+                          "bytes." % (size, db_obj.get_db_size()))
+    finally:
+        db_obj.close()
+    return 0
+
+
 def main(args=sys.argv):
     cli_args, remaining_argv = parse_command_line(args)
 
@@ -423,6 +512,10 @@ def main(args=sys.argv):
             remaining_argv[1].lower() == "status":
         # do status reporting
         return get_status(cli_args)
+    elif remaining_argv and len(remaining_argv) > 1 and \
+            remaining_argv[1].lower() == "vacuum":
+        # rewrite the database file.  The agent must be stopped
+        return vacuum_db(cli_args)
     else:
         # start main service
         return start_main_service(cli_args)
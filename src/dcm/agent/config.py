@@ -26,6 +26,10 @@ from dcm.agent.cloudmetadata import CLOUD_TYPES
 import dcm.agent.connection.websocket as websocket
 import dcm.agent.exceptions as exceptions
 import dcm.agent.job_runner as job_runner
+import dcm.agent.plugin_pool as plugin_pool
+import dcm.agent.plugins.loader as plugin_loader
+import dcm.agent.messaging.journal as journal
+import dcm.agent.messaging.persistence as persistence
 from dcm.agent.plugins.api.exceptions import AgentPluginConfigException
 import dcm.agent.tests.utils.test_connection as test_connection  # TODO
 import dcm.agent.utils as utils
@@ -49,6 +53,39 @@ def get_python_script_dir():
     return os.path.join(_ROOT, 'scripts')
 
 
+def get_db_object(conf, read_only=False):
+    """
+    Open the agent database with the backend selected by
+    [storage]db_backend.
+
+    :param read_only: Only look at the database.  This is for looking at
+    the database of an agent that may be running.
+    """
+    backend = conf.storage_db_backend
+    if backend == "journal":
+        return journal.JournalAgentDB(
+            conf.storage_dbfile + ".journal",
+            sync=conf.storage_db_journal_sync,
+            compact_ops=conf.storage_db_journal_compact_ops,
+            read_only=read_only)
+    if backend != "sqlite":
+        raise exceptions.AgentOptionValueException(
+            "[storage]db_backend", backend, "sqlite,journal")
+
+    group_commit_window = None
+    if conf.storage_db_group_commit_ms is not None:
+        group_commit_window = conf.storage_db_group_commit_ms / 1000.0
+    return persistence.SQLiteAgentDB(
+        conf.storage_dbfile,
+        thread_connections=conf.storage_db_thread_connections,
+        busy_timeout=conf.storage_db_busy_timeout,
+        group_commit_window=group_commit_window,
+        group_commit_max_ops=conf.storage_db_group_commit_max_ops,
+        doc_encoding=conf.storage_db_doc_encoding,
+        cache_size=conf.storage_db_cache_size,
+        read_only=read_only)
+
+
 def get_connection_object(conf):
     con_type = conf.connection_type
     if not con_type:
@@ -188,6 +225,8 @@ class AgentConfig(object):
         self._remaining_argv = None
         self.instance_id = None
         self.jr = None
+        self.plugin_pool = None
+        self.db = None
         self.state = "STARTING"
         self.features = {}
 
@@ -255,6 +294,52 @@ class AgentConfig(object):
             self.jr.shutdown()
             self.jr = None
 
+    def start_plugin_pool(self):
+        if self.workers_plugin_processes < 1:
+            return
+        if self.storage_db_backend == "journal":
+            # the journal tables are held in memory by this process.  A
+            # plugin process would have its own copy appending to the same
+            # file, so every plugin is run in a thread instead
+            _g_logger.warning("The plugin process pool is not used with "
+                              "the journal database backend.  Plugins "
+                              "with execution: process will be run in "
+                              "threads.")
+            return
+        self.plugin_pool = plugin_pool.PluginProcessPool(
+            self,
+            processes=self.workers_plugin_processes,
+            cancel_timeout=self.workers_plugin_cancel_timeout)
+        # start the processes now if any plugin uses them.  Otherwise they
+        # are started on first use
+        try:
+            plugins = plugin_loader.get_all_plugins(self).values()
+        except AgentPluginConfigException:
+            return
+        for items_map in plugins:
+            if (items_map.get(plugin_pool.EXECUTION_KEY) ==
+                    plugin_pool.EXECUTION_PROCESS):
+                self.plugin_pool.start()
+                return
+
+    def stop_plugin_pool(self):
+        if self.plugin_pool:
+            self.plugin_pool.stop()
+            self.plugin_pool = None
+
+    def get_db(self):
+        # the agent and the plugins it runs share one database object so
+        # that what it holds in memory (the request cache or the journal
+        # tables) stays in one place
+        if self.db is None:
+            self.db = get_db_object(self)
+        return self.db
+
+    def close_db(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
     def get_temp_file(self, filename, isdir=False):
         new_dir = tempfile.mkdtemp(dir=self.storage_temppath)
         if isdir:
@@ -314,8 +399,22 @@ def build_options_list():
                   help_msg="The port where the pydev debugger is listening"),
 
         ConfigOpt("workers", "count", int, default=2, options=None,
-                  help_msg="The number of worker threads that will be "
-                           "processing incoming requests"),
+                  help_msg="The number of worker threads that will always "
+                           "be processing incoming requests"),
+
+        ConfigOpt("workers", "max_count", int, default=8, options=None,
+                  help_msg="The most worker threads that will be started "
+                           "when requests wait in the queue"),
+
+        ConfigOpt("workers", "scale_up_wait", float, default=2.0,
+                  options=None,
+                  help_msg="The number of seconds a request can wait for a "
+                           "worker thread before another one is started"),
+
+        ConfigOpt("workers", "idle_timeout", float, default=60.0,
+                  options=None,
+                  help_msg="The number of seconds a worker thread above "
+                           "count can be idle before it exits"),
 
         ConfigOpt("workers", "long_runner_threads", int, default=1,
                   options=None,
@@ -323,6 +422,31 @@ def build_options_list():
                            "processing long running plugins (anything that "
                            "returns a job description)"),
 
+        ConfigOpt("workers", "plugin_processes", int, default=2,
+                  options=None,
+                  help_msg="The number of processes that run the plugins "
+                           "configured with execution: process.  0 runs "
+                           "them in threads like the other plugins"),
+
+        ConfigOpt("workers", "plugin_cancel_timeout", float, default=10.0,
+                  options=None,
+                  help_msg="The number of seconds a plugin process has to "
+                           "return after its command is canceled before it "
+                           "is killed"),
+
+        ConfigOpt("workers", "callback_threads", int, default=8,
+                  options=None,
+                  help_msg="The most threads used to run event callbacks "
+                           "that must not block the main loop, such as "
+                           "forming a connection"),
+
+        ConfigOpt("workers", "callback_queue", int, default=64,
+                  options=None,
+                  help_msg="The number of ready event callbacks that can "
+                           "wait for a free callback thread.  Callbacks "
+                           "beyond this are held by the main loop until a "
+                           "thread frees up"),
+
         ConfigOpt("connection", "type", str, default="ws", options=None,
                   help_msg="The type of connection object to use.  Supported "
                            "types are ws and fallback"),
@@ -354,19 +478,94 @@ def build_options_list():
         FilenameOpt("plugin", "configfile",
                     help_msg="The location of the plugin configuration file"),
 
+        ConfigOpt("plugin", "preload", bool, default=True, options=None,
+                  help_msg="Import every plugin module in the background "
+                           "once the agent has connected"),
+        ConfigOpt("plugin", "preload_wait", float, default=60.0,
+                  options=None, minv=0.0,
+                  help_msg="The longest time in seconds that requests are "
+                           "held while the plugin modules are preloaded"),
+
         FilenameOpt("storage", "temppath", default="/tmp"),
         FilenameOpt("storage", "base_dir", default="/dcm"),
         FilenameOpt("storage", "mountpoint", default="/mnt/dcmdata"),
         FilenameOpt("storage", "dbfile", default=None),
         FilenameOpt("storage", "script_dir", default=None),
 
+        ConfigOpt("storage", "db_backend", str, default="sqlite",
+                  options=["sqlite", "journal"],
+                  help_msg="How the agent database is stored.  journal "
+                           "keeps the records in memory and appends each "
+                           "change to a journal file next to dbfile."),
+        ConfigOpt("storage", "db_journal_sync", bool, default=False,
+                  help_msg="Flush every journal write to the disk before "
+                           "going on.  Without it a write survives the "
+                           "agent crashing but not the host."),
+        ConfigOpt("storage", "db_journal_compact_ops", int, default=10000,
+                  minv=1,
+                  help_msg="The journal is not compacted into a snapshot "
+                           "until it has at least this many entries."),
         ConfigOpt("storage", "db_timeout", int, default=60*60*4,
                   help_msg="The amount of time in seconds for a request id to "
                            "stay in the database."),
+        ConfigOpt("storage", "db_max_rows", int, default=100000, minv=0,
+                  help_msg="The most requests that will be kept in the "
+                           "database.  The oldest completed requests are "
+                           "removed first when there are more."),
+        ConfigOpt("storage", "db_max_bytes", int, default=100*1024*1024,
+                  minv=0,
+                  help_msg="The most bytes the request history may use in "
+                           "the database.  The oldest completed requests are "
+                           "removed first when it grows beyond this."),
+        ConfigOpt("storage", "db_clean_interval", int, default=3600, minv=1,
+                  help_msg="The number of seconds between sweeps of the "
+                           "database for expired requests and size "
+                           "limits."),
+        ConfigOpt("storage", "db_alert_max_age", int, default=60*60*24*30,
+                  minv=0,
+                  help_msg="The number of seconds an intrusion detection "
+                           "alert is kept in the database."),
+        ConfigOpt("storage", "db_alert_max_rows", int, default=100000,
+                  minv=0,
+                  help_msg="The most intrusion detection alerts that will "
+                           "be kept in the database.  The oldest are "
+                           "removed first."),
+        ConfigOpt("storage", "db_doc_encoding", str, default="json",
+                  options=["json", "zlib"],
+                  help_msg="How request and reply documents are stored in "
+                           "the database.  zlib compresses large "
+                           "documents."),
+        ConfigOpt("storage", "db_thread_connections", bool, default=False,
+                  help_msg="Give every thread its own connection to the "
+                           "agent database and use WAL journaling so that "
+                           "reads do not wait on writes."),
+        ConfigOpt("storage", "db_busy_timeout", float, default=5.0,
+                  help_msg="The number of seconds a database connection "
+                           "will wait on a lock held by another connection "
+                           "before failing."),
+        ConfigOpt("storage", "db_group_commit_ms", float, default=None,
+                  help_msg="When set, writes to the agent database from all "
+                           "threads are collected for up to this many "
+                           "milliseconds and committed in a single "
+                           "transaction."),
+        ConfigOpt("storage", "db_group_commit_max_ops", int, default=64,
+                  minv=1,
+                  help_msg="The largest number of writes that will be "
+                           "committed in one group commit transaction."),
+        ConfigOpt("storage", "db_cache_size", int, default=1000, minv=0,
+                  help_msg="The number of requests, and of unknown request "
+                           "ids, kept in memory to answer lookups without "
+                           "going to the database.  0 turns the cache "
+                           "off."),
         ConfigOpt("storage", "default_filesystem", str, default="ext3"),
 
         ConfigOpt("system", "user", str, default="dcm"),
         ConfigOpt("system", "sudo", str, default="/usr/bin/sudo"),
+        ConfigOpt("system", "event_space", str, default="poll",
+                  options=["poll", "asyncio"],
+                  help_msg="What runs the agent main loop.  poll is the "
+                           "thread based event space and asyncio runs the "
+                           "same callbacks from an asyncio event loop."),
 
         ConfigOpt("intrusion_detection", "ossec", bool, default=False),
         ConfigOpt("intrusion_detection", "max_process_time", float, default=5.0,
@@ -13,13 +13,16 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 #
+import collections
 import logging
-import queue
 import threading
+import time
 import urllib.error
 import urllib.parse
 import urllib.request
 
+import dcm.agent.events.callback as callback
+import dcm.agent.plugin_pool as plugin_pool
 import dcm.agent.plugins.api.base as plugin_base
 import dcm.agent.plugins.loader as plugin_loader
 import dcm.agent.logger as dcm_logger
@@ -31,13 +34,16 @@ from dcm.agent.events.globals import global_space as dcm_events
 
 _g_logger = logging.getLogger(__name__)
 
+# how often the requests held for the plugin preload are looked at
+_g_preload_poll_interval = 0.1
+
 
 class WorkLoad(object):
     def __init__(self, request_id, payload, items_map):
         self.request_id = request_id
         self.payload = payload
         self.items_map = items_map
-        self.quit = False
+        self.queued_time = None
 
 
 class WorkReply(object):
@@ -48,17 +54,23 @@ class WorkReply(object):
 
 def _run_plugin(conf, items_map, request_id, command, arguments):
     try:
-        plugin = plugin_loader.load_plugin(
-            conf,
-            items_map,
-            request_id,
-            command,
-            arguments)
-
-        dcm_logger.log_to_dcm_console_job_started(job_name=command,
-                                                  request_id=request_id)
-        reply_obj = plugin.run()
-        reply_doc = reply_obj.get_reply_doc()
+        if plugin_pool.use_process(conf, items_map):
+            dcm_logger.log_to_dcm_console_job_started(job_name=command,
+                                                      request_id=request_id)
+            reply_doc = conf.plugin_pool.run(
+                request_id, items_map, command, arguments)
+        else:
+            plugin = plugin_loader.load_plugin(
+                conf,
+                items_map,
+                request_id,
+                command,
+                arguments)
+
+            dcm_logger.log_to_dcm_console_job_started(
+                job_name=command, request_id=request_id)
+            reply_obj = plugin.run()
+            reply_doc = reply_obj.get_reply_doc()
 
         dcm_logger.log_to_dcm_console_job_succeeded(job_name=command,
                                                     request_id=request_id)
@@ -78,104 +90,392 @@ def _run_plugin(conf, items_map, request_id, command, arguments):
     return reply_doc
 
 
-class Worker(threading.Thread):
+def _run_workload(conf, workload, reply_callback):
+    # setup message logging
+    with tracer.RequestTracer(workload.request_id):
+        reply_doc = _run_plugin(conf,
+                                workload.items_map,
+                                workload.request_id,
+                                workload.payload["command"],
+                                workload.payload["arguments"])
 
-    def __init__(self, conf, worker_queue, reply_callback):
-        super(Worker, self).__init__()
-        self.worker_queue = worker_queue
-        self._exit = threading.Event()
-        self._conf = conf
-        self._is_done = False
-        self._reply_callback = reply_callback
+        _g_logger.debug(
+            "Adding the reply document to the reply queue " + str(reply_doc))
+
+        work_reply = WorkReply(workload.request_id, reply_doc)
+        dcm_events.register_callback(
+            reply_callback, args=[work_reply],
+            priority=callback.CallbackPriority.WORK_COMPLETE)
+
+        _g_logger.info("Reply message sent for command " +
+                       workload.payload["command"])
 
-    # It should be safe to call done without a lock
-    def done(self):
-        _g_logger.debug("done() called on worker %s .." % self.getName())
-        self._is_done = True
-        self._exit.set()
 
-    def run(self):
+def _get_plugin_limit(items_map, key, default):
+    value = items_map.get(key)
+    if value is None:
+        return default
+    try:
+        value = int(value)
+    except ValueError:
+        _g_logger.warning("The plugin setting %s=%s is not an integer."
+                          % (key, value))
+        return default
+    if value < 1:
+        _g_logger.warning("The plugin setting %s=%d must be at least 1."
+                          % (key, value))
+        return default
+    return value
+
+
+class _CommandQueue(object):
+    """
+    The queued workloads of one command and its scheduling state.
+    """
+
+    def __init__(self, command):
+        self.command = command
+        self.queue = collections.deque()
+        self.running = 0
+        self.deficit = 0
+        self.max_concurrency = None
+        self.weight = 1
+
+    def configure(self, items_map):
+        self.max_concurrency = _get_plugin_limit(
+            items_map, "max_concurrency", None)
+        self.weight = _get_plugin_limit(items_map, "weight", 1)
+
+    def is_runnable(self):
+        return bool(self.queue) and (self.max_concurrency is None or
+                                     self.running < self.max_concurrency)
+
+    def free_slots(self):
+        if self.max_concurrency is None:
+            return len(self.queue)
+        return max(0, min(len(self.queue),
+                          self.max_concurrency - self.running))
+
+
+class WorkerPool(object):
+    """
+    The threads that run the plugins of queued commands.  min_workers
+    threads are always running.  When commands have waited in the queue for
+    scale_up_wait seconds a thread is started for each of them, up to
+    max_workers, so that a burst of slow commands does not hold up quick
+    ones behind it.  Threads above min_workers exit once they have been
+    idle for idle_timeout seconds.  The wait is checked from a timer in the
+    event space.
+
+    Each command has its own queue and the workers take from them by
+    deficit round robin, so a flood of one command cannot starve the
+    others.  The plugin section of a command can set:
+
+        max_concurrency: the most of the command that run at once
+        weight: how many of the command are taken in each round (1)
+    """
+
+    def __init__(self, run_func, min_workers=2, max_workers=8,
+                 scale_up_wait=2.0, idle_timeout=60.0):
+        """
+        :param run_func: Called with each submitted workload from a worker
+        thread.
+        """
+        self._run_func = run_func
+        self._min_workers = max(1, min_workers)
+        self._max_workers = max(self._min_workers, max_workers)
+        self._scale_up_wait = scale_up_wait
+        self._idle_timeout = idle_timeout
+        self._cond = threading.Condition()
+        # command name -> _CommandQueue, and the round robin order of the
+        # commands with queued workloads
+        self._queues = {}
+        self._active = collections.deque()
+        self._queued = 0
+        self._workers = []
+        self._idle = 0
+        self._busy = 0
+        self._stopping = False
+        self._check_timer = None
+        self._completed = 0
+        self._grown = 0
+        self._shrunk = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+    def _start_worker(self):
+        # This should only be called locked
+        worker = threading.Thread(target=self._run_worker,
+                                  name="DispatcherWorker")
+        self._workers.append(worker)
+        worker.start()
+        _g_logger.debug("Started worker %s, %d running."
+                        % (worker.getName(), len(self._workers)))
+
+    def start(self):
+        self._cond.acquire()
+        try:
+            self._stopping = False
+            while len(self._workers) < self._min_workers:
+                self._start_worker()
+        finally:
+            self._cond.release()
+
+    def submit(self, workload):
+        command = workload.payload["command"]
+        self._cond.acquire()
+        try:
+            try:
+                cq = self._queues[command]
+            except KeyError:
+                cq = _CommandQueue(command)
+                self._queues[command] = cq
+            # the plugin section is read again for every request so follow
+            # any change to it
+            cq.configure(workload.items_map)
+            if not cq.queue:
+                self._active.append(cq)
+            workload.queued_time = time.monotonic()
+            cq.queue.append(workload)
+            self._queued += 1
+            if not cq.is_runnable():
+                return
+            if self._idle > 0:
+                self._cond.notify()
+            if len(self._workers) < self._min_workers:
+                self._start_worker()
+            elif self._queued > self._idle:
+                self._schedule_check(self._scale_up_wait)
+        finally:
+            self._cond.release()
+
+    def _has_runnable(self):
+        # This should only be called locked
+        for cq in self._active:
+            if cq.is_runnable():
+                return True
+        return False
+
+    def _take_next(self):
+        # This should only be called locked.  Deficit round robin: the
+        # command at the front of the round gets weight more turns each
+        # time it comes up and is moved to the back once it has used them
+        for _ in range(len(self._active)):
+            cq = self._active[0]
+            if not cq.is_runnable():
+                self._active.rotate(-1)
+                continue
+            if cq.deficit < 1:
+                cq.deficit += cq.weight
+            cq.deficit -= 1
+            workload = cq.queue.popleft()
+            self._queued -= 1
+            cq.running += 1
+            if not cq.queue:
+                self._active.popleft()
+                cq.deficit = 0
+            elif cq.deficit < 1:
+                self._active.rotate(-1)
+            return workload
+        return None
+
+    def _finished(self, cq):
+        # This should only be called locked
+        cq.running -= 1
+        if cq.running == 0 and not cq.queue:
+            del self._queues[cq.command]
+        if self._stopping:
+            # let the waiting workers see if they can exit
+            self._cond.notifyAll()
+        elif cq.is_runnable() and self._idle > 0:
+            # a capped command may be able to run again
+            self._cond.notify()
+
+    def _schedule_check(self, delay):
+        # This should only be called locked
+        if (self._check_timer is not None or self._stopping or
+                len(self._workers) >= self._max_workers):
+            return
+        self._check_timer = dcm_events.register_callback(
+            self._check_wait, delay=delay)
+
+    def _check_wait(self):
+        self._cond.acquire()
         try:
-            _g_logger.info("Worker %s thread starting." % self.getName())
+            self._check_timer = None
+            if self._stopping or not self._queued:
+                return
+            now = time.monotonic()
+            # the workloads that have waited too long, could run now and
+            # that an idle worker is not about to pick up
+            late = 0
+            next_late = None
+            for cq in self._active:
+                slots = cq.free_slots()
+                for workload in cq.queue:
+                    if slots == 0:
+                        break
+                    ready_time = workload.queued_time + self._scale_up_wait
+                    if ready_time > now:
+                        if next_late is None or ready_time < next_late:
+                            next_late = ready_time
+                        break
+                    late += 1
+                    slots -= 1
+            grow = min(late - self._idle,
+                       self._max_workers - len(self._workers))
+            for _ in range(grow):
+                self._start_worker()
+                self._grown += 1
+            if grow > 0:
+                _g_logger.info("%d commands waited more than %.1f seconds, "
+                               "%d workers are now running."
+                               % (late, self._scale_up_wait,
+                                  len(self._workers)))
+            if next_late is not None:
+                delay = next_late - now
+            else:
+                delay = self._scale_up_wait
+            self._schedule_check(delay)
+        finally:
+            self._cond.release()
 
-            done = False
-            while not done:
+    def _run_worker(self):
+        this_thread = threading.currentThread()
+        _g_logger.info("Worker %s thread starting." % this_thread.getName())
+        self._cond.acquire()
+        try:
+            while True:
+                workload = self._take_next()
+                while workload is None:
+                    if self._stopping and not self._queued:
+                        break
+                    self._idle += 1
+                    woken = self._cond.wait(self._idle_timeout)
+                    self._idle -= 1
+                    workload = self._take_next()
+                    if (workload is None and not woken and
+                            not self._stopping and
+                            len(self._workers) > self._min_workers):
+                        self._shrunk += 1
+                        break
+                if workload is None:
+                    self._workers.remove(this_thread)
+                    return
+                cq = self._queues[workload.payload["command"]]
+                wait_time = time.monotonic() - workload.queued_time
+                self._wait_total += wait_time
+                self._wait_max = max(self._wait_max, wait_time)
+                self._busy += 1
+                self._cond.release()
                 try:
-                    workload = self.worker_queue.get()
-                    if workload is None:
-                        continue
-                    if workload.quit:
-                        done = True
-                        self.worker_queue.task_done()
-                        continue
-
-                    # setup message logging
-                    with tracer.RequestTracer(workload.request_id):
-
-                        reply_doc = _run_plugin(self._conf,
-                                                workload.items_map,
-                                                workload.request_id,
-                                                workload.payload["command"],
-                                                workload.payload["arguments"])
-                        self.worker_queue.task_done()
-
-                        _g_logger.debug(
-                            "Adding the reply document to the reply "
-                            "queue " + str(reply_doc))
-
-                        work_reply = WorkReply(workload.request_id, reply_doc)
-                        dcm_events.register_callback(
-                            self._reply_callback, args=[work_reply])
-
-                        _g_logger.info("Reply message sent for command " +
-                                       workload.payload["command"])
-                except queue.Empty:
-                    pass
-                except:
+                    self._run_func(workload)
+                except BaseException:
                     _g_logger.exception(
                         "Something went wrong processing the queue")
-                    raise
+                finally:
+                    self._cond.acquire()
+                    self._busy -= 1
+                    self._completed += 1
+                    self._finished(cq)
+        finally:
+            self._cond.release()
+            _g_logger.info("Worker %s thread ending." % this_thread.getName())
+
+    def stop(self):
+        """
+        Run what is left in the queue and wait for every worker to exit.
+        """
+        self._cond.acquire()
+        try:
+            self._stopping = True
+            if self._check_timer is not None:
+                dcm_events.cancel_callback(self._check_timer)
+                self._check_timer = None
+            self._cond.notifyAll()
+            workers = self._workers[:]
+        finally:
+            self._cond.release()
+        for worker in workers:
+            _g_logger.debug("Stopping worker %s" % str(worker))
+            worker.join()
+            _g_logger.debug("Worker %s is done" % str(worker))
+
+    def get_stats(self):
+        """
+        :return: A dict of gauges: the running, idle and busy workers, the
+        number of queued commands and how long the oldest has waited, the
+        queued and running count of each command, and the mean and max time
+        commands waited before a worker took them.
+        """
+        self._cond.acquire()
+        try:
+            now = time.monotonic()
+            oldest_wait = 0.0
+            commands = {}
+            for cq in self._queues.values():
+                if cq.queue:
+                    oldest_wait = max(oldest_wait,
+                                      now - cq.queue[0].queued_time)
+                commands[cq.command] = {"queued": len(cq.queue),
+                                        "running": cq.running}
+            if self._completed:
+                wait_mean = self._wait_total / self._completed
+            else:
+                wait_mean = 0.0
+            return {"workers": len(self._workers),
+                    "idle": self._idle,
+                    "busy": self._busy,
+                    "queued": self._queued,
+                    "oldest_wait": oldest_wait,
+                    "commands": commands,
+                    "min_workers": self._min_workers,
+                    "max_workers": self._max_workers,
+                    "completed": self._completed,
+                    "grown": self._grown,
+                    "shrunk": self._shrunk,
+                    "wait_mean": wait_mean,
+                    "wait_max": self._wait_max}
         finally:
-            _g_logger.info("Worker %s thread ending." % self.getName())
+            self._cond.release()
 
 
 class Dispatcher(object):
 
     def __init__(self, conf):
         self._conf = conf
-        self.workers = []
-        self.worker_q = queue.Queue()
+        self._pool = WorkerPool(
+            self._run_workload,
+            min_workers=conf.workers_count,
+            max_workers=conf.workers_max_count,
+            scale_up_wait=conf.workers_scale_up_wait,
+            idle_timeout=conf.workers_idle_timeout)
         self._long_runner = longrunners.LongRunner(conf)
         self.request_listener = None
+        # the requests acked while the plugin modules were being preloaded
+        self._held = collections.deque()
+        self._preload_wait_start = None
+        self._preload_wait_expired = False
+
+    def _run_workload(self, workload):
+        _run_workload(self._conf, workload, self.work_complete_callback)
 
     def start_workers(self, request_listener):
-        _g_logger.info("Starting %d workers." % self._conf.workers_count)
+        _g_logger.info("Starting %d workers, growing to at most %d."
+                       % (self._conf.workers_count,
+                          self._conf.workers_max_count))
         self.request_listener = request_listener
-        for i in range(self._conf.workers_count):
-            worker = Worker(self._conf, self.worker_q,
-                            self.work_complete_callback)
-            _g_logger.debug("Starting worker %d : %s" % (i, str(worker)))
-            worker.start()
-            self.workers.append(worker)
+        self._pool.start()
+
+    def get_worker_stats(self):
+        return self._pool.get_stats()
 
     def stop(self):
         _g_logger.info("Stopping workers.")
-
-        for _ in self.workers:
-            workload = WorkLoad(None, None, None)
-            workload.quit = True
-            self.worker_q.put(workload)
-
-        for w in self.workers:
-            _g_logger.debug("Stopping worker %s" % str(w))
-            w.done()
-            w.join()
-            _g_logger.debug("Worker %s is done" % str(w))
+        self._pool.stop()
+        _g_logger.info("Worker statistics: %s" % str(self._pool.get_stats()))
         _g_logger.info("Shutting down the long runner.")
         self._long_runner.shutdown()
-        _g_logger.info("Flushing the work queue.")
-        while not self.worker_q.empty():
-            self.worker_q.get()
         _g_logger.info("The dispatcher is closed.")
 
     def incoming_request(self, reply_obj):
@@ -190,14 +490,61 @@ class Dispatcher(object):
         dcm_logger.log_to_dcm_console_incoming_message(
             job_name=payload["command"])
 
+        # we ack first.  This will write it to the persistent store before
+        # sending the message so the agent will have it for restarts.  Only
+        # plugins run in the process pool can be canceled
+        if plugin_pool.use_process(self._conf, items_map):
+            reply_obj.ack(self._cancel_request, None, None)
+        else:
+            reply_obj.ack(None, None, None)
+        _g_logger.debug(
+            "The request %s has been set to send an ACK" % request_id)
+        if self._hold_for_preload(request_id, payload, items_map):
+            return
+        self._start_request(request_id, payload, items_map)
+
+    def _hold_for_preload(self, request_id, payload, items_map):
+        # requests are not started until the plugins that failed to load
+        # have been reported.  This is on the main loop so the requests are
+        # kept in order and looked at again rather than waited on
+        if not self._held and (self._preload_wait_expired or
+                               plugin_loader.preload_finished()):
+            return False
+        _g_logger.debug("Holding request %s until the plugins are preloaded"
+                        % request_id)
+        if self._preload_wait_start is None:
+            self._preload_wait_start = time.monotonic()
+        self._held.append((request_id, payload, items_map))
+        if len(self._held) == 1:
+            dcm_events.register_callback(
+                self._release_held, delay=_g_preload_poll_interval)
+        return True
+
+    def _release_held(self):
+        if not plugin_loader.preload_finished():
+            waited = time.monotonic() - self._preload_wait_start
+            if waited <= self._conf.plugin_preload_wait:
+                dcm_events.register_callback(
+                    self._release_held, delay=_g_preload_poll_interval)
+                return
+            _g_logger.warning("The plugin preload did not finish in %.1f "
+                              "seconds, requests are no longer held for it."
+                              % waited)
+            self._preload_wait_expired = True
+        while self._held:
+            (request_id, payload, items_map) = self._held.popleft()
+            try:
+                self._start_request(request_id, payload, items_map)
+            except Exception:
+                _g_logger.exception("The held request %s could not be "
+                                    "started" % request_id)
+
+    def _start_request(self, request_id, payload, items_map):
         immediate = "immediate" in items_map
         long_runner = "longer_runner" in items_map
         if "longer_runner" in payload:
             long_runner = bool(payload["longer_runner"])
 
-        # we ack first.  This will write it to the persistent store before
-        # sending the message so the agent will have it for restarts
-        reply_obj.ack(None, None, None)
         if long_runner:
             try:
                 dj = self._long_runner.start_new_job(
@@ -217,7 +564,8 @@ class Dispatcher(object):
             reply_doc = reply_obj.get_reply_doc()
             wr = WorkReply(request_id, reply_doc)
             dcm_events.register_callback(
-                self.work_complete_callback, args=[wr])
+                self.work_complete_callback, args=[wr],
+                priority=callback.CallbackPriority.WORK_COMPLETE)
         elif immediate:
             items_map["long_runner"] = self._long_runner
             reply_doc = _run_plugin(self._conf,
@@ -227,13 +575,18 @@ class Dispatcher(object):
                                     payload["arguments"])
             wr = WorkReply(request_id, reply_doc)
             dcm_events.register_callback(
-                self.work_complete_callback, args=[wr])
+                self.work_complete_callback, args=[wr],
+                priority=callback.CallbackPriority.WORK_COMPLETE)
         else:
             workload = WorkLoad(request_id, payload, items_map)
-            self.worker_q.put(workload)
+            self._pool.submit(workload)
 
-        _g_logger.debug(
-            "The request %s has been set to send an ACK" % request_id)
+    def _cancel_request(self, reply_obj, **kwargs):
+        request_id = reply_obj.get_request_id()
+        _g_logger.info("Request %s was canceled" % request_id)
+        pool = self._conf.plugin_pool
+        if pool is not None:
+            pool.cancel(request_id)
 
     def work_complete_callback(self, work_reply):
         self.request_listener.reply(work_reply.request_id,
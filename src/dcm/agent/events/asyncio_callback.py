@@ -0,0 +1,249 @@
+#
+#  Copyright (C) 2014 Dell, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import asyncio
+import logging
+import threading
+
+import dcm.agent.events.callback as callback
+
+
+_g_logger = logging.getLogger(__name__)
+
+
+class AsyncioEventSpace(callback.EventSpace):
+    """
+    An EventSpace that keeps its timers in an asyncio event loop.  The
+    loop only runs inside poll() so the agent main loop drives it the same
+    way it drives the plain EventSpace, but anything run by the loop can
+    also schedule coroutines and futures on get_loop().
+
+    Callbacks can be registered and canceled from any thread.  The loop
+    uses time.monotonic() like UserCallback so ready times are passed to it
+    as they are.
+    """
+
+    def __init__(self, loop=None, **kwargs):
+        """
+        :param loop: The asyncio loop to use.  A new one is made when this
+        is None.  Nothing else should run the loop.  The other keyword
+        arguments are those of EventSpace except for the scheduler.
+        """
+        super(AsyncioEventSpace, self).__init__(**kwargs)
+        if loop is None:
+            loop = asyncio.new_event_loop()
+        self._loop = loop
+        self._loop_thread = None
+        # the timers are in the loop.  This maps each callback that has not
+        # come due to its loop handle, or None until the loop has seen it
+        self._timers = None
+        self._pending = {}
+        self._run_scheduled = False
+        self._any_called = False
+
+    def get_loop(self):
+        return self._loop
+
+    def _call_in_loop(self, func, *args):
+        if threading.currentThread() is self._loop_thread:
+            func(*args)
+        else:
+            self._loop.call_soon_threadsafe(func, *args)
+
+    def register_callback(self, func, args=None, kwargs=None, delay=0,
+                          in_thread=False,
+                          priority=callback.CallbackPriority.CONTROL):
+        self._cond.acquire()
+        try:
+            if self._done:
+                raise Exception("We cannot register callbacks because this "
+                                "space has been stopped.")
+            ub = callback.UserCallback(func, args, kwargs, delay, in_thread,
+                                       priority=priority)
+            self._pending[ub] = None
+        finally:
+            self._cond.release()
+        self._call_in_loop(self._schedule, ub)
+        return ub
+
+    def _schedule(self, ub):
+        # run by the loop
+        self._cond.acquire()
+        try:
+            if ub not in self._pending:
+                # canceled before the loop got to it
+                return
+            ready_time = ub.get_time_ready()
+            if ready_time > self._loop.time():
+                self._pending[ub] = self._loop.call_at(
+                    ready_time, self._callback_ready, ub)
+                return
+        finally:
+            self._cond.release()
+        self._callback_ready(ub)
+
+    def _callback_ready(self, ub):
+        # run by the loop
+        self._cond.acquire()
+        try:
+            if self._pending.pop(ub, False) is False:
+                return
+            if ub.in_thread():
+                self._submit_threaded(ub)
+                return
+            self._ready[ub._priority].append(ub)
+            if self._run_scheduled:
+                return
+            self._run_scheduled = True
+        finally:
+            self._cond.release()
+        # what comes due in this turn of the loop is run in the next one so
+        # that poll cycles pick from everything that is ready
+        self._loop.call_soon(self._run_ready)
+
+    def _run_ready(self):
+        self._cond.acquire()
+        try:
+            if self._done:
+                self._run_scheduled = False
+                return
+            ready_list = self._next_cycle(self._loop.time())
+            # let the loop handle its other events before the next cycle
+            self._run_scheduled = any(self._ready)
+        finally:
+            self._cond.release()
+        if self._run_scheduled:
+            self._loop.call_soon(self._run_ready)
+        if ready_list:
+            self._any_called = True
+            self._run_cycle(ready_list)
+
+    def cancel_callback(self, ub):
+        self._cond.acquire()
+        try:
+            rc = ub._cancel()
+            if rc:
+                handle = self._pending.pop(ub, None)
+                if handle is not None:
+                    self._call_in_loop(handle.cancel)
+            return rc
+        finally:
+            self._cond.release()
+
+    def _threaded_done(self):
+        self._cond.acquire()
+        try:
+            self._cond.notifyAll()
+            hand_off = bool(self._deferred)
+        finally:
+            self._cond.release()
+        if hand_off:
+            self._loop.call_soon_threadsafe(self._hand_off_deferred)
+
+    def _hand_off_deferred(self):
+        self._cond.acquire()
+        try:
+            while self._deferred and self._pool.submit(self._deferred[0]):
+                self._deferred.popleft()
+        finally:
+            self._cond.release()
+
+    def _stop_poll(self):
+        # give whatever came due with the end of the poll one more turn of
+        # the loop to run before stopping it
+        self._loop.call_soon(self._loop.stop)
+
+    def poll(self, timeblock=5.0):
+        """
+        Run the asyncio loop for timeblock seconds.  Callbacks that come
+        due are called from this thread or handed to the worker pool.
+        :param timeblock: The amount of time to wait for events to be ready
+        :return: A boolean is returned to indicate if an event was called
+        or not
+        """
+        self._cond.acquire()
+        try:
+            if self._done:
+                return False
+            self._loop_thread = threading.currentThread()
+        finally:
+            self._cond.release()
+
+        self._any_called = False
+        stop_handle = self._loop.call_at(
+            self._loop.time() + timeblock, self._stop_poll)
+        try:
+            self._hand_off_deferred()
+            self._loop.run_forever()
+        finally:
+            stop_handle.cancel()
+            self._cond.acquire()
+            try:
+                self._loop_thread = None
+            finally:
+                self._cond.release()
+        return self._any_called
+
+    def stop(self):
+        self._cond.acquire()
+        try:
+            self._done = True
+            if self._loop_thread is not None:
+                # end the running poll like the plain EventSpace does
+                self._call_in_loop(self._loop.stop)
+        finally:
+            self._cond.release()
+
+    def _cancel_all(self):
+        # This should only be called locked
+        for ub, handle in list(self._pending.items()):
+            ub._cancel()
+            if handle is not None:
+                self._call_in_loop(handle.cancel)
+        self._pending.clear()
+        self._cancel_ready()
+        for ub in self._deferred:
+            ub._cancel()
+        self._deferred.clear()
+        self._pool.cancel_queued()
+
+    def wakeup(self, cancel_all=False):
+        self._cond.acquire()
+        try:
+            if cancel_all:
+                self._cancel_all()
+            self._cond.notifyAll()
+        finally:
+            self._cond.release()
+        self._loop.call_soon_threadsafe(lambda: None)
+
+    def reset(self):
+        self._cond.acquire()
+        try:
+            self._done = True
+            self._cancel_all()
+            # wait for the threaded callbacks that already started
+            while self._pool.busy_count() > 0:
+                self._cond.wait()
+        finally:
+            self._cond.release()
+
+        self._pool.stop()
+
+        self._cond.acquire()
+        try:
+            self._done = False
+        finally:
+            self._cond.release()
@@ -13,15 +13,29 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 #
-import datetime
+import collections
 import heapq
 import logging
+import math
 import threading
+import time
 
 
 _g_logger = logging.getLogger(__name__)
 
 
+class CallbackPriority(object):
+    """
+    The classes of callbacks.  When more than one callback is ready poll()
+    runs the lower numbered classes first.
+    """
+    CONTROL = 0
+    WORK_COMPLETE = 1
+    TELEMETRY = 2
+
+    ALL = [CONTROL, WORK_COMPLETE, TELEMETRY]
+
+
 class UserCallback(object):
     """
     This object is a handle to an event which was registered in an EventSpace.
@@ -29,28 +43,34 @@ class UserCallback(object):
     examine the results of a event that has completed.
     """
 
-    def __init__(self, func, args, kwargs, delay, in_thread):
+    def __init__(self, func, args, kwargs, delay, in_thread,
+                 priority=CallbackPriority.CONTROL):
         self._func = func
+        self._priority = priority
         self._canceled = False
         self._called = False
         self._calling = False
         self._args = args
         self._in_thread = in_thread
         self._run_thread = None
+        # when a threaded callback was handed off to wait for a worker
+        self._queued_time = None
         if args is None:
             self._args = []
         self._kwargs = kwargs
         if kwargs is None:
             self._kwargs = {}
-        self._time_ready = datetime.datetime.now() +\
-            datetime.timedelta(seconds=delay)
+        self._time_ready = time.monotonic() + delay
         self._lock = threading.RLock()
         self._rc = None
         self._exception = None
+        # the timing wheel slot holding this callback, if any
+        self._wheel_slot = None
 
     def get_time_ready(self):
         """
-        :return: The time at which this callback will be ready to be called.
+        :return: The time.monotonic() time at which this callback will be
+        ready to be called.
         """
         self._lock.acquire()
         try:
@@ -98,7 +118,7 @@ class UserCallback(object):
         """
         self._lock.acquire()
         try:
-            self._time_ready = datetime.datetime.now()
+            self._time_ready = time.monotonic()
             self._canceled = True
             return not self._calling
         finally:
@@ -106,14 +126,14 @@ class UserCallback(object):
 
     def is_ready(self, tm=None):
         """
-        :param tm: The time to check the ready time against.  If None the
-        current time will be used.
+        :param tm: The time.monotonic() time to check the ready time against.
+        If None the current time will be used.
         :return:  A bool indicating if this callback object is ready to be
         called.  If the associated delay has expired the callback is ready
         to be called and True is returned.
         """
         if tm is None:
-            tm = datetime.datetime.now()
+            tm = time.monotonic()
         self._lock.acquire()
         try:
             return self._time_ready <= tm
@@ -172,6 +192,372 @@ class UserCallback(object):
             self._run_thread = None
 
 
+class HeapScheduler(object):
+    """
+    Keep the pending callbacks in a heap ordered by their ready time.
+    Canceled callbacks are left in place and are dropped when they come
+    due.
+    """
+
+    def __init__(self):
+        self._q = []
+
+    def push(self, ub):
+        heapq.heappush(self._q, ub)
+
+    def remove(self, ub):
+        pass
+
+    def pop_ready(self, now):
+        ready = []
+        while self._q and self._q[0].is_ready(tm=now):
+            ready.append(heapq.heappop(self._q))
+        return ready
+
+    def next_time(self):
+        """
+        :return: The time the next callback will be ready or None if there
+        are none.
+        """
+        if not self._q:
+            return None
+        return self._q[0].get_time_ready()
+
+    def callbacks(self):
+        return list(self._q)
+
+    def clear(self):
+        self._q = []
+
+    def __len__(self):
+        return len(self._q)
+
+
+class TimingWheel(object):
+    """
+    A hierarchical timing wheel.  Time is cut into ticks and each level is
+    a ring of slots.  A slot in the first level holds the callbacks that
+    are ready in one tick, a slot in the next level holds the callbacks for
+    slots_per_level ticks and so on.  When the first level comes around
+    the next slot of the level above it is spread out over the levels
+    below.  Adding and canceling a callback only touch the one slot it is
+    in so both are O(1), and canceled callbacks are really removed.
+
+    A callback is never run before its ready time but may run up to one
+    tick after it.  Anything further out than the top level can reach is
+    kept on an overflow list that is looked at each time the top level
+    turns.  clock is what the wheel reads the time from, time.monotonic()
+    when it is None.
+    """
+
+    def __init__(self, tick=0.01, levels=4, slot_bits=8, clock=None):
+        if clock is None:
+            clock = time.monotonic
+        self._clock = clock
+        self._tick = tick
+        self._slot_bits = slot_bits
+        self._slots_per_level = 1 << slot_bits
+        self._slot_mask = self._slots_per_level - 1
+        self._levels = [[collections.OrderedDict()
+                         for _ in range(self._slots_per_level)]
+                        for _ in range(levels)]
+        self._overflow = collections.OrderedDict()
+        self._due = collections.OrderedDict()
+        self._epoch = clock()
+        self._current_tick = 0
+        self._count = 0
+
+    def _tick_of(self, tm):
+        return int(math.ceil((tm - self._epoch) / self._tick))
+
+    def _place(self, ub, now):
+        ready_time = ub.get_time_ready()
+        ready_tick = self._tick_of(ready_time)
+        delta = ready_tick - self._current_tick
+        if delta <= 0 or ready_time <= now:
+            slot = self._due
+        else:
+            slot = self._overflow
+            for level, ring in enumerate(self._levels):
+                if delta < 1 << (self._slot_bits * (level + 1)):
+                    index = (ready_tick >> (self._slot_bits * level)) & \
+                        self._slot_mask
+                    slot = ring[index]
+                    break
+        slot[ub] = True
+        ub._wheel_slot = slot
+
+    def push(self, ub):
+        self._place(ub, self._clock())
+        self._count += 1
+
+    def remove(self, ub):
+        slot = ub._wheel_slot
+        if slot is not None and ub in slot:
+            del slot[ub]
+            ub._wheel_slot = None
+            self._count -= 1
+
+    def _cascade(self, slot, now):
+        callbacks = list(slot)
+        slot.clear()
+        for ub in callbacks:
+            self._place(ub, now)
+
+    def _advance(self):
+        # move to the next tick and return the slot of callbacks that are
+        # ready in it.  What is spread out is placed against the time of
+        # this tick, not the time of the poll, so that a poll that catches
+        # up several ticks does not take later callbacks early
+        self._current_tick += 1
+        tick = self._current_tick
+        now = self._epoch + tick * self._tick
+        if tick & self._slot_mask == 0:
+            # find the highest level that turns on this tick.  the levels
+            # are spread out from the top down so that a callback can fall
+            # more than one level in a single turn
+            top = 0
+            while top < len(self._levels) and \
+                    tick & ((1 << (self._slot_bits * (top + 1))) - 1) == 0:
+                top += 1
+            if top == len(self._levels):
+                self._cascade(self._overflow, now)
+                top -= 1
+            for level in range(top, 0, -1):
+                index = (tick >> (self._slot_bits * level)) & \
+                    self._slot_mask
+                self._cascade(self._levels[level][index], now)
+        return self._levels[0][tick & self._slot_mask]
+
+    def pop_ready(self, now):
+        now_tick = int(math.floor((now - self._epoch) / self._tick))
+        if self._count == len(self._due):
+            # nothing is waiting in the wheel so there is nothing to turn
+            self._current_tick = max(self._current_tick, now_tick)
+        # what was already ready when it was pushed
+        ready = list(self._due)
+        self._due.clear()
+        while self._current_tick < now_tick:
+            slot = self._advance()
+            # a cascade puts what is ready in this tick on the due list
+            ready.extend(self._due)
+            self._due.clear()
+            ready.extend(slot)
+            slot.clear()
+        if len(ready) > 1:
+            # a callback pushed already ready may be due after some that
+            # waited in the wheel for a late poll.  The sort is stable so
+            # the order within a tick is kept
+            ready.sort(key=lambda ub: self._tick_of(ub.get_time_ready()))
+        for ub in ready:
+            ub._wheel_slot = None
+        self._count -= len(ready)
+        return ready
+
+    def next_time(self):
+        """
+        :return: The time of the next tick with callbacks in it or None if
+        there are none.  When the first level is empty this is the time the
+        next higher slot is spread out, which may be earlier than the next
+        callback.
+        """
+        if self._count == 0:
+            return None
+        if self._due:
+            return self._epoch
+        ring = self._levels[0]
+        for i in range(1, self._slots_per_level + 1):
+            tick = self._current_tick + i
+            if ring[tick & self._slot_mask]:
+                break
+            if tick & self._slot_mask == 0:
+                break
+        return self._epoch + tick * self._tick
+
+    def callbacks(self):
+        callbacks = list(self._due) + list(self._overflow)
+        for ring in self._levels:
+            for slot in ring:
+                callbacks.extend(slot)
+        return callbacks
+
+    def clear(self):
+        for ub in self.callbacks():
+            ub._wheel_slot = None
+        for ring in self._levels:
+            for slot in ring:
+                slot.clear()
+        self._overflow.clear()
+        self._due.clear()
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+
+class CallbackWorkerPool(object):
+    """
+    A bounded set of threads that run the in_thread callbacks of an
+    EventSpace.  Workers are started as callbacks are submitted, up to
+    max_workers, and are reused until they have been idle for idle_timeout
+    seconds.  At most max_queue callbacks wait for a free worker, beyond
+    that submit() refuses the callback and the caller has to hold on to it.
+    """
+
+    def __init__(self, max_workers=8, max_queue=64, idle_timeout=10.0):
+        self._max_workers = max_workers
+        self._max_queue = max_queue
+        self._idle_timeout = idle_timeout
+        self._cond = threading.Condition()
+        self._queue = collections.deque()
+        self._workers = []
+        self._idle = 0
+        self._busy = 0
+        self._stopping = False
+        self._done_cb = None
+        self._completed = 0
+        self._rejected = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+    def set_done_callback(self, done_cb):
+        """
+        :param done_cb: A function called with no arguments, and with no
+        pool locks held, each time a worker finishes a callback.
+        """
+        self._done_cb = done_cb
+
+    def configure(self, max_workers=None, max_queue=None):
+        self._cond.acquire()
+        try:
+            if max_workers is not None:
+                self._max_workers = max(1, max_workers)
+            if max_queue is not None:
+                self._max_queue = max(0, max_queue)
+        finally:
+            self._cond.release()
+
+    def submit(self, ub):
+        """
+        :return: False if the callback was not accepted because the queue
+        is full or the pool is stopping.
+        """
+        self._cond.acquire()
+        try:
+            if self._stopping or len(self._queue) >= self._max_queue:
+                self._rejected += 1
+                return False
+            if ub._queued_time is None:
+                ub._queued_time = time.monotonic()
+            self._queue.append(ub)
+            if self._idle >= len(self._queue):
+                self._cond.notify()
+            elif len(self._workers) < self._max_workers:
+                worker = threading.Thread(target=self._run_worker,
+                                          name="EventSpaceWorker")
+                self._workers.append(worker)
+                worker.start()
+            return True
+        finally:
+            self._cond.release()
+
+    def _run_worker(self):
+        this_thread = threading.currentThread()
+        self._cond.acquire()
+        try:
+            while True:
+                while not self._queue and not self._stopping:
+                    self._idle += 1
+                    woken = self._cond.wait(self._idle_timeout)
+                    self._idle -= 1
+                    if not woken and not self._queue:
+                        break
+                if not self._queue:
+                    self._workers.remove(this_thread)
+                    return
+                ub = self._queue.popleft()
+                wait_time = max(0.0, time.monotonic() - ub._queued_time)
+                self._wait_total += wait_time
+                self._wait_max = max(self._wait_max, wait_time)
+                self._busy += 1
+                self._cond.release()
+                try:
+                    ub.call()
+                finally:
+                    self._cond.acquire()
+                    self._busy -= 1
+                    self._completed += 1
+                    done_cb = self._done_cb
+                if done_cb is not None:
+                    self._cond.release()
+                    try:
+                        done_cb()
+                    finally:
+                        self._cond.acquire()
+        finally:
+            self._cond.release()
+
+    def busy_count(self):
+        self._cond.acquire()
+        try:
+            return self._busy
+        finally:
+            self._cond.release()
+
+    def cancel_queued(self):
+        """
+        Cancel and drop every callback that has not been picked up by a
+        worker.
+        """
+        self._cond.acquire()
+        try:
+            for ub in self._queue:
+                ub._cancel()
+            self._queue.clear()
+        finally:
+            self._cond.release()
+
+    def stop(self):
+        """
+        Stop the idle workers and wait for them to exit.  Callbacks still
+        in the queue are run first.  The pool can be used again once this
+        returns.
+        """
+        self._cond.acquire()
+        try:
+            self._stopping = True
+            self._cond.notifyAll()
+            workers = self._workers[:]
+        finally:
+            self._cond.release()
+        for worker in workers:
+            worker.join()
+        self._cond.acquire()
+        try:
+            self._stopping = False
+        finally:
+            self._cond.release()
+
+    def get_stats(self):
+        self._cond.acquire()
+        try:
+            if self._completed:
+                wait_mean = self._wait_total / self._completed
+            else:
+                wait_mean = 0.0
+            return {"workers": len(self._workers),
+                    "busy": self._busy,
+                    "queued": len(self._queue),
+                    "max_workers": self._max_workers,
+                    "max_queue": self._max_queue,
+                    "completed": self._completed,
+                    "rejected": self._rejected,
+                    "wait_mean": wait_mean,
+                    "wait_max": self._wait_max}
+        finally:
+            self._cond.release()
+
+
 class EventSpace(object):
     """
     A class for managing and running events.
@@ -187,18 +573,55 @@ class EventSpace(object):
     managing them.
     """
 
-    def __init__(self):
+    def __init__(self, scheduler=None, worker_pool=None,
+                 slow_cycle_warning=None, priority_aging=0.5, cycle_size=32):
         """
-        :return:
+        :param scheduler: The object that orders the pending callbacks.  A
+        HeapScheduler is used when this is None.  A TimingWheel does
+        better when many callbacks are registered and canceled.
+        :param worker_pool: The CallbackWorkerPool that runs the in_thread
+        callbacks.  One with the default limits is made when this is None.
+        :param slow_cycle_warning: Log a warning when the callbacks of one
+        poll cycle take longer than this many seconds or one of them ran
+        this late.  None turns the warning off.
+        :param priority_aging: A ready callback is treated as one priority
+        class higher for every this many seconds it has waited, so that a
+        busy higher class cannot starve the lower ones.
+        :param cycle_size: The most callbacks run in one poll cycle.  Newly
+        ready callbacks of a higher class get in between cycles.
         """
-        self._q = []
+        if scheduler is None:
+            scheduler = HeapScheduler()
+        if worker_pool is None:
+            worker_pool = CallbackWorkerPool()
+        self._timers = scheduler
         self._cond = threading.Condition()
         self._done = False
-        self._running_threads = []
-        self._done_threads = []
+        self._pool = worker_pool
+        self._pool.set_done_callback(self._threaded_done)
+        # threaded callbacks that are ready but were refused by the full
+        # worker queue, in the order they came ready
+        self._deferred = collections.deque()
+        # ready callbacks that poll() has not run yet, one FIFO per
+        # priority class
+        self._ready = [collections.deque() for _ in CallbackPriority.ALL]
+        self._priority_aging = priority_aging
+        self._cycle_size = cycle_size
+        self._slow_cycle_warning = slow_cycle_warning
+        self._poll_observer = None
+        self._stats_lock = threading.Lock()
+        self._cycles = 0
+        self._callbacks_run = 0
+        self._callback_time = 0.0
+        self._max_cycle_time = 0.0
+        self._slowest_callback = None
+        self._slowest_callback_time = 0.0
+        self._max_lag = 0.0
+        self._last_cycle = None
 
     def register_callback(self, func, args=None, kwargs=None, delay=0,
-                          in_thread=False):
+                          in_thread=False,
+                          priority=CallbackPriority.CONTROL):
         """
         :param func: The callable object (typically a function or a method)
          which will be called later by the event system.
@@ -209,7 +632,10 @@ class EventSpace(object):
         as **kwargs
         :param delay: The number or seconds to wait before calling func.  More
          time may expire but at least the given number of seconds will pass.
-        :param in_thread: Run the callback in its own thread.
+        :param in_thread: Run the callback in a thread from the worker pool
+        instead of from poll().
+        :param priority: One of the CallbackPriority classes.  It decides
+        the order in which poll() runs the callbacks that are ready.
         :return: A UserCallback object which is a handle to this callback
         registration.  It can be used to inspect and manage that event.
         """
@@ -218,8 +644,9 @@ class EventSpace(object):
             if self._done:
                 raise Exception("We cannot register callbacks because this "
                                 "space has been stopped.")
-            ub = UserCallback(func, args, kwargs, delay, in_thread)
-            heapq.heappush(self._q, ub)
+            ub = UserCallback(func, args, kwargs, delay, in_thread,
+                              priority=priority)
+            self._timers.push(ub)
             self._cond.notify()
             return ub
         finally:
@@ -251,78 +678,114 @@ class EventSpace(object):
         self._cond.acquire()
         try:
             rc = ub._cancel()
+            if rc:
+                self._timers.remove(ub)
             self._cond.notify()
             return rc
         finally:
             self._cond.release()
 
-    def _run_threaded(self, ub):
-        this_thread = threading.currentThread()
+    def configure_workers(self, max_workers=None, max_queue=None):
+        """
+        Change the number of threads that run in_thread callbacks and how
+        many ready callbacks may wait for one of them.
+        """
+        self._pool.configure(max_workers=max_workers, max_queue=max_queue)
+
+    def get_worker_stats(self):
+        """
+        :return: A dict with the worker pool statistics.  The wait times
+        are the seconds threaded callbacks spent ready but waiting for a
+        free worker.
+        """
+        stats = self._pool.get_stats()
+        self._cond.acquire()
         try:
-            ub.call()
+            stats["deferred"] = len(self._deferred)
         finally:
-            self._cond.acquire()
-            try:
-                self._running_threads.remove(this_thread)
-                self._done_threads.append(this_thread)
-                self._cond.notifyAll()
-            finally:
-                self._cond.release()
+            self._cond.release()
+        return stats
+
+    def _threaded_done(self):
+        # a worker is free, wake up poll so that deferred callbacks are
+        # handed off and reset so that it can see the pool go idle
+        self._cond.acquire()
+        try:
+            self._cond.notifyAll()
+        finally:
+            self._cond.release()
+
+    def _submit_threaded(self, ub):
+        # This should only be called locked
+        if ub._queued_time is None:
+            ub._queued_time = time.monotonic()
+        if self._deferred or not self._pool.submit(ub):
+            self._deferred.append(ub)
 
     def _build_ready_list(self, now, end_time):
         # get everything that is ready right now while under lock.  It nothing
         # is ready a time to sleep is returned
-        ready_list = []
-        done = False
-        first_not_ready = None
-        while not done:
-            head_ub = heapq.nsmallest(1, self._q)
-            if head_ub:
-                if head_ub[0].is_ready(tm=now):
-                    ub = heapq.heappop(self._q)
-                    if ub.in_thread():
-                        _run_thread = threading.Thread(
-                            target=self._run_threaded,
-                            args=(ub,))
-                        self._running_threads.append(_run_thread)
-                        _run_thread.start()
-                    else:
-                        ready_list.append(ub)
-                else:
-                    first_not_ready = head_ub[0]
-                    done = True
+        while self._deferred and self._pool.submit(self._deferred[0]):
+            self._deferred.popleft()
+        for ub in self._timers.pop_ready(now):
+            if ub.in_thread():
+                self._submit_threaded(ub)
             else:
-                done = True
+                self._ready[ub._priority].append(ub)
+        ready_list = self._next_cycle(now)
         if ready_list:
             sleep_time = 0.0
         else:
-            if first_not_ready:
-                ready_time = min(end_time, head_ub[0].get_time_ready())
+            next_time = self._timers.next_time()
+            if next_time is not None:
+                ready_time = min(end_time, next_time)
             else:
                 ready_time = end_time
-            td = ready_time - now
-            sleep_time = max(0.0, td.total_seconds())
+            sleep_time = max(0.0, ready_time - now)
 
         return ready_list, sleep_time
 
-    def _clear_done_threads(self):
+    def _next_cycle(self, now):
+        # This should only be called locked.  Take up to cycle_size ready
+        # callbacks, each time from the class whose oldest callback has the
+        # best priority once aged by how long it has waited
+        cycle = []
+        while len(cycle) < self._cycle_size:
+            best = None
+            best_rank = None
+            for ready in self._ready:
+                if not ready:
+                    continue
+                ub = ready[0]
+                waited = now - ub._time_ready
+                rank = ub._priority - int(waited / self._priority_aging)
+                if best is None or rank < best_rank:
+                    best = ready
+                    best_rank = rank
+            if best is None:
+                break
+            cycle.append(best.popleft())
+        return cycle
+
+    def _cancel_ready(self):
         # This should only be called locked
-        for t in self._done_threads[:]:
-            t.join()
-            self._done_threads.remove(t)
+        for ready in self._ready:
+            for ub in ready:
+                ub._cancel()
+            ready.clear()
 
     def poll(self, timeblock=5.0):
         """
         Poll an event space to check for ready event callbacks.  If a event
         is scheduled it will be called directly from the current call stack
         (if this object was initialized with use_threads=False) or it will
-        be registered in a new thread.
+        be handed to the worker pool.
         :param timeblock: The amount of time to wait for events to be ready
         :return: A boolean is returned to indicate if an event was called
         or not
         """
-        now = datetime.datetime.now()
-        end_time = now + datetime.timedelta(seconds=timeblock)
+        now = time.monotonic()
+        end_time = now + timeblock
         done = False
         any_called = False
         while not done:
@@ -332,7 +795,9 @@ class EventSpace(object):
                 if self._done:
                     return any_called
 
-                self._clear_done_threads()
+                # the callbacks of the last cycle took time, so look again
+                # for what has come ready since
+                now = time.monotonic()
                 ready_to_unlock = False
                 while not ready_to_unlock and not done:
                     ready_list, sleep_time =\
@@ -347,18 +812,109 @@ class EventSpace(object):
                         ready_to_unlock = True
 
                     # check to see if time expired here to end all loops
-                    now = datetime.datetime.now()
+                    now = time.monotonic()
                     done = end_time < now
             finally:
                 self._cond.release()
 
             # call everything that was found ready.  We may want to kick
             # these out in threads in the event that they block
-            for ready_ub in ready_list:
+            if ready_list:
                 any_called = True
-                ready_ub.call()
+                self._run_cycle(ready_list)
         return any_called
 
+    def _run_cycle(self, ready_list):
+        ran = 0
+        cycle_time = 0.0
+        slowest = None
+        slowest_time = 0.0
+        max_lag = 0.0
+        for ub in ready_list:
+            start = time.monotonic()
+            lag = start - ub.get_time_ready()
+            ub.call()
+            if not ub.has_run():
+                # it was canceled before it got called
+                continue
+            call_time = time.monotonic() - start
+            ran += 1
+            cycle_time += call_time
+            max_lag = max(max_lag, lag)
+            if slowest is None or call_time > slowest_time:
+                slowest = ub
+                slowest_time = call_time
+        if ran == 0:
+            return
+
+        cycle = {"callbacks": ran,
+                 "callback_time": cycle_time,
+                 "slowest_callback": str(slowest),
+                 "slowest_callback_time": slowest_time,
+                 "max_lag": max_lag}
+        self._stats_lock.acquire()
+        try:
+            self._cycles += 1
+            self._callbacks_run += ran
+            self._callback_time += cycle_time
+            self._max_cycle_time = max(self._max_cycle_time, cycle_time)
+            if slowest_time > self._slowest_callback_time:
+                self._slowest_callback = cycle["slowest_callback"]
+                self._slowest_callback_time = slowest_time
+            self._max_lag = max(self._max_lag, max_lag)
+            self._last_cycle = cycle
+            observer = self._poll_observer
+        finally:
+            self._stats_lock.release()
+
+        if self._slow_cycle_warning is not None and \
+                (cycle_time > self._slow_cycle_warning or
+                 max_lag > self._slow_cycle_warning):
+            _g_logger.warning(
+                "The event loop ran %(callbacks)d callbacks in "
+                "%(callback_time).3f seconds.  The slowest was "
+                "%(slowest_callback)s at %(slowest_callback_time).3f seconds "
+                "and the latest ran %(max_lag).3f seconds after it was "
+                "due." % cycle)
+        if observer is not None:
+            try:
+                observer(cycle)
+            except Exception:
+                _g_logger.exception("The poll observer failed")
+
+    def set_poll_observer(self, observer):
+        """
+        :param observer: A function that is called from the polling thread
+        with a dict describing each poll cycle that ran callbacks.  The keys
+        are callbacks, callback_time, slowest_callback,
+        slowest_callback_time and max_lag.  Times are in seconds and the
+        lag is how long after its due time a callback started.  None
+        removes the observer.
+        """
+        self._stats_lock.acquire()
+        try:
+            self._poll_observer = observer
+        finally:
+            self._stats_lock.release()
+
+    def get_poll_stats(self):
+        """
+        :return: A dict with the totals over all poll cycles since this
+        space was made and the last cycle under last_cycle.
+        """
+        self._stats_lock.acquire()
+        try:
+            return {"cycles": self._cycles,
+                    "callbacks": self._callbacks_run,
+                    "callback_time": self._callback_time,
+                    "max_cycle_time": self._max_cycle_time,
+                    "slowest_callback": self._slowest_callback,
+                    "slowest_callback_time": self._slowest_callback_time,
+                    "max_lag": self._max_lag,
+                    "last_cycle": self._last_cycle}
+        finally:
+            self._stats_lock.release()
+
     def wakeup(self, cancel_all=False):
         """
         Wake up a call to poll even if no callbacks are ready
@@ -369,8 +925,14 @@ class EventSpace(object):
         self._cond.acquire()
         try:
             if cancel_all:
-                for ub in self._q:
+                for ub in self._timers.callbacks():
+                    if ub._cancel():
+                        self._timers.remove(ub)
+                self._cancel_ready()
+                for ub in self._deferred:
                     ub._cancel()
+                self._deferred.clear()
+                self._pool.cancel_queued()
             self._cond.notifyAll()
         finally:
             self._cond.release()
@@ -384,12 +946,26 @@ class EventSpace(object):
             self._done = True
             # canceling everything in the list will mark everything that is
             # not already effectively running to never run
-            for ub in self._q:
+            for ub in self._timers.callbacks():
+                ub._cancel()
+            self._timers.clear()
+            self._cancel_ready()
+            for ub in self._deferred:
                 ub._cancel()
-            self._q = []
-            while len(self._running_threads) > 0:
+            self._deferred.clear()
+            self._pool.cancel_queued()
+            # wait for the threaded callbacks that already started
+            while self._pool.busy_count() > 0:
                 self._cond.wait()
-            self._clear_done_threads()
+        finally:
+            self._cond.release()
+
+        # the workers take this lock when they finish a callback so they
+        # must be joined without it
+        self._pool.stop()
+
+        self._cond.acquire()
+        try:
             # now that everything is clear allow new registrations again
             self._done = False
         finally:
@@ -13,10 +13,60 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 #
+import dcm.agent.events.asyncio_callback as asyncio_callback
 import dcm.agent.events.callback as events
 import dcm.agent.events.pubsub as pubsub
+import dcm.agent.exceptions as exceptions
 
-global_space = events.EventSpace()
+
+_g_event_space_types = ["poll", "asyncio"]
+
+
+def _new_event_space(space_type):
+    # Everything on the main loop shares one thread so warn when its
+    # callbacks hold it for more than a second.
+    if space_type == "asyncio":
+        return asyncio_callback.AsyncioEventSpace(slow_cycle_warning=1.0)
+    # the agent has a retransmit timer for every message in flight and
+    # nearly all of them are canceled, which a timing wheel handles in
+    # constant time
+    return events.EventSpace(scheduler=events.TimingWheel(),
+                             slow_cycle_warning=1.0)
+
+
+class _GlobalEventSpace(object):
+    """
+    The event space shared by the whole agent.  Modules keep a reference
+    to this object from when they are imported, so use_event_space()
+    changes the space behind it instead of replacing it.
+    """
+
+    def __init__(self, space_type):
+        self.space_type = space_type
+        self.event_space = _new_event_space(space_type)
+
+    def __getattr__(self, name):
+        return getattr(self.event_space, name)
+
+
+def use_event_space(space_type):
+    """
+    Pick the implementation of the global event space, either poll or
+    asyncio.  This must be called before anything is registered in it
+    because the callbacks of the old space are canceled.
+    """
+    if space_type not in _g_event_space_types:
+        raise exceptions.AgentOptionValueException(
+            "[system]event_space", space_type,
+            ",".join(_g_event_space_types))
+    if space_type == global_space.space_type:
+        return
+    global_space.event_space.reset()
+    global_space.event_space = _new_event_space(space_type)
+    global_space.space_type = space_type
+
+
+global_space = _GlobalEventSpace("poll")
 global_pubsub = pubsub.PubSubEvent(global_space)
 
 
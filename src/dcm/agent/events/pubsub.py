@@ -16,31 +16,142 @@
 import logging
 import threading
 
+import dcm.agent.events.callback as callback
+
 
 _g_logger = logging.getLogger(__name__)
 
 
-def _deliver_topic(
-        subs=None, topic_args=None, topic_kwargs=None, done_cb=None,
-        done_kwargs=None):
-
-    # set the topic error to the first callback to fail and then stop
-    # calling them
-    topic_error = None
-    try:
-        for s in subs:
-            if topic_args is None:
-                topic_args = []
-            if topic_kwargs is None:
-                topic_kwargs = {}
-            s(*topic_args, **topic_kwargs)
-    except BaseException as ex:
-        topic_error = ex
-
-    if done_cb is not None:
+class DeliveryMode(object):
+    """
+    How a subscriber is called when its topic is published.
+
+    INLINE calls it from publish() in the publishing thread and is meant for
+    handlers that only record something.  EVENT_LOOP calls it later from
+    the event space poll loop.  EXECUTOR calls it from the event space
+    worker pool and is for handlers that block.
+    """
+    INLINE = "inline"
+    EVENT_LOOP = "event_loop"
+    EXECUTOR = "executor"
+
+
+# a topic that ends with this matches every topic that starts with the rest
+# of it
+WILDCARD = "*"
+
+_g_match_cache_size = 1024
+
+
+class TopicError(Exception):
+    """
+    The topic error given to the done callback when any subscriber failed.
+    errors holds a (subscriber, exception) pair for each of them.
+    """
+
+    def __init__(self, topic, errors):
+        self.topic = topic
+        self.errors = errors
+        message = ("%d subscribers of %s failed: %s"
+                   % (len(errors), topic,
+                      ", ".join("%s: %s" % (getattr(s, "__name__", s), ex)
+                                for s, ex in errors)))
+        super(TopicError, self).__init__(message)
+
+
+class TopicDelivery(object):
+    """
+    The handle returned by publish().  It gathers the return values and
+    exceptions of every subscriber and calls the done callback from the
+    event space once all of them have run.
+    """
+
+    def __init__(self, event_space, topic, pending, done_cb, done_kwargs,
+                 priority):
+        self.topic = topic
+        self.results = []
+        self.errors = []
+        self._event_space = event_space
+        self._pending = pending
+        self._done_cb = done_cb
+        self._done_kwargs = done_kwargs
+        self._priority = priority
+        self._lock = threading.Lock()
+        self._done_event = threading.Event()
+
+    def _call(self, sub, topic_args, topic_kwargs):
+        try:
+            rc = sub(*topic_args, **topic_kwargs)
+        except BaseException as ex:
+            _g_logger.debug("The subscriber %s of %s failed: %s"
+                            % (sub, self.topic, str(ex)))
+            rc = None
+            error = ex
+        else:
+            error = None
+        self._lock.acquire()
+        try:
+            if error is None:
+                self.results.append((sub, rc))
+            else:
+                self.errors.append((sub, error))
+        finally:
+            self._lock.release()
+
+    def _call_in_thread(self, sub, topic_args, topic_kwargs):
+        self._call(sub, topic_args, topic_kwargs)
+        self._count_down(1, False)
+
+    def _count_down(self, count, in_loop):
+        self._lock.acquire()
+        try:
+            self._pending -= count
+            finished = self._pending == 0
+        finally:
+            self._lock.release()
+        if finished:
+            self._finish(in_loop)
+
+    def get_error(self):
+        """
+        :return: None if every subscriber returned, otherwise a TopicError
+        """
+        self._lock.acquire()
+        try:
+            if not self.errors:
+                return None
+            return TopicError(self.topic, self.errors[:])
+        finally:
+            self._lock.release()
+
+    def _finish(self, in_loop):
+        self._done_event.set()
+        if self._done_cb is None:
+            return
+        done_kwargs = self._done_kwargs
         if done_kwargs is None:
             done_kwargs = {}
-        done_cb(topic_error, **done_kwargs)
+        # the done callback is always called from the event loop, whichever
+        # thread the last subscriber ran in
+        if in_loop:
+            self._done_cb(self.get_error(), **done_kwargs)
+        else:
+            self._event_space.register_callback(
+                self._done_cb, args=[self.get_error()], kwargs=done_kwargs,
+                priority=self._priority)
+
+    def is_done(self):
+        return self._done_event.is_set()
+
+    def wait(self, timeout=None):
+        return self._done_event.wait(timeout)
+
+
+def _deliver_topic(delivery=None, subs=None, topic_args=None,
+                   topic_kwargs=None):
+    for s in subs:
+        delivery._call(s, topic_args, topic_kwargs)
+    delivery._count_down(len(subs), True)
 
 
 class PubSubEvent(object):
@@ -49,49 +160,129 @@ class PubSubEvent(object):
         self._event_space = event_space
         self._done = False
         self._subscribers = {}
+        # wildcard subscriptions keyed by the prefix they match
+        self._prefix_subscribers = {}
+        # the subscriptions matching each published topic.  This is thrown
+        # away whenever a subscription changes
+        self._match_cache = {}
         self._lock = threading.RLock()
 
+    def _match(self, topic):
+        # This should only be called locked
+        try:
+            return self._match_cache[topic]
+        except KeyError:
+            pass
+        subs = list(self._subscribers.get(topic, []))
+        if self._prefix_subscribers:
+            for i in range(len(topic) + 1):
+                subs.extend(self._prefix_subscribers.get(topic[:i], []))
+        if len(self._match_cache) >= _g_match_cache_size:
+            self._match_cache.clear()
+        self._match_cache[topic] = subs
+        return subs
+
     def publish(self,
                 topic,
                 topic_args=None,
-                topic_kwargs=None, done_cb=None, done_kwargs=None):
+                topic_kwargs=None, done_cb=None, done_kwargs=None,
+                priority=callback.CallbackPriority.CONTROL):
+        """
+        Deliver a topic to every subscriber of it or of a wildcard that
+        matches it.  Each subscriber is called in its delivery mode and
+        all of them are called even if some fail.  done_cb is called from
+        the event loop when they have all run, with None or a TopicError as
+        its first argument and done_kwargs as its keyword arguments.
+        :return: A TopicDelivery holding the results.
+        """
+        if topic_args is None:
+            topic_args = []
+        if topic_kwargs is None:
+            topic_kwargs = {}
+
         self._lock.acquire()
         try:
-            try:
-                subs = self._subscribers[topic][:]
-            except KeyError:
-                subs = []  # set this to empty to trip the done_cb
-
-            ka = {'topic_args': topic_args,
-                  'topic_kwargs': topic_kwargs,
-                  'subs': subs,
-                  'done_cb': done_cb,
-                  'done_kwargs': done_kwargs}
-            self._event_space.register_callback(_deliver_topic, kwargs=ka)
+            subs = self._match(topic)
+            inline = []
+            event_loop = []
+            executor = []
+            for cb, mode in subs:
+                if mode == DeliveryMode.INLINE:
+                    inline.append(cb)
+                elif mode == DeliveryMode.EXECUTOR:
+                    executor.append(cb)
+                else:
+                    event_loop.append(cb)
+            # one count is held by this call so that the delivery is not
+            # finished before the inline subscribers have run
+            delivery = TopicDelivery(
+                self._event_space, topic, len(subs) + 1, done_cb,
+                done_kwargs, priority)
+
+            for cb in executor:
+                self._event_space.register_callback(
+                    delivery._call_in_thread,
+                    args=[cb, topic_args, topic_kwargs],
+                    in_thread=True, priority=priority)
+            if event_loop:
+                ka = {'delivery': delivery,
+                      'subs': event_loop,
+                      'topic_args': topic_args,
+                      'topic_kwargs': topic_kwargs}
+                self._event_space.register_callback(
+                    _deliver_topic, kwargs=ka, priority=priority)
         finally:
             self._lock.release()
 
-    def subscribe(self, topic, cb):
+        for cb in inline:
+            delivery._call(cb, topic_args, topic_kwargs)
+        delivery._count_down(len(inline) + 1, False)
+        return delivery
+
+    def subscribe(self, topic, cb, mode=DeliveryMode.EVENT_LOOP):
+        """
+        :param topic: The topic to subscribe to.  A topic that ends with
+        WILDCARD matches every topic starting with the text before it.
+        :param cb: The function called with the topic arguments.
+        :param mode: One of the DeliveryMode values.
+        """
+        if topic.endswith(WILDCARD):
+            index = self._prefix_subscribers
+            topic = topic[:-len(WILDCARD)]
+        else:
+            index = self._subscribers
         self._lock.acquire()
         try:
             try:
-                subs = self._subscribers[topic]
+                subs = index[topic]
             except KeyError:
                 subs = []
-                self._subscribers[topic] = subs
-            subs.append(cb)
+                index[topic] = subs
+            subs.append((cb, mode))
+            self._match_cache.clear()
         finally:
             self._lock.release()
 
     def unsubscribe(self, topic, cb):
+        if topic.endswith(WILDCARD):
+            index = self._prefix_subscribers
+            topic = topic[:-len(WILDCARD)]
+        else:
+            index = self._subscribers
         self._lock.acquire()
         try:
             try:
-                subs = self._subscribers[topic]
+                subs = index[topic]
             except KeyError:
                 raise
-            subs.remove(cb)
+            for sub in subs:
+                if sub[0] == cb:
+                    subs.remove(sub)
+                    break
+            else:
+                raise ValueError("%s is not subscribed to %s" % (cb, topic))
             if not subs:
-                del self._subscribers[topic]
+                del index[topic]
+            self._match_cache.clear()
         finally:
             self._lock.release()
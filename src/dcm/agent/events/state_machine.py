@@ -13,6 +13,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 #
+import collections
 import logging
 import os
 import sys
@@ -25,20 +26,30 @@ _g_logger = logging.getLogger(__name__)
 
 class StateMachine(object):
 
-    def __init__(self, start_state, logger=None):
+    def __init__(self, start_state, logger=None, history_size=64):
+        """
+        :param start_state: The state the machine starts in.
+        :param logger: The logger that transitions are logged to.
+        :param history_size: The number of the most recent transitions kept
+        for get_event_list().  The oldest are dropped so that machines that
+        live as long as the agent do not grow.
+        """
+        # one dict per state mapping each event to (new_state, func)
         self._state_map = {}
         self._current_state = start_state
+        self._current_map = self._state_map.setdefault(start_state, {})
         self._user_callbacks_list = []
-        self._event_list = []
+        self._event_list = collections.deque(maxlen=history_size)
         if logger is None:
             self._logger = _g_logger
         else:
             self._logger = logger
 
     def add_transition(self, state_event, event, new_state, func):
-        if state_event not in self._state_map:
-            self._state_map[state_event] = {}
-        self._state_map[state_event][event] = (new_state, func)
+        # the dict of the current state is shared with _current_map so
+        # transitions can be added at any time
+        self._state_map.setdefault(state_event, {})[event] = (new_state, func)
+        self._state_map.setdefault(new_state, {})
 
     def mapping_to_digraph(self, outf=None):
         if outf is None:
@@ -56,32 +67,39 @@ class StateMachine(object):
         outf.flush()
 
     def event_occurred(self, event, **kwargs):
+        old_state = self._current_state
         try:
-            old_state = self._current_state
-            new_state, func = self._state_map[self._current_state][event]
-            # a logging adapter is added so that me can configure more of the
-            # log line in a conf file
-            log_msg = ("Event %(event)s occurred.  Moving from state "
-                       "%(old_state)s to %(new_state)s") % locals()
-            self._logger.debug(log_msg)
-            self._event_list.append((event, old_state, new_state))
-            try:
-                if func is not None:
-                    self._logger.debug("Calling %s | %s" % (func.__name__,
-                                                            func.__doc__))
-                    func(**kwargs)
-                self._current_state = new_state
-                self._logger.debug("Moved to new state %s." % new_state)
-            except exceptions.DoNotChangeStateException as dncse:
-                self._logger.warning("An error occurred that permits us "
-                                     "to continue but skip the state "
-                                     "change. %s" % str(dncse))
-            except Exception as ex:
-                self._logger.exception("An exception occurred %s")
-                raise
-        except KeyError as keyEx:
+            new_state, func = self._current_map[event]
+        except KeyError:
             raise exceptions.IllegalStateTransitionException(
-                event, self._current_state)
+                event, old_state)
+
+        debug = self._logger.isEnabledFor(logging.DEBUG)
+        if debug:
+            self._logger.debug("Event %s occurred.  Moving from state %s "
+                               "to %s", event, old_state, new_state)
+        self._event_list.append((event, old_state, new_state))
+        try:
+            if func is not None:
+                if debug:
+                    self._logger.debug("Calling %s | %s",
+                                       func.__name__, func.__doc__)
+                func(**kwargs)
+            self._current_state = new_state
+            self._current_map = self._state_map[new_state]
+            if debug:
+                self._logger.debug("Moved to new state %s.", new_state)
+        except exceptions.DoNotChangeStateException as dncse:
+            self._logger.warning("An error occurred that permits us "
+                                 "to continue but skip the state "
+                                 "change. %s" % str(dncse))
+        except Exception as ex:
+            self._logger.exception("An exception occurred %s")
+            raise
 
     def get_event_list(self):
-        return self._event_list
+        """
+        :return: A list of the most recent (event, old_state, new_state)
+        transitions, oldest first.
+        """
+        return list(self._event_list)
@@ -13,22 +13,35 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 #
+import collections
+import copy
 import functools
 import glob
 import logging
 from logging.handlers import RotatingFileHandler
 import os
+import queue
+import threading
 import urllib.parse
 import urllib.error
 import urllib.request
 import pwd
 import grp
+import time
+import weakref
+
+import dcm.agent.events.callback as callback
 
 from dcm.agent.events.globals import global_space as dcm_events
 
 
+_g_max_log_message_size = 10*1024
+# the logger that log_to_dcm_console() messages go through
+_g_console_logger_name = "dcm.agent.log.to.agent.manager"
+
+
 def send_log_to_dcm_callback(conn=None, token=None, message=None, level=None):
-    max_size = 10*1024
+    max_size = _g_max_log_message_size
     if len(message) > max_size:
         message = message[:max_size]
     message = urllib.parse.quote(message)
@@ -41,35 +54,225 @@ def send_log_to_dcm_callback(conn=None, token=None, message=None, level=None):
     conn.send(msg)
 
 
-class dcmLogger(logging.Handler):
+def send_logs_to_dcm_callback(conn=None, token=None, records=None):
+    """
+    Send a batch of (level, message, count) records in one LOG message.
+    A batch of one record is sent just as send_log_to_dcm_callback() does.
+    Otherwise level and message are those of the most severe record and
+    the text of all of them, one per line, so that a reader that only knows
+    single record LOG messages still gets everything, and the added records
+    list has each of them on its own.
+    """
+    if len(records) == 1:
+        level, message, count = records[0]
+        if count > 1:
+            message = "%s (repeated %d times)" % (message, count)
+        send_log_to_dcm_callback(
+            conn=conn, token=token, message=message, level=level)
+        return
+    max_size = _g_max_log_message_size
+    lines = []
+    doc_records = []
+    top_level = None
+    for level, message, count in records:
+        if len(message) > max_size:
+            message = message[:max_size]
+        if count > 1:
+            lines.append("%s (repeated %d times)" % (message, count))
+        else:
+            lines.append(message)
+        doc_records.append({"level": level,
+                            "message": urllib.parse.quote(message),
+                            "count": count})
+        if top_level is None or \
+                logging.getLevelName(level) > logging.getLevelName(top_level):
+            top_level = level
+    msg = {
+        "type": "LOG",
+        "token": token,
+        "level": top_level,
+        "message": urllib.parse.quote("\n".join(lines)),
+        "records": doc_records
+    }
+    conn.send(msg)
+
 
-    def __init__(self, encoding=None):
+class dcmLogger(logging.Handler):
+    """
+    Ship log records to the agent manager in batches.  Records wait in a
+    ring buffer of at most max_records entries and are sent as one LOG
+    message when batch_size of them are waiting or flush_interval seconds
+    after the first of them came in.  A record with the same level, logger
+    and message as one already waiting only adds to its count.
+    rate_limits maps a level name to the most new records per second that
+    level may add.  Records that are rate limited or pushed out of a full
+    buffer are counted and the counts are reported with the next batch.
+    The log_to_dcm_console() messages are meant for the user so they are
+    never rate limited or coalesced.
+    """
+
+    def __init__(self, encoding=None, max_records=1000, batch_size=100,
+                 flush_interval=0.5, rate_limits=None):
         super(dcmLogger, self).__init__()
         self._conn = None
         self._conf = None
-        self._unsent_msgs = []
+        self._max_records = max_records
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        if rate_limits is None:
+            rate_limits = {"DEBUG": 50, "INFO": 100}
+        self._rate_limits = rate_limits
+        # level name -> [tokens, time of the last refill]
+        self._rate_buckets = {}
+        # (level, logger, message) -> [level, formatted message, count]
+        self._buffer = collections.OrderedDict()
+        self._flush_timer = None
+        self._flush_now = False
+        self._sent_records = 0
+        self._sent_messages = 0
+        self._coalesced = 0
+        self._dropped_overflow = 0
+        self._dropped_rate = {}
+        self._unreported_drops = 0
+        self._console_count = 0
+
+    def _rate_limited(self, level):
+        # This should only be called locked
+        try:
+            rate = self._rate_limits[level]
+        except KeyError:
+            return False
+        now = time.monotonic()
+        try:
+            bucket = self._rate_buckets[level]
+        except KeyError:
+            bucket = [rate, now]
+            self._rate_buckets[level] = bucket
+        bucket[0] = min(rate, bucket[0] + (now - bucket[1]) * rate)
+        bucket[1] = now
+        if bucket[0] < 1.0:
+            return True
+        bucket[0] -= 1.0
+        return False
 
     def emit(self, record):
-        msg = self.format(record)
+        console = record.name == _g_console_logger_name
+        self.acquire()
+        try:
+            if console:
+                # a key of its own so it is never coalesced
+                self._console_count += 1
+                key = (record.levelname, record.name, self._console_count)
+            else:
+                key = (record.levelname, record.name, record.getMessage())
+                entry = self._buffer.get(key)
+                if entry is not None:
+                    entry[2] += 1
+                    self._coalesced += 1
+                    return
+            if not console and self._rate_limited(record.levelname):
+                self._dropped_rate[record.levelname] = \
+                    self._dropped_rate.get(record.levelname, 0) + 1
+                self._unreported_drops += 1
+                return
+            if len(self._buffer) >= self._max_records:
+                self._buffer.popitem(last=False)
+                self._dropped_overflow += 1
+                self._unreported_drops += 1
+            self._buffer[key] = [record.levelname, self.format(record), 1]
+            self._schedule_flush(len(self._buffer) >= self._batch_size)
+        finally:
+            self.release()
+
+    def _schedule_flush(self, now):
+        # This should only be called locked
         if self._conn is None:
-            self._unsent_msgs.append(msg)
+            return
+        if self._flush_timer is not None:
+            if not now or self._flush_now:
+                return
+            if not dcm_events.cancel_callback(self._flush_timer):
+                return
+        self._flush_now = now
+        if now:
+            delay = 0
         else:
-            dcm_events.register_callback(
-                send_log_to_dcm_callback, kwargs={"conn": self._conn,
-                                                  "token": "",
-                                                  "message": msg,
-                                                  "level": record.levelname})
+            delay = self._flush_interval
+        self._flush_timer = dcm_events.register_callback(
+            self._flush_callback, delay=delay,
+            priority=callback.CallbackPriority.TELEMETRY)
+
+    def _take_batch(self):
+        # This should only be called locked
+        records = []
+        while self._buffer and len(records) < self._batch_size:
+            _, entry = self._buffer.popitem(last=False)
+            records.append(tuple(entry))
+        if self._unreported_drops:
+            records.append(
+                ("WARNING",
+                 "%d log records were dropped by the agent"
+                 % self._unreported_drops, 1))
+            self._unreported_drops = 0
+        return records
+
+    def _flush_callback(self):
+        self.acquire()
+        try:
+            self._flush_timer = None
+            self._flush_now = False
+        finally:
+            self.release()
+        # records that come in while a batch is sent go out in the next one
+        while True:
+            self.acquire()
+            try:
+                conn = self._conn
+                if conn is None:
+                    return
+                records = self._take_batch()
+                if not records:
+                    return
+                self._sent_records += len(records)
+                self._sent_messages += 1
+            finally:
+                self.release()
+            send_logs_to_dcm_callback(conn=conn, token="", records=records)
+
+    def flush(self):
+        self.acquire()
+        try:
+            if self._buffer or self._unreported_drops:
+                self._schedule_flush(True)
+        finally:
+            self.release()
+
+    def get_stats(self):
+        self.acquire()
+        try:
+            return {"buffered": len(self._buffer),
+                    "sent_records": self._sent_records,
+                    "sent_messages": self._sent_messages,
+                    "coalesced": self._coalesced,
+                    "dropped_overflow": self._dropped_overflow,
+                    "dropped_rate_limited": dict(self._dropped_rate)}
+        finally:
+            self.release()
 
     def set_conn(self, conf, conn):
-        self._conn = conn
-        self._conf = conf
-        if conn is None:
-            return
-        for msg in self._unsent_msgs:
-            dcm_events.register_callback(
-                send_log_to_dcm_callback, kwargs={"conn": self._conn,
-                                                  "message": msg})
-            self._unsent_msgs = []
+        self.acquire()
+        try:
+            self._conn = conn
+            self._conf = conf
+            if conn is None:
+                if self._flush_timer is not None:
+                    dcm_events.cancel_callback(self._flush_timer)
+                    self._flush_timer = None
+                return
+            if self._buffer:
+                self._schedule_flush(True)
+        finally:
+            self.release()
 
 
 def set_dcm_connection(conf, conn):
@@ -91,6 +294,16 @@ def clear_dcm_logging():
                     h.set_conn(None, None)
 
 
+def flush_logs():
+    # wait for the queued file handlers to write what they hold
+    for key in logging.Logger.manager.loggerDict:
+        logger = logging.Logger.manager.loggerDict[key]
+        if type(logger) == logging.Logger:
+            for h in logger.handlers:
+                if isinstance(h, DCMAgentLogger):
+                    h.flush()
+
+
 def delete_logs():
     # effectively just for tests
     for key in logging.Logger.manager.loggerDict:
@@ -101,17 +314,259 @@ def delete_logs():
                     h.clear_logs()
 
 
+class _LogWriter(threading.Thread):
+    """
+    The thread that does the file writes and rotations of every queued
+    DCMAgentLogger in the process.  Records that do not fit in a full queue
+    are dropped and a warning with their count is written to the file of
+    the handler that dropped them, at most once every
+    _g_log_drop_report_interval seconds and when the thread stops.
+    """
+
+    def __init__(self, queue_size):
+        super(_LogWriter, self).__init__(name="LogWriter")
+        # logging.shutdown() flushes the handlers when the process exits
+        # so this thread must not be what keeps the process alive
+        self.daemon = True
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.pid = os.getpid()
+        self.dropped = 0
+        self._drop_lock = threading.Lock()
+        self._unreported_drops = 0
+        self._drop_handler = None
+        self._last_drop_report = None
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    self._report_drops(True)
+                    return
+                handler, record = item
+                handler._write(record)
+                self._report_drops(False)
+            finally:
+                self.queue.task_done()
+
+    def _report_drops(self, force):
+        now = time.monotonic()
+        self._drop_lock.acquire()
+        try:
+            if not self._unreported_drops:
+                return
+            if not force and self._last_drop_report is not None and \
+                    now - self._last_drop_report < \
+                    _g_log_drop_report_interval:
+                return
+            count = self._unreported_drops
+            handler = self._drop_handler
+            self._unreported_drops = 0
+            self._drop_handler = None
+            self._last_drop_report = now
+        finally:
+            self._drop_lock.release()
+        # written straight to the file, logging it would only queue it
+        # behind the records that filled the queue
+        record = logging.LogRecord(
+            __name__, logging.WARNING, __file__, 0,
+            "%d log records were dropped because the log writer queue "
+            "was full" % count, None, None)
+        handler._write(record)
+
+    def put(self, handler, record):
+        try:
+            self.queue.put_nowait((handler, record))
+        except queue.Full:
+            # never block the caller on a slow disk
+            self._drop_lock.acquire()
+            try:
+                self.dropped += 1
+                self._unreported_drops += 1
+                self._drop_handler = handler
+            finally:
+                self._drop_lock.release()
+
+    def drain(self, timeout):
+        """
+        Wait for everything queued so far to be written.
+        :return: False if that took more than timeout seconds.
+        """
+        end_time = time.monotonic() + timeout
+        self.queue.all_tasks_done.acquire()
+        try:
+            while self.queue.unfinished_tasks:
+                remaining = end_time - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self.queue.all_tasks_done.wait(remaining)
+            return True
+        finally:
+            self.queue.all_tasks_done.release()
+
+    def stop(self):
+        self.queue.put(None)
+        self.join()
+
+
+_g_log_writer = None
+_g_log_writer_stopped = False
+_g_log_writer_lock = threading.Lock()
+_g_log_queue_size = 10000
+_g_log_flush_timeout = 5.0
+_g_log_drop_report_interval = 10.0
+# every DCMAgentLogger, so that their locks can be made new after a fork
+_g_file_handlers = weakref.WeakSet()
+
+
+def _get_log_writer():
+    global _g_log_writer
+
+    writer = _g_log_writer
+    if writer is not None or _g_log_writer_stopped:
+        return writer
+    _g_log_writer_lock.acquire()
+    try:
+        if _g_log_writer is None and not _g_log_writer_stopped:
+            _g_log_writer = _LogWriter(_g_log_queue_size)
+            _g_log_writer.start()
+        return _g_log_writer
+    finally:
+        _g_log_writer_lock.release()
+
+
+def stop_log_writer():
+    """
+    Write out everything that the queued file handlers are holding and
+    stop their thread.  Records logged after this are written by the
+    logging thread itself.
+    """
+    global _g_log_writer
+    global _g_log_writer_stopped
+
+    _g_log_writer_lock.acquire()
+    try:
+        writer = _g_log_writer
+        _g_log_writer = None
+        _g_log_writer_stopped = True
+    finally:
+        _g_log_writer_lock.release()
+    if writer is not None and writer.pid == os.getpid():
+        writer.stop()
+
+
+def start_log_writer():
+    """
+    Let the queued file handlers use a writer thread again after
+    stop_log_writer().  The thread is started by the next record.
+    """
+    global _g_log_writer_stopped
+
+    _g_log_writer_lock.acquire()
+    try:
+        _g_log_writer_stopped = False
+    finally:
+        _g_log_writer_lock.release()
+
+
+def _after_fork_in_child():
+    # the child has no writer thread, and any of these locks may have been
+    # held by a thread that does not exist in the child.  logging does the
+    # same for the handler locks
+    global _g_log_writer
+    global _g_log_writer_stopped
+    global _g_log_writer_lock
+
+    _g_log_writer_lock = threading.Lock()
+    _g_log_writer = None
+    _g_log_writer_stopped = True
+    for handler in list(_g_file_handlers):
+        handler._write_lock = threading.RLock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
 class DCMAgentLogger(RotatingFileHandler):
+    """
+    A rotating log file owned by the agent user.  When queued is set the
+    records are handed to a background thread that writes and rotates the
+    file so the logging thread never waits on the disk.
+    """
 
     def __init__(self, filename, owner=None, mode='a', maxBytes=0,
-                 backupCount=0, encoding=None, delay=False):
+                 backupCount=0, encoding=None, delay=False, queued=False):
         self._uid = pwd.getpwnam(owner).pw_uid
         self._gid = grp.getgrnam(owner).gr_gid
         super(DCMAgentLogger, self).__init__(
             filename, mode=mode, maxBytes=maxBytes, backupCount=backupCount,
             encoding=encoding, delay=delay)
+        self._queued = queued
+        # in queued mode only the writer thread touches the stream and it
+        # takes this lock instead of the handler lock.  logging.shutdown()
+        # holds the handler lock while it flushes
+        self._write_lock = threading.RLock()
+        _g_file_handlers.add(self)
         self.log_perms()
 
+    def _writer(self):
+        if not self._queued:
+            return None
+        writer = _get_log_writer()
+        if writer is None or writer.pid != os.getpid():
+            # a forked child does not have the writer thread
+            return None
+        return writer
+
+    def emit(self, record):
+        writer = self._writer()
+        if writer is None:
+            super(DCMAgentLogger, self).emit(record)
+            return
+        try:
+            # the record is formatted in the writer thread so take
+            # everything out of it that may change before then
+            record = copy.copy(record)
+            record.msg = record.getMessage()
+            record.args = None
+            if record.exc_info:
+                if not record.exc_text:
+                    record.exc_text = logging.Formatter().formatException(
+                        record.exc_info)
+                record.exc_info = None
+        except Exception:
+            self.handleError(record)
+            return
+        writer.put(self, record)
+
+    def _write(self, record):
+        # called from the writer thread
+        self._write_lock.acquire()
+        try:
+            super(DCMAgentLogger, self).emit(record)
+        finally:
+            self._write_lock.release()
+
+    def flush(self):
+        writer = self._writer()
+        if writer is not None and \
+                threading.currentThread() is not writer:
+            writer.drain(_g_log_flush_timeout)
+        self._write_lock.acquire()
+        try:
+            super(DCMAgentLogger, self).flush()
+        finally:
+            self._write_lock.release()
+
+    def close(self):
+        self.flush()
+        self._write_lock.acquire()
+        try:
+            super(DCMAgentLogger, self).close()
+        finally:
+            self._write_lock.release()
+
     def _open(self):
         s = super(DCMAgentLogger, self)._open()
         self.log_perms()
@@ -125,14 +580,19 @@ class DCMAgentLogger(RotatingFileHandler):
                 logging.exception("We could not set the log file ownership.")
 
     def clear_logs(self):
-        with open(self.baseFilename, "w"):
-            pass
+        self.flush()
+        self._write_lock.acquire()
+        try:
+            with open(self.baseFilename, "w"):
+                pass
 
-        for l in glob.glob("%s.*" % self.baseFilename):
-            try:
-                os.remove(l)
-            except:
-                logging.exception("Failed to remove a rotated file.")
+            for l in glob.glob("%s.*" % self.baseFilename):
+                try:
+                    os.remove(l)
+                except:
+                    logging.exception("Failed to remove a rotated file.")
+        finally:
+            self._write_lock.release()
 
 
 # Events to log to DCM
@@ -144,7 +604,7 @@ def log_to_dcm_console(level, base_message, msg=None, **kwargs):
     if msg:
         out_message = out_message + " : " + msg
 
-    l_logger = logging.getLogger("dcm.agent.log.to.agent.manager")
+    l_logger = logging.getLogger(_g_console_logger_name)
     l_logger.log(level, out_message)
 
 
@@ -202,6 +662,12 @@ log_to_dcm_console_unknown_job_parameter = functools.partial(
     "The job %(job_name)s received the unknown parameter %(parameter_name)s.  The parameter will be ignored.")
 
 
+log_to_dcm_console_plugins_load_failed = functools.partial(
+    log_to_dcm_console,
+    logging.ERROR,
+    "The plugins %(plugin_names)s could not be loaded.")
+
+
 log_to_dcm_console_successful_reconnect = functools.partial(
     log_to_dcm_console,
     logging.INFO,
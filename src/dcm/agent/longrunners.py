@@ -22,6 +22,8 @@ import urllib.parse
 import urllib.error
 import urllib.request
 
+import dcm.agent.events.callback as callback
+import dcm.agent.plugin_pool as plugin_pool
 import dcm.agent.plugins.loader as plugin_loader
 
 from dcm.agent.events.globals import global_space as dcm_events
@@ -91,18 +93,26 @@ class JobRunner(threading.Thread):
 
                     job_reply = JobReply(work.job_id)
                     dcm_events.register_callback(
-                        self._job_update_callback, args=[job_reply])
-
-                    plugin = plugin_loader.load_python_module(
-                        work.items_map["module_name"],
-                        self._conf,
-                        work.request_id,
-                        work.items_map,
-                        work.name,
-                        work.arguments)
-
-                    reply_obj = plugin.run()
-                    job_reply.reply_doc = reply_obj.get_reply_doc()
+                        self._job_update_callback, args=[job_reply],
+                        priority=callback.CallbackPriority.WORK_COMPLETE)
+
+                    if plugin_pool.use_process(self._conf, work.items_map):
+                        job_reply.reply_doc = self._conf.plugin_pool.run(
+                            work.request_id,
+                            work.items_map,
+                            work.name,
+                            work.arguments)
+                    else:
+                        plugin = plugin_loader.load_python_module(
+                            work.items_map["module_name"],
+                            self._conf,
+                            work.request_id,
+                            work.items_map,
+                            work.name,
+                            work.arguments)
+
+                        reply_obj = plugin.run()
+                        job_reply.reply_doc = reply_obj.get_reply_doc()
                 except Exception as ex:
                     _g_logger.exception("An error occurred")
                     job_reply.error = str(ex)
@@ -118,7 +128,8 @@ class JobRunner(threading.Thread):
                 finally:
                     job_reply.end_date = calendar.timegm(time.gmtime())
                     dcm_events.register_callback(
-                        self._job_update_callback, args=[job_reply])
+                        self._job_update_callback, args=[job_reply],
+                        priority=callback.CallbackPriority.WORK_COMPLETE)
                     _g_logger.debug("Completed the long job %s:%s "
                                     "STATUS=%s" % (work.name, work.request_id,
                                                    job_reply.job_status))
@@ -185,9 +196,10 @@ class LongRunner(object):
     def job_complete(self, job_id):
         if self._conf.jobs_retain_job_time == 0:
             return
-        dcm_events.register_callback(self._job_cleanup,
-                                     args=[job_id],
-                                     delay=self._conf.jobs_retain_job_time)
+        dcm_events.register_callback(
+            self._job_cleanup, args=[job_id],
+            delay=self._conf.jobs_retain_job_time,
+            priority=callback.CallbackPriority.TELEMETRY)
 
     def _job_cleanup(self, job_id):
         with self._lock:
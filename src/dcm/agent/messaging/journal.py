@@ -0,0 +1,589 @@
+#
+#  Copyright (C) 2014 Dell, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+An agent database kept in memory and made durable with an append only
+journal.  Every change is written to the end of the journal as one line
+of JSON before it is applied to the in memory tables, so the only disk
+write for a change is a small sequential append.
+
+Once the journal has more entries than there are live records the whole
+state is written to a snapshot file and the journal is started over.  A
+new snapshot is renamed into place before the journal is replaced and
+both carry a generation number, so a crash at any point leaves either
+the old snapshot with the old journal or the new snapshot with a journal
+that can be ignored.  A torn entry at the end of the journal, left by a
+crash in the middle of a write, is dropped when the journal is loaded.
+"""
+import collections
+import datetime
+import json
+import logging
+import os
+import threading
+
+import dcm.agent.exceptions as exceptions
+import dcm.agent.messaging.persistence as persistence
+import dcm.agent.messaging.states as messaging_states
+
+
+_g_logger = logging.getLogger(__name__)
+
+# the positions in a request row.  they are the same as the columns
+# returned by the SQLite backend so SQLiteRequestObject can be reused
+_REQUEST_ID = 0
+_REQUEST_DOC = 2
+_REPLY_DOC = 3
+_STATE = 4
+_AGENT_ID = 5
+_LAST_UPDATE_TIME = 6
+
+# a rough count of the bytes a request takes besides its documents
+_g_row_overhead = 128
+
+
+class JournalOps(object):
+    GENERATION = "gen"
+    NEW = "new"
+    UPDATE = "upd"
+    LOST = "lost"
+    DELETE = "del"
+    USER = "user"
+    ALERTS = "alerts"
+    DELETE_ALERTS = "adel"
+    COUNTER = "ctr"
+
+
+def _now():
+    # dates are kept as the text SQLite would have stored for them
+    return str(datetime.datetime.now())
+
+
+def _doc_size(doc):
+    if doc is None:
+        return 0
+    return len(doc)
+
+
+def _locked(func):
+    def wrapper(self, *args, **kwargs):
+        self.lock()
+        try:
+            return func(self, *args, **kwargs)
+        finally:
+            self.unlock()
+    return wrapper
+
+
+class JournalAgentDB(object):
+    """
+    The tables are held in memory so everything in a process that uses the
+    journal must share one of these objects (see AgentConfig.get_db).
+    """
+
+    def __init__(self, db_file, sync=False, compact_ops=10000,
+                 read_only=False):
+        """
+        :param db_file: The path to the journal.  The snapshot is kept next
+        to it with a .snap suffix.  ":memory:" keeps nothing on disk.
+        :param sync: When True every journal write is flushed to the disk
+        with fsync before the call returns.  Otherwise it is only handed to
+        the OS which survives the agent crashing but not the host.
+        :param compact_ops: The journal is not compacted until it has at
+        least this many entries.
+        :param read_only: Load the tables but never write to the files.
+        This is used to look at the database of a running agent.
+        """
+        self._db_file = db_file
+        self._snap_file = db_file + ".snap"
+        self._sync = sync
+        self._compact_ops = compact_ops
+        self.read_only = read_only
+        self._lock = threading.RLock()
+        self._in_memory = db_file == ":memory:"
+
+        self._requests = collections.OrderedDict()
+        self._by_state = {}
+        self._users = collections.OrderedDict()
+        self._alerts = {}
+        self._alert_high_water = 0
+        self._counters = {}
+        self._live_bytes = 0
+
+        self._generation = 0
+        self._journal_ops = 0
+        self._fptr = None
+        if not self._in_memory:
+            self._load()
+
+    # the lock is public so that callers can group calls the same way they
+    # can with SQLiteAgentDB
+    def lock(self):
+        self._lock.acquire()
+
+    def unlock(self):
+        self._lock.release()
+
+    @_locked
+    def close(self):
+        if self._fptr is not None:
+            self._fptr.close()
+            self._fptr = None
+
+    def _load(self):
+        if os.path.exists(self._snap_file):
+            with open(self._snap_file, "r") as fptr:
+                self._restore_snapshot(json.load(fptr))
+
+        good_size, journal_generation = self._replay_journal()
+        if self.read_only:
+            return
+        if journal_generation is None or \
+                journal_generation < self._generation:
+            # there is no journal or it is from before the snapshot
+            self._start_journal()
+            return
+        if good_size != os.path.getsize(self._db_file):
+            _g_logger.warning(
+                "Dropping %d bytes from the end of the journal %s that "
+                "could not be read"
+                % (os.path.getsize(self._db_file) - good_size,
+                   self._db_file))
+            with open(self._db_file, "r+b") as fptr:
+                fptr.truncate(good_size)
+        self._fptr = open(self._db_file, "ab")
+
+    def _replay_journal(self):
+        """
+        Apply the entries in the journal that belong to the loaded
+        snapshot.
+
+        :return: A tuple of the number of bytes that were read cleanly and
+        the generation of the journal, None if it has no header.
+        """
+        if not os.path.exists(self._db_file):
+            return 0, None
+        good_size = 0
+        generation = None
+        with open(self._db_file, "rb") as fptr:
+            for line in fptr:
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    op = json.loads(line.decode())
+                except ValueError:
+                    break
+                if generation is None:
+                    if not isinstance(op, dict) or \
+                            op.get("o") != JournalOps.GENERATION:
+                        raise exceptions.PersistenceException(
+                            "%s is not an agent journal" % self._db_file)
+                    generation = op["g"]
+                    if generation < self._generation:
+                        return good_size, generation
+                else:
+                    self._apply(op)
+                    self._journal_ops += 1
+                good_size += len(line)
+        if good_size == 0 and os.path.getsize(self._db_file) > 0:
+            raise exceptions.PersistenceException(
+                "%s is not an agent journal" % self._db_file)
+        return good_size, generation
+
+    def _restore_snapshot(self, snap):
+        self._generation = snap["generation"]
+        for row in snap["requests"]:
+            self._add_request(row)
+        for row in snap["users"]:
+            self._users[(row[0], row[1])] = row
+        for alert in snap["alerts"]:
+            self._alerts[alert[2]] = alert
+        self._counters = snap["counters"]
+        self._alert_high_water = snap["alert_high_water"]
+
+    def _write_file(self, path, lines):
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as fptr:
+            for line in lines:
+                fptr.write(line)
+            fptr.flush()
+            os.fsync(fptr.fileno())
+        os.rename(tmp_path, path)
+
+    def _start_journal(self):
+        if self._fptr is not None:
+            self._fptr.close()
+        header = {"o": JournalOps.GENERATION, "g": self._generation}
+        self._write_file(self._db_file,
+                         [(json.dumps(header) + "\n").encode()])
+        self._journal_ops = 0
+        self._fptr = open(self._db_file, "ab")
+
+    def compact(self):
+        """
+        Write the current tables to a new snapshot and start the journal
+        over.
+        """
+        if self._in_memory or self.read_only:
+            return
+        self.lock()
+        try:
+            self._generation += 1
+            snap = {
+                "generation": self._generation,
+                "requests": list(self._requests.values()),
+                "users": list(self._users.values()),
+                "alerts": list(self._alerts.values()),
+                "counters": self._counters,
+                "alert_high_water": self._alert_high_water}
+            self._write_file(self._snap_file, [json.dumps(snap).encode()])
+            self._start_journal()
+        finally:
+            self.unlock()
+
+    def vacuum(self):
+        """
+        The journal has no free pages to give back, this only compacts it.
+        """
+        self.compact()
+
+    def _write(self, op):
+        if self.read_only:
+            raise exceptions.PersistenceException(
+                "The journal %s was opened read only" % self._db_file)
+        if not self._in_memory:
+            self._fptr.write((json.dumps(op) + "\n").encode())
+            self._fptr.flush()
+            if self._sync:
+                os.fsync(self._fptr.fileno())
+            self._journal_ops += 1
+        self._apply(op)
+        if self._journal_ops > self._compact_ops and \
+                self._journal_ops > len(self._requests) + len(self._alerts):
+            self.compact()
+
+    def _apply(self, op):
+        name = op["o"]
+        if name == JournalOps.NEW:
+            self._add_request(op["r"])
+        elif name == JournalOps.UPDATE:
+            row = self._requests[op["id"]]
+            self._set_state(row, op["s"])
+            row[_LAST_UPDATE_TIME] = op["t"]
+            if "r" in op:
+                self._live_bytes += _doc_size(op["r"]) - \
+                    _doc_size(row[_REPLY_DOC])
+                row[_REPLY_DOC] = op["r"]
+        elif name == JournalOps.LOST:
+            lost_ids = list(self._by_state.get(
+                messaging_states.ReplyStates.ACKED, {}))
+            for request_id in lost_ids:
+                row = self._requests[request_id]
+                self._set_state(row, messaging_states.ReplyStates.REPLY)
+                self._live_bytes += _doc_size(op["r"]) - \
+                    _doc_size(row[_REPLY_DOC])
+                row[_REPLY_DOC] = op["r"]
+        elif name == JournalOps.DELETE:
+            for request_id in op["ids"]:
+                self._remove_request(request_id)
+        elif name == JournalOps.USER:
+            self._users[(op["r"][0], op["r"][1])] = op["r"]
+        elif name == JournalOps.ALERTS:
+            for alert in op["a"]:
+                self._alerts[alert[2]] = alert
+                if alert[0] > self._alert_high_water:
+                    self._alert_high_water = alert[0]
+        elif name == JournalOps.DELETE_ALERTS:
+            for alert_hash in op["h"]:
+                self._alerts.pop(alert_hash, None)
+        elif name == JournalOps.COUNTER:
+            self._counters[op["n"]] = op["v"]
+        else:
+            raise exceptions.PersistenceException(
+                "Unknown journal entry %s" % name)
+
+    def _add_request(self, row):
+        self._requests[row[_REQUEST_ID]] = row
+        self._by_state.setdefault(
+            row[_STATE], collections.OrderedDict())[row[_REQUEST_ID]] = True
+        self._live_bytes += _g_row_overhead + \
+            _doc_size(row[_REQUEST_DOC]) + _doc_size(row[_REPLY_DOC])
+
+    def _remove_request(self, request_id):
+        row = self._requests.pop(request_id, None)
+        if row is None:
+            return
+        del self._by_state[row[_STATE]][request_id]
+        self._live_bytes -= _g_row_overhead + \
+            _doc_size(row[_REQUEST_DOC]) + _doc_size(row[_REPLY_DOC])
+
+    def _set_state(self, row, state):
+        del self._by_state[row[_STATE]][row[_REQUEST_ID]]
+        row[_STATE] = state
+        self._by_state.setdefault(
+            state, collections.OrderedDict())[row[_REQUEST_ID]] = True
+
+    def _add_to_counter(self, name, amount):
+        self._write({"o": JournalOps.COUNTER, "n": name,
+                     "v": self._counters.get(name, 0) + amount})
+
+    def _delete_requests(self, request_ids):
+        if request_ids:
+            self._write({"o": JournalOps.DELETE, "ids": request_ids})
+        return len(request_ids)
+
+    @_locked
+    def starting_agent(self):
+        if not self._by_state.get(messaging_states.ReplyStates.ACKED):
+            return
+        r = {
+            'Exception':
+            "The job was executed but the state of the execution was lost.",
+            'return_code': 1}
+        self._write({"o": JournalOps.LOST, "r": json.dumps(r)})
+
+    @_locked
+    def check_agent_id(self, agent_id):
+        self._delete_requests(
+            [request_id for request_id, row in self._requests.items()
+             if row[_AGENT_ID] != agent_id])
+
+    def _get_all_state(self, state):
+        return [persistence.SQLiteRequestObject(self._requests[i])
+                for i in self._by_state.get(state, {})]
+
+    @_locked
+    def get_all_complete(self):
+        return self._get_all_state(messaging_states.ReplyStates.REPLY_ACKED)
+
+    @_locked
+    def get_all_rejected(self, session=None):
+        return self._get_all_state(messaging_states.ReplyStates.NACKED)
+
+    @_locked
+    def get_all_reply_nacked(self, session=None):
+        return self._get_all_state(messaging_states.ReplyStates.REPLY_NACKED)
+
+    @_locked
+    def get_all_ack(self):
+        return self._get_all_state(messaging_states.ReplyStates.ACKED)
+
+    @_locked
+    def get_all_reply(self):
+        return self._get_all_state(messaging_states.ReplyStates.REPLY)
+
+    @_locked
+    def lookup_req(self, request_id):
+        row = self._requests.get(request_id)
+        if row is None:
+            return None
+        return persistence.SQLiteRequestObject(row)
+
+    @_locked
+    def new_record(self, request_id, request_doc, reply_doc, state,
+                   agent_id):
+        if request_id != request_doc['request_id']:
+            raise exceptions.PersistenceException("The request_id must match "
+                                                  "the request_doc")
+        if request_id in self._requests:
+            raise exceptions.PersistenceException(
+                "The request %s is already recorded" % request_id)
+        if reply_doc is not None:
+            reply_doc = json.dumps(reply_doc)
+        nw = _now()
+        self._write({"o": JournalOps.NEW,
+                     "r": [request_id, nw, json.dumps(request_doc),
+                           reply_doc, state, agent_id, nw]})
+
+    def _update(self, request_id, state, **kwargs):
+        if request_id not in self._requests:
+            raise exceptions.PersistenceException(
+                "0 rows were updated when exactly 1 should have been")
+        op = {"o": JournalOps.UPDATE, "id": request_id, "s": state,
+              "t": _now()}
+        op.update(kwargs)
+        self._write(op)
+
+    @_locked
+    def update_record(self, request_id, state, reply_doc=None):
+        try:
+            if reply_doc is not None:
+                reply_doc = json.dumps(reply_doc)
+            self._update(request_id, state, r=reply_doc)
+        except Exception as ex:
+            raise exceptions.PersistenceException(ex)
+
+    @_locked
+    def update_state(self, request_id, state):
+        """
+        Move a request to a new state without touching any of its
+        documents.
+        """
+        try:
+            self._update(request_id, state)
+        except Exception as ex:
+            raise exceptions.PersistenceException(ex)
+
+    @_locked
+    def clean_all_expired(self, cut_off_time):
+        cut_off_time = str(cut_off_time)
+        self._delete_requests(
+            [request_id for request_id, row in self._requests.items()
+             if row[_LAST_UPDATE_TIME] < cut_off_time])
+
+    def _oldest_completed(self):
+        completed = []
+        for state in persistence._g_completed_states:
+            completed.extend(self._by_state.get(state, {}))
+        completed.sort(key=lambda i: self._requests[i][_LAST_UPDATE_TIME])
+        return completed
+
+    @_locked
+    def evict_completed(self, max_rows=None, max_bytes=None,
+                        batch_size=100):
+        """
+        Delete the oldest completed requests until there are no more than
+        max_rows requests and the live records take no more than max_bytes.
+        The deletes are journaled like any other write, the space is given
+        back when the journal reaches compact_ops and is compacted.
+
+        :return: A tuple of the number of records evicted to meet max_rows
+        and the number evicted to meet max_bytes.
+        """
+        completed = self._oldest_completed()
+        by_count = 0
+        by_size = 0
+        if max_rows is not None:
+            excess = len(self._requests) - max_rows
+            if excess > 0:
+                by_count = self._delete_requests(completed[:excess])
+                completed = completed[by_count:]
+        if max_bytes is not None:
+            while self._live_bytes > max_bytes and completed:
+                evicted = self._delete_requests(completed[:batch_size])
+                completed = completed[evicted:]
+                by_size += evicted
+        if by_count:
+            self._add_to_counter(
+                persistence.DBCounters.EVICTED_BY_COUNT, by_count)
+        if by_size:
+            self._add_to_counter(
+                persistence.DBCounters.EVICTED_BY_SIZE, by_size)
+        if by_count or by_size:
+            _g_logger.info("Evicted %d completed requests to stay under %s "
+                           "rows and %d to stay under %s bytes"
+                           % (by_count, str(max_rows), by_size,
+                              str(max_bytes)))
+        return by_count, by_size
+
+    @_locked
+    def get_counters(self):
+        return dict(self._counters)
+
+    def get_cache_stats(self):
+        # every lookup is answered from memory
+        return None
+
+    @_locked
+    def get_db_size(self):
+        """
+        :return: The number of bytes the journal and snapshot take on disk.
+        """
+        if self._in_memory:
+            return self._live_bytes
+        size = 0
+        for f in [self._db_file, self._snap_file]:
+            if os.path.exists(f):
+                size += os.path.getsize(f)
+        return size
+
+    @_locked
+    def clean_all(self, request_id):
+        self._delete_requests(
+            [i for i in self._requests if i != request_id])
+
+    @_locked
+    def add_user(self, agent_id, name, ssh_key, admin):
+        existing = self._users.get((name, agent_id))
+        if existing is not None:
+            owner = existing[2]
+        else:
+            # the first user added for an agent is its owner
+            owner = int(not any(u[1] == agent_id
+                                for u in self._users.values()))
+        self._write({"o": JournalOps.USER,
+                     "r": [name, agent_id, owner, int(bool(admin)), ssh_key,
+                           _now()]})
+
+    @_locked
+    def get_owner(self, agent_id, name, ssh_key, admin):
+        owners = [u for u in self._users.values()
+                  if u[1] == agent_id and u[2] == 1]
+        if not owners:
+            raise exceptions.PersistenceException(
+                "There is no owner in the database")
+        if len(owners) > 1:
+            _g_logger.warning(
+                "The database has more than 1 user as the owner")
+        return owners[0][0], owners[0][4]
+
+    def add_alert(self, alert_time, time_received,
+                  alert_hash, level, rule, subject, message):
+        self.add_alerts([(alert_time, time_received, alert_hash, level, rule,
+                          subject, message)])
+
+    @_locked
+    def add_alerts(self, alerts):
+        """
+        Record many alerts in one journal entry.  An alert whose hash is
+        already recorded is skipped.
+        """
+        new_alerts = []
+        seen = set()
+        for alert in alerts:
+            if alert[2] in self._alerts or alert[2] in seen:
+                continue
+            seen.add(alert[2])
+            new_alerts.append(list(alert))
+        if new_alerts:
+            self._write({"o": JournalOps.ALERTS, "a": new_alerts})
+
+    @_locked
+    def get_latest_alert_time(self):
+        return self._alert_high_water
+
+    @_locked
+    def clean_alerts(self, cut_off_time=None, max_rows=None):
+        """
+        Remove the alerts older than cut_off_time and then the oldest
+        alerts until no more than max_rows are left.  The high water mark
+        is kept in the snapshot so removing alerts never moves it back.
+
+        :return: The number of alerts removed.
+        """
+        alerts = sorted(self._alerts.values(), key=lambda a: a[0])
+        remove = []
+        if cut_off_time is not None:
+            remove = [a[2] for a in alerts if a[0] < cut_off_time]
+            alerts = alerts[len(remove):]
+        if max_rows is not None and len(alerts) > max_rows:
+            remove.extend(a[2] for a in alerts[:len(alerts) - max_rows])
+        if not remove:
+            return 0
+        self._write({"o": JournalOps.DELETE_ALERTS, "h": remove})
+        self._add_to_counter(persistence.DBCounters.ALERTS_REMOVED,
+                             len(remove))
+        _g_logger.info("Removed %d alerts from the database" % len(remove))
+        return len(remove)
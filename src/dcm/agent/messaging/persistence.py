@@ -13,16 +13,20 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 #
+import collections
+import copy
 import datetime
 import json
 import logging
 import os
 import sqlite3
 import threading
+import time
+import urllib.parse
+import zlib
 
 import dcm.agent.exceptions as exceptions
 import dcm.agent.messaging.states as messaging_states
-import dcm.agent.utils as agent_utils
 
 
 _g_logger = logging.getLogger(__name__)
@@ -61,6 +65,148 @@ create table if not exists alerts (
 );
 """
 
+# Each entry moves an existing database up to the schema version that it is
+# paired with.  The version a database is at is kept in PRAGMA user_version
+# so only the missing steps are run when an agent is upgraded.  The steps
+# must be safe to run again because they are not always run in a
+# transaction.  They are run at every start so they must never rewrite the
+# whole file, that is left to SQLiteAgentDB.vacuum().
+_g_schema_migrations = [
+    (1, """
+create index if not exists requests_state_idx on requests (state);
+create index if not exists requests_last_update_time_idx
+    on requests (last_update_time);
+create index if not exists requests_agent_id_idx on requests (agent_id);
+"""),
+    (2, """
+create table if not exists counters (
+    name              string primary key not null,
+    value             integer
+);
+"""),
+    # SQLite rewrites a whole row on every update.  Keeping the request
+    # document in its own table means the state changes of a request do
+    # not write out its (possibly very large) document again.
+    (3, """
+BEGIN;
+create table if not exists request_docs (
+    request_id        TEXT primary key not null,
+    request_doc       blob
+);
+insert or ignore into request_docs(request_id, request_doc)
+    select request_id, request_doc from requests
+    where request_doc is not null;
+update requests set request_doc = NULL where request_doc is not null;
+create trigger if not exists requests_delete_doc after delete on requests
+begin
+    delete from request_docs where request_id = old.request_id;
+end;
+COMMIT;
+"""),
+    (4, """
+create index if not exists alerts_alert_time_idx on alerts (alert_time);
+"""),
+]
+
+
+def _get_column_order():
+    return ["request_id", "creation_time", "request_doc",
+            "reply_doc", "state", "agent_id", "last_update_time"]
+
+
+def _get_select_columns():
+    table_columns = ["requests." + c for c in _get_column_order()]
+    table_columns[2] = "request_docs.request_doc"
+    return ", ".join(table_columns)
+
+
+_g_select_requests = (
+    "SELECT " + _get_select_columns() + " FROM requests "
+    "LEFT JOIN request_docs ON request_docs.request_id=requests.request_id ")
+
+# The statements run on every request or every sweep.  They must all be
+# able to use an index on the requests table.
+_g_select_state_stmt = _g_select_requests + "WHERE requests.state=?"
+_g_lookup_req_stmt = _g_select_requests + "WHERE requests.request_id=?"
+_g_starting_agent_stmt = ("UPDATE requests SET state=?, reply_doc=? "
+                          "WHERE state=?")
+# agent_id <> ? cannot be answered from an index, the two ranges can
+_g_check_agent_id_stmt = ("DELETE FROM requests "
+                          "WHERE agent_id < ? OR agent_id > ?")
+# alerts can be removed by retention so the newest alert time that was
+# ever recorded is also kept in the counters table
+_g_latest_alert_stmt = (
+    "SELECT max(coalesce((SELECT max(alert_time) FROM alerts), 0), "
+    "coalesce((SELECT value FROM counters WHERE name=?), 0))")
+_g_clean_old_alerts_stmt = "DELETE FROM alerts WHERE alert_time < ?"
+_g_evict_oldest_alerts_stmt = (
+    "DELETE FROM alerts WHERE alert_hash IN (SELECT alert_hash FROM alerts "
+    "ORDER BY alert_time LIMIT ?)")
+_g_clean_expired_stmt = "DELETE FROM requests WHERE last_update_time < ?"
+_g_evict_oldest_stmt = ("DELETE FROM requests WHERE request_id IN "
+                        "(SELECT request_id FROM requests "
+                        "WHERE state IN (?, ?, ?) "
+                        "ORDER BY last_update_time LIMIT ?)")
+
+# only requests that the agent manager will never ask about again are
+# evicted to keep the database under its size limits
+_g_completed_states = (messaging_states.ReplyStates.REPLY_ACKED,
+                       messaging_states.ReplyStates.REPLY_NACKED,
+                       messaging_states.ReplyStates.NACKED)
+
+
+# A stored document that starts with this marker is zlib compressed json.
+# Anything else is plain json text, which is how all documents were stored
+# before compression was added.
+_g_zlib_marker = b"ZJ1:"
+# compressing smaller documents does not save enough to be worth the time
+_g_compress_min_size = 256
+
+
+class DocEncodings(object):
+    JSON = "json"
+    ZLIB = "zlib"
+
+
+def _dump_doc(doc):
+    if doc is None:
+        return None
+    return json.dumps(doc)
+
+
+def _encode_doc(doc, encoding):
+    # doc is the json text of a document as made by _dump_doc
+    if doc is None:
+        return None
+    if encoding != DocEncodings.ZLIB or len(doc) < _g_compress_min_size:
+        return doc
+    return sqlite3.Binary(_g_zlib_marker + zlib.compress(doc.encode()))
+
+
+def _decode_doc(value):
+    if isinstance(value, bytes) and value.startswith(_g_zlib_marker):
+        return zlib.decompress(value[len(_g_zlib_marker):]).decode()
+    return value
+
+
+class DBCounters(object):
+    EVICTED_BY_COUNT = "evicted_by_count"
+    EVICTED_BY_SIZE = "evicted_by_size"
+    ALERTS_REMOVED = "alerts_removed"
+    ALERT_HIGH_WATER = "alert_high_water"
+
+
+def _migrate_schema(db_conn):
+    version = db_conn.execute("PRAGMA user_version").fetchone()[0]
+    for to_version, script in _g_schema_migrations:
+        if to_version <= version:
+            continue
+        _g_logger.info("Migrating the agent database from schema version "
+                       "%d to %d" % (version, to_version))
+        db_conn.executescript(
+            script + "PRAGMA user_version=%d;" % to_version)
+        version = to_version
+
 
 def fail_started_state(db_record):
     db_record.state = messaging_states.ReplyStates.REPLY
@@ -96,11 +242,6 @@ class RequestObject(object):
         self.agent_id = connected_obj.agent_id
 
 
-def _get_column_order():
-    return ["request_id", "creation_time", "request_doc",
-            "reply_doc", "state", "agent_id", "last_update_time"]
-
-
 class SQLiteRequestObject(object):
 
     # this is the disconnected object
@@ -112,29 +253,409 @@ class SQLiteRequestObject(object):
         for attr in column_order:
             setattr(self, attr, row[i])
             i += 1
+        self.request_doc = _decode_doc(self.request_doc)
+        self.reply_doc = _decode_doc(self.reply_doc)
+
+
+class RequestCache(object):
+    """
+    A bounded LRU cache of the SQLiteRequestObjects that lookup_req has
+    returned, kept current by the writes that go through SQLiteAgentDB.
+    The ids that were looked up and not found are kept in a second LRU so
+    that repeated lookups of unknown ids do not go to the database.
+
+    Every write bumps a generation number.  A reader that missed the cache
+    can only fill it if no write happened while it was reading the
+    database, otherwise it might put back a record that is already stale.
+    """
+
+    def __init__(self, max_size):
+        self._max_size = max_size
+        self._records = collections.OrderedDict()
+        self._missing = collections.OrderedDict()
+        self._generation = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _store(self, lru, request_id, value):
+        lru.pop(request_id, None)
+        lru[request_id] = value
+        while len(lru) > self._max_size:
+            lru.popitem(last=False)
+
+    def get(self, request_id):
+        """
+        :return: A tuple of (found, record, generation).  When found is True
+        record is a copy of the cached record, or None if the request id is
+        known not to be in the database.
+        """
+        self._lock.acquire()
+        try:
+            if request_id in self._records:
+                record = self._records.pop(request_id)
+                self._records[request_id] = record
+                self.hits += 1
+                return True, copy.copy(record), self._generation
+            if request_id in self._missing:
+                self._missing.pop(request_id)
+                self._missing[request_id] = True
+                self.hits += 1
+                return True, None, self._generation
+            self.misses += 1
+            return False, None, self._generation
+        finally:
+            self._lock.release()
+
+    def fill(self, request_id, record, generation):
+        self._lock.acquire()
+        try:
+            if generation != self._generation:
+                return
+            if record is None:
+                self._store(self._missing, request_id, True)
+            else:
+                self._store(self._records, request_id, copy.copy(record))
+        finally:
+            self._lock.release()
+
+    def put(self, record):
+        self._lock.acquire()
+        try:
+            self._generation += 1
+            self._missing.pop(record.request_id, None)
+            self._store(self._records, record.request_id, record)
+        finally:
+            self._lock.release()
+
+    def update(self, request_id, **kwargs):
+        self._lock.acquire()
+        try:
+            self._generation += 1
+            record = self._records.get(request_id)
+            if record is None:
+                return
+            # readers hold copies so the cached record is replaced rather
+            # than changed in place
+            record = copy.copy(record)
+            for k in kwargs:
+                setattr(record, k, kwargs[k])
+            self._records[request_id] = record
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._generation += 1
+            self._records.clear()
+            self._missing.clear()
+        finally:
+            self._lock.release()
+
+    def __len__(self):
+        return len(self._records) + len(self._missing)
+
+
+def _read_sync(func):
+    # readers only need the object lock when every thread shares the one
+    # connection.  With per thread connections in WAL mode SQLite gives
+    # each reader its own snapshot so they do not block the writers
+    def wrapper(self, *args, **kwargs):
+        if self._thread_connections:
+            return func(self, *args, **kwargs)
+        self.lock()
+        try:
+            return func(self, *args, **kwargs)
+        finally:
+            self.unlock()
+    return wrapper
+
+
+def _write_sync(func):
+    # when writes are group committed they are serialized by the committer
+    # thread.  holding the object lock while waiting on a batch would stop
+    # any other writer from joining it
+    def wrapper(self, *args, **kwargs):
+        if self._group_committer is not None:
+            return func(self, *args, **kwargs)
+        self.lock()
+        try:
+            return func(self, *args, **kwargs)
+        finally:
+            self.unlock()
+    return wrapper
+
+
+class _PendingWrite(object):
+
+    def __init__(self, func):
+        self.func = func
+        self.rc = None
+        self.exception = None
+        self.durable = threading.Event()
+
+
+class GroupCommitter(threading.Thread):
+    """
+    Run the writes submitted from many threads in a single transaction.
+
+    A write that arrives alone while the last batch held a single write is
+    committed at once, so a quiet agent does not pay the window.  Otherwise
+    the batch is committed once the window has expired or max_ops writes
+    have been collected, whichever comes first.  Every write runs in its
+    own savepoint so a failed write does not take the rest of its batch
+    with it.  The thread that submitted a write is blocked until the batch
+    holding it has been committed and synced to disk.
+    """
+
+    def __init__(self, db, window, max_ops):
+        super(GroupCommitter, self).__init__()
+        self._db = db
+        self._window = window
+        self._max_ops = max_ops
+        self._pending = []
+        self._cond = threading.Condition()
+        self._done = False
+        self._last_batch_size = 0
+        self.batches_committed = 0
+        self.writes_committed = 0
+
+    def submit(self, func):
+        pending_write = _PendingWrite(func)
+        self._cond.acquire()
+        try:
+            if self._done:
+                raise exceptions.PersistenceException(
+                    "The group committer has been shutdown")
+            self._pending.append(pending_write)
+            if len(self._pending) == 1 or \
+                    len(self._pending) >= self._max_ops:
+                self._cond.notify()
+        finally:
+            self._cond.release()
+
+        pending_write.durable.wait()
+        if pending_write.exception is not None:
+            raise pending_write.exception
+        return pending_write.rc
+
+    def _next_batch(self):
+        self._cond.acquire()
+        try:
+            while not self._pending and not self._done:
+                self._cond.wait()
+            if len(self._pending) > 1 or self._last_batch_size > 1:
+                # other writers are active so wait for them to join
+                end_time = time.monotonic() + self._window
+                while len(self._pending) < self._max_ops and \
+                        not self._done:
+                    remaining = end_time - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+            batch = self._pending[:self._max_ops]
+            self._pending = self._pending[self._max_ops:]
+            self._last_batch_size = len(batch)
+            return batch
+        finally:
+            self._cond.release()
+
+    def _commit_batch(self, db_conn, batch):
+        cursor = db_conn.cursor()
+        try:
+            cursor.execute("BEGIN IMMEDIATE")
+            for pending_write in batch:
+                cursor.execute("SAVEPOINT group_write")
+                try:
+                    pending_write.rc = pending_write.func(cursor)
+                except Exception as ex:
+                    pending_write.exception = ex
+                    cursor.execute("ROLLBACK TO group_write")
+                cursor.execute("RELEASE group_write")
+            cursor.execute("COMMIT")
+            self.batches_committed += 1
+            self.writes_committed += len(batch)
+        except Exception as ex:
+            _g_logger.exception("Failed to commit a batch of %d writes to "
+                                "the DB: %s" % (len(batch), str(ex)))
+            if db_conn.in_transaction:
+                cursor.execute("ROLLBACK")
+            for pending_write in batch:
+                if pending_write.exception is None:
+                    pending_write.exception = ex
+        finally:
+            cursor.close()
+            for pending_write in batch:
+                pending_write.durable.set()
+
+    def run(self):
+        # a write is acked once it returns so every commit must be synced
+        db_conn = self._db._connect(synchronous="FULL")
+        # transactions are handled by hand so that savepoints can be used
+        db_conn.isolation_level = None
+        try:
+            while True:
+                batch = self._next_batch()
+                if not batch:
+                    return
+                self._commit_batch(db_conn, batch)
+        finally:
+            db_conn.close()
+
+    def done(self):
+        self._cond.acquire()
+        try:
+            self._done = True
+            self._cond.notify()
+        finally:
+            self._cond.release()
 
 
 class SQLiteAgentDB(object):
     _lock = threading.RLock()
 
-    def __init__(self, db_file):
+    def __init__(self, db_file, thread_connections=False, busy_timeout=5.0,
+                 group_commit_window=None, group_commit_max_ops=64,
+                 doc_encoding=DocEncodings.JSON, cache_size=0,
+                 read_only=False):
+        """
+        :param db_file: The path to the sqlite database file.
+        :param thread_connections: When True each thread gets its own
+        connection to the database and the file is put in WAL journal mode
+        so that readers do not wait on writers.  This is ignored for
+        in memory databases because they cannot be shared between
+        connections.
+        :param busy_timeout: The number of seconds a connection will wait
+        on a locked database before failing.
+        :param group_commit_window: When not None writes from all threads
+        are collected for up to this many seconds and committed in one
+        transaction.  Like thread_connections this is ignored for in
+        memory databases.
+        :param group_commit_max_ops: The most writes that will be put in
+        a single group commit.
+        :param doc_encoding: How request and reply documents are written.
+        One of the DocEncodings values.  Documents written with any
+        encoding can always be read.
+        :param cache_size: The number of requests, and separately the
+        number of unknown request ids, that lookup_req keeps in memory.
+        0 turns the cache off.
+        :param read_only: Open the file read only and leave its schema as
+        it is.  This is for looking at the database of an agent that may be
+        running.  Group commit is not used.
+        """
         self._db_file = db_file
+        self._read_only = read_only and db_file != ":memory:"
+        self._doc_encoding = doc_encoding
+        self._busy_timeout = busy_timeout
+        self._thread_connections = \
+            thread_connections and db_file != ":memory:"
+        self._local = threading.local()
+        # every thread connection so that close() can close them all
+        self._thread_conns = []
+        self._thread_conns_lock = threading.Lock()
+        self._group_committer = None
+        self._group_commit = \
+            group_commit_window is not None and db_file != ":memory:" and \
+            not self._read_only
+        self._cache = None
+        # the newest alert_time recorded, loaded from the DB on first use
+        self._alert_high_water = None
+        self._alert_lock = threading.Lock()
+        if cache_size > 0:
+            self._cache = RequestCache(cache_size)
+        if self._thread_connections:
+            # writers still serialize on this instance rather than
+            # spinning on SQLITE_BUSY inside of the busy timeout
+            self._lock = threading.RLock()
 
         try:
-            self._db_conn = sqlite3.connect(
-                self._db_file, check_same_thread=False)
-            try:
-                self._db_conn.executescript(_g_sqllite_ddl)
-                self._db_conn.commit()
-            except Exception as ex:
-                _g_logger.exception(
-                    "Could not open " + db_file + " " + str(ex))
-                self._db_conn.rollback()
-                raise
+            self._db_conn = self._connect()
+            if not self._read_only:
+                self._create_tables()
         except Exception as ex:
             _g_logger.exception(
                 "Could not connect to the DB " + db_file + " " + str(ex))
             raise
+        self._local.conn = self._db_conn
+
+        if self._group_commit:
+            self._group_committer = GroupCommitter(
+                self, group_commit_window, group_commit_max_ops)
+            self._group_committer.start()
+
+    def _create_tables(self):
+        try:
+            # this only takes for a new file.  An existing file is changed
+            # over by vacuum()
+            self._db_conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            if self._thread_connections:
+                self._db_conn.execute("PRAGMA journal_mode=WAL")
+            self._db_conn.executescript(_g_sqllite_ddl)
+            _migrate_schema(self._db_conn)
+            self._db_conn.commit()
+            auto_vacuum = self._db_conn.execute(
+                "PRAGMA auto_vacuum").fetchone()[0]
+            if auto_vacuum == 0:
+                _g_logger.info(
+                    "The agent database %s does not give back the space of "
+                    "removed records.  Run 'dcm-agent vacuum' while the "
+                    "agent is stopped to change it over." % self._db_file)
+        except Exception as ex:
+            _g_logger.exception(
+                "Could not open " + self._db_file + " " + str(ex))
+            self._db_conn.rollback()
+            raise
+
+    def close(self):
+        if self._group_committer is not None:
+            self._group_committer.done()
+            self._group_committer.join()
+        self._thread_conns_lock.acquire()
+        try:
+            conns = self._thread_conns
+            self._thread_conns = []
+        finally:
+            self._thread_conns_lock.release()
+        for conn in conns:
+            conn.close()
+        self._db_conn.close()
+
+    def _connect(self, synchronous=None):
+        db_file = self._db_file
+        uri = False
+        if self._read_only:
+            db_file = "file:%s?mode=ro" % urllib.parse.quote(
+                os.path.abspath(db_file))
+            uri = True
+        if not self._thread_connections:
+            return sqlite3.connect(
+                db_file, check_same_thread=False,
+                timeout=self._busy_timeout, uri=uri)
+        # close() closes the thread connections from its own thread
+        conn = sqlite3.connect(db_file, check_same_thread=False,
+                               timeout=self._busy_timeout, uri=uri)
+        if synchronous is None:
+            # a record is acked once it is written so a connection that
+            # writes syncs every commit.  With a group committer the
+            # thread connections only read
+            synchronous = "NORMAL" if self._group_commit else "FULL"
+        conn.execute("PRAGMA synchronous=%s" % synchronous)
+        return conn
+
+    def _get_conn(self):
+        if not self._thread_connections:
+            return self._db_conn
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._connect()
+            self._local.conn = conn
+            self._thread_conns_lock.acquire()
+            try:
+                self._thread_conns.append(conn)
+            finally:
+                self._thread_conns_lock.release()
+        return conn
 
     def lock(self):
         self._lock.acquire()
@@ -152,15 +673,16 @@ class SQLiteAgentDB(object):
 
     def _execute(self, func):
         try:
-            cursor = self._db_conn.cursor()
+            db_conn = self._get_conn()
+            cursor = db_conn.cursor()
             try:
                 rc = func(cursor)
-                self._db_conn.commit()
+                db_conn.commit()
                 return rc
             except Exception as ex:
                 _g_logger.exception(
                     "Could not access " + self._db_file + " " + str(ex))
-                self._db_conn.rollback()
+                db_conn.rollback()
                 raise
             finally:
                 cursor.close()
@@ -170,7 +692,26 @@ class SQLiteAgentDB(object):
             self._log_db_info()
             raise
 
-    @agent_utils.class_method_sync
+    def _cache_update(self, request_id, **kwargs):
+        if self._cache is not None:
+            self._cache.update(request_id, **kwargs)
+
+    def _cache_clear(self):
+        if self._cache is not None:
+            self._cache.clear()
+
+    def _execute_write(self, func):
+        if self._group_committer is None:
+            return self._execute(func)
+        try:
+            return self._group_committer.submit(func)
+        except Exception as ex:
+            _g_logger.exception(
+                "Failed to write to the DB " + self._db_file + " " + str(ex))
+            self._log_db_info()
+            raise
+
+    @_write_sync
     def starting_agent(self):
         r = {
             'Exception':
@@ -178,98 +719,106 @@ class SQLiteAgentDB(object):
             'return_code': 1}
         reply_doc = json.dumps(r)
 
-        stmt = ("UPDATE requests SET state=?, reply_doc=? WHERE state=?")
-
         def do_it(cursor):
-            cursor.execute(stmt,
+            cursor.execute(_g_starting_agent_stmt,
                            (messaging_states.ReplyStates.REPLY,
                             reply_doc,
                             messaging_states.ReplyStates.ACKED))
-        self._execute(do_it)
+        self._execute_write(do_it)
+        self._cache_clear()
 
-    @agent_utils.class_method_sync
+    @_write_sync
     def check_agent_id(self, agent_id):
-        stmt = 'DELETE FROM requests where agent_id <> ?'
-
         def do_it(cursor):
-            cursor.execute(stmt, (agent_id,))
-        self._execute(do_it)
+            cursor.execute(_g_check_agent_id_stmt, (agent_id, agent_id))
+        self._execute_write(do_it)
+        self._cache_clear()
 
     def _get_all_state(self, state):
-        stmt = ("SELECT " + ", ".join(_get_column_order()) +
-                " FROM requests WHERE state=\"" + state + '"')
-
         def do_it(cursor):
-            cursor.execute(stmt)
+            cursor.execute(_g_select_state_stmt, (state,))
             rows = cursor.fetchall()
             if not rows:
                 return []
             return [SQLiteRequestObject(i) for i in rows]
         return self._execute(do_it)
 
-    @agent_utils.class_method_sync
+    @_read_sync
     def get_all_complete(self):
         return self._get_all_state(messaging_states.ReplyStates.REPLY_ACKED)
 
-    @agent_utils.class_method_sync
+    @_read_sync
     def get_all_rejected(self, session=None):
         return self._get_all_state(messaging_states.ReplyStates.NACKED)
 
-    @agent_utils.class_method_sync
+    @_read_sync
     def get_all_reply_nacked(self, session=None):
         return self._get_all_state(messaging_states.ReplyStates.REPLY_NACKED)
 
-    @agent_utils.class_method_sync
+    @_read_sync
     def get_all_ack(self):
         return self._get_all_state(messaging_states.ReplyStates.ACKED)
 
-    @agent_utils.class_method_sync
+    @_read_sync
     def get_all_reply(self):
         return self._get_all_state(messaging_states.ReplyStates.REPLY)
 
-    @agent_utils.class_method_sync
+    @_read_sync
     def lookup_req(self, request_id):
-        stmt = ("SELECT " + ", ".join(_get_column_order()) + " FROM "
-                'requests where request_id=?')
+        if self._cache is not None:
+            found, record, generation = self._cache.get(request_id)
+            if found:
+                return record
 
         def do_it(cursor):
-            cursor.execute(stmt, [request_id])
+            cursor.execute(_g_lookup_req_stmt, [request_id])
             row = cursor.fetchone()
             if not row:
                 return
             return SQLiteRequestObject(row)
-        return self._execute(do_it)
+        record = self._execute(do_it)
+        if self._cache is not None:
+            self._cache.fill(request_id, record, generation)
+        return record
 
-    @agent_utils.class_method_sync
+    @_write_sync
     def new_record(self, request_id, request_doc, reply_doc, state,
                    agent_id):
-        stmt = ("INSERT INTO requests(request_id, creation_time, request_doc, "
+        stmt = ("INSERT INTO requests(request_id, creation_time, "
                 "reply_doc, state, agent_id, last_update_time) "
-                "VALUES(?, ?, ?, ?, ?, ?, ?)")
+                "VALUES(?, ?, ?, ?, ?, ?)")
+        doc_stmt = ("INSERT OR REPLACE INTO request_docs(request_id, "
+                    "request_doc) VALUES(?, ?)")
 
         if request_id != request_doc['request_id']:
             raise exceptions.PersistenceException("The request_id must match "
                                                   "the request_doc")
 
-        if request_doc is not None:
-            request_doc = json.dumps(request_doc)
-        if reply_doc is not None:
-            reply_doc = json.dumps(reply_doc)
+        request_text = _dump_doc(request_doc)
+        reply_text = _dump_doc(reply_doc)
+        request_doc = _encode_doc(request_text, self._doc_encoding)
+        reply_doc = _encode_doc(reply_text, self._doc_encoding)
 
         def do_it(cursor):
             nw = datetime.datetime.now()
-            parms = (request_id, nw, request_doc,
-                     reply_doc, state, agent_id, nw)
+            parms = (request_id, nw, reply_doc, state, agent_id, nw)
             cursor.execute(stmt, parms)
-        self._execute(do_it)
-
-    @agent_utils.class_method_sync
+            cursor.execute(doc_stmt, (request_id, request_doc))
+            return nw
+        nw = self._execute_write(do_it)
+        if self._cache is not None:
+            # dates are stored as text so cache them the way they read back
+            self._cache.put(SQLiteRequestObject(
+                (request_id, str(nw), request_text, reply_text, state,
+                 agent_id, str(nw))))
+
+    @_write_sync
     def update_record(self, request_id, state, reply_doc=None):
         stmt = ("UPDATE requests SET state=?, reply_doc=?, last_update_time=? "
                 "WHERE request_id=?")
         try:
-            if reply_doc is not None:
-                reply_doc = json.dumps(reply_doc)
+            reply_text = _dump_doc(reply_doc)
+            reply_doc = _encode_doc(reply_text, self._doc_encoding)
 
             def do_it(cursor):
                 nw = datetime.datetime.now()
@@ -278,28 +827,185 @@ class SQLiteAgentDB(object):
                     raise exceptions.PersistenceException(
                         "%d rows were updated when exactly 1 should have "
                         "been" % cursor.rowcount)
-            self._execute(do_it)
+                return nw
+            nw = self._execute_write(do_it)
+        except Exception as ex:
+            raise exceptions.PersistenceException(ex)
+        self._cache_update(request_id, state=state, reply_doc=reply_text,
+                           last_update_time=str(nw))
+
+    @_write_sync
+    def update_state(self, request_id, state):
+        """
+        Move a request to a new state without touching any of its
+        documents.  This is the cheap write for the transitions that do not
+        carry a new reply (reply acked and reply nacked).
+        """
+        stmt = ("UPDATE requests SET state=?, last_update_time=? "
+                "WHERE request_id=?")
+        try:
+            def do_it(cursor):
+                nw = datetime.datetime.now()
+                cursor.execute(stmt, (state, nw, request_id))
+                if cursor.rowcount != 1:
+                    raise exceptions.PersistenceException(
+                        "%d rows were updated when exactly 1 should have "
+                        "been" % cursor.rowcount)
+                return nw
+            nw = self._execute_write(do_it)
         except Exception as ex:
             raise exceptions.PersistenceException(ex)
+        self._cache_update(request_id, state=state,
+                           last_update_time=str(nw))
 
-    @agent_utils.class_method_sync
+    @_write_sync
     def clean_all_expired(self, cut_off_time):
-        stmt = ("DELETE FROM requests WHERE request_id in (SELECT request_id "
-                "FROM requests WHERE last_update_time < ?)")
+        def do_it(cursor):
+            cursor.execute(_g_clean_expired_stmt, (cut_off_time,))
+        self._execute_write(do_it)
+        self._cache_clear()
+
+    def _used_bytes(self, cursor):
+        cursor.execute("PRAGMA page_size")
+        page_size = cursor.fetchone()[0]
+        cursor.execute("PRAGMA page_count")
+        page_count = cursor.fetchone()[0]
+        cursor.execute("PRAGMA freelist_count")
+        free_count = cursor.fetchone()[0]
+        return (page_count - free_count) * page_size
+
+    def _add_to_counter(self, cursor, name, amount):
+        cursor.execute("INSERT OR IGNORE INTO counters(name, value) "
+                       "VALUES(?, 0)", (name,))
+        cursor.execute("UPDATE counters SET value=value+? WHERE name=?",
+                       (amount, name))
+
+    def vacuum(self):
+        """
+        Rewrite the database file with incremental auto vacuum turned on,
+        which a file made by an older agent does not have.  This is a
+        maintenance step, it needs as much free disk space as the file
+        takes and holds an exclusive lock on the file until it is done.
+        """
+        script = "PRAGMA auto_vacuum=INCREMENTAL; VACUUM;"
+        if self._thread_connections:
+            script = script + "PRAGMA wal_checkpoint(TRUNCATE);"
+        self.lock()
+        try:
+            self._get_conn().executescript(script)
+        finally:
+            self.unlock()
 
+    def get_auto_vacuum(self):
         def do_it(cursor):
-            cursor.execute(stmt, (cut_off_time,))
-        self._execute(do_it)
+            cursor.execute("PRAGMA auto_vacuum")
+            return cursor.fetchone()[0]
+        return self._execute(do_it)
 
-    @agent_utils.class_method_sync
+    def _release_free_pages(self):
+        # incremental_vacuum frees a page each time it is stepped, only
+        # executescript steps it to the end
+        script = "PRAGMA incremental_vacuum;"
+        if self._thread_connections:
+            script = script + "PRAGMA wal_checkpoint(TRUNCATE);"
+        self.lock()
+        try:
+            self._get_conn().executescript(script)
+        finally:
+            self.unlock()
+
+    @_write_sync
+    def evict_completed(self, max_rows=None, max_bytes=None,
+                        batch_size=100):
+        """
+        Delete the oldest completed requests until there are no more than
+        max_rows requests and the database uses no more than max_bytes.
+        The pages that are freed are then given back to the file system.
+
+        :return: A tuple of the number of records evicted to meet max_rows
+        and the number evicted to meet max_bytes.
+        """
+        def do_it(cursor):
+            by_count = 0
+            by_size = 0
+            if max_rows is not None:
+                cursor.execute("SELECT count(*) FROM requests")
+                excess = cursor.fetchone()[0] - max_rows
+                if excess > 0:
+                    cursor.execute(_g_evict_oldest_stmt,
+                                   _g_completed_states + (excess,))
+                    by_count = cursor.rowcount
+            if max_bytes is not None:
+                while self._used_bytes(cursor) > max_bytes:
+                    cursor.execute(_g_evict_oldest_stmt,
+                                   _g_completed_states + (batch_size,))
+                    if cursor.rowcount < 1:
+                        break
+                    by_size += cursor.rowcount
+            if by_count:
+                self._add_to_counter(
+                    cursor, DBCounters.EVICTED_BY_COUNT, by_count)
+            if by_size:
+                self._add_to_counter(
+                    cursor, DBCounters.EVICTED_BY_SIZE, by_size)
+            return by_count, by_size
+
+        by_count, by_size = self._execute_write(do_it)
+        if by_count or by_size:
+            self._cache_clear()
+            _g_logger.info("Evicted %d completed requests to stay under %s "
+                           "rows and %d to stay under %s bytes"
+                           % (by_count, str(max_rows), by_size,
+                              str(max_bytes)))
+            self._release_free_pages()
+        return by_count, by_size
+
+    def get_cache_stats(self):
+        """
+        :return: The lookup_req cache hits and misses, or None when the
+        cache is off.
+        """
+        if self._cache is None:
+            return None
+        return {"hits": self._cache.hits, "misses": self._cache.misses,
+                "size": len(self._cache)}
+
+    @_read_sync
+    def get_counters(self):
+        def do_it(cursor):
+            cursor.execute("SELECT name, value FROM counters")
+            return dict(cursor.fetchall())
+        return self._execute(do_it)
+
+    @_read_sync
+    def get_db_size(self):
+        """
+        :return: The number of bytes the database file takes on disk
+        including any write ahead log.
+        """
+        if self._db_file == ":memory:":
+            def do_it(cursor):
+                cursor.execute("PRAGMA page_size")
+                page_size = cursor.fetchone()[0]
+                cursor.execute("PRAGMA page_count")
+                return page_size * cursor.fetchone()[0]
+            return self._execute(do_it)
+        size = 0
+        for f in [self._db_file, self._db_file + "-wal"]:
+            if os.path.exists(f):
+                size += os.path.getsize(f)
+        return size
+
+    @_write_sync
     def clean_all(self, request_id):
         stmt = ("DELETE FROM requests WHERE request_id <> ?")
 
         def do_it(cursor):
             cursor.execute(stmt, (request_id,))
-        self._execute(do_it)
+        self._execute_write(do_it)
+        self._cache_clear()
 
-    @agent_utils.class_method_sync
+    @_write_sync
     def add_user(self, agent_id, name, ssh_key, admin):
         test_owner = ("SELECT * FROM users where agent_id=?")
         test_exists = ("SELECT * FROM users where agent_id=? and "
@@ -331,9 +1037,9 @@ class SQLiteAgentDB(object):
                     insert_new,
                     (name, agent_id, owner, administrator, ssh_key, nw))
 
-        self._execute(do_it)
+        self._execute_write(do_it)
 
-    @agent_utils.class_method_sync
+    @_read_sync
     def get_owner(self, agent_id, name, ssh_key, admin):
         stmt = ("SELECT username, ssh_public_key FROM users where agent_id=? and owner=1")
 
@@ -350,46 +1056,117 @@ class SQLiteAgentDB(object):
 
         return self._execute(do_it)
 
-    @agent_utils.class_method_sync
     def add_alert(self, alert_time, time_received,
                   alert_hash, level, rule, subject, message):
-        insert_new = ("INSERT INTO alerts(alert_time, added_time, alert_hash, "
-                      "level, rule, subject, message) "
+        self.add_alerts([(alert_time, time_received, alert_hash, level, rule,
+                          subject, message)])
+
+    @_write_sync
+    def add_alerts(self, alerts):
+        """
+        Record many alerts in one transaction.  An alert whose hash is
+        already recorded is skipped.
+
+        :param alerts: A list of (alert_time, time_received, alert_hash,
+        level, rule, subject, message) tuples.
+        """
+        insert_new = ("INSERT OR IGNORE INTO alerts(alert_time, added_time, "
+                      "alert_hash, level, rule, subject, message) "
                       "VALUES(?, ?, ?, ?, ?, ?, ?)")
-        stmt = "SELECT alert_time from alerts"
-
+        if not alerts:
+            return
 
         def do_it(cursor):
-            cursor.execute(
-                insert_new,
-                (alert_time, time_received, alert_hash, level, rule,
-                 subject, message))
-            cursor.execute(stmt)
-            row = cursor.fetchone()
-            return row
-
-        return self._execute(do_it)
+            newest = None
+            for alert in alerts:
+                cursor.execute(insert_new, alert)
+                if cursor.rowcount == 1 and \
+                        (newest is None or alert[0] > newest):
+                    newest = alert[0]
+            return newest
+
+        newest = self._execute_write(do_it)
+        if newest is None:
+            return
+        self._alert_lock.acquire()
+        try:
+            if self._alert_high_water is not None and \
+                    newest > self._alert_high_water:
+                self._alert_high_water = newest
+        finally:
+            self._alert_lock.release()
 
-    @agent_utils.class_method_sync
+    @_read_sync
     def get_latest_alert_time(self):
-        stmt = "SELECT max(alert_time) from alerts"
-
         def do_it(cursor):
-            cursor.execute(stmt)
+            cursor.execute(_g_latest_alert_stmt,
+                           (DBCounters.ALERT_HIGH_WATER,))
             row = cursor.fetchone()
             if row is None or len(row) < 1 or row[0] is None:
                 return 0
             return row[0]
 
-        return self._execute(do_it)
+        # the lock is held across the read so that a writer cannot update
+        # the high water mark between the read and it being cached
+        self._alert_lock.acquire()
+        try:
+            if self._alert_high_water is None:
+                self._alert_high_water = self._execute(do_it)
+            return self._alert_high_water
+        finally:
+            self._alert_lock.release()
+
+    @_write_sync
+    def clean_alerts(self, cut_off_time=None, max_rows=None):
+        """
+        Remove the alerts older than cut_off_time and then the oldest
+        alerts until no more than max_rows are left.  The newest alert time
+        is saved first so that get_latest_alert_time does not go backwards
+        and cause removed alerts to be sent again.
+
+        :param cut_off_time: An alert time in milliseconds since the epoch.
+        :return: The number of alerts removed.
+        """
+        def do_it(cursor):
+            removed = 0
+            cursor.execute("SELECT max(alert_time) FROM alerts")
+            newest = cursor.fetchone()[0]
+            if cut_off_time is not None:
+                cursor.execute(_g_clean_old_alerts_stmt, (cut_off_time,))
+                removed += cursor.rowcount
+            if max_rows is not None:
+                cursor.execute("SELECT count(*) FROM alerts")
+                excess = cursor.fetchone()[0] - max_rows
+                if excess > 0:
+                    cursor.execute(_g_evict_oldest_alerts_stmt, (excess,))
+                    removed += cursor.rowcount
+            if removed:
+                cursor.execute("INSERT OR IGNORE INTO counters(name, value) "
+                               "VALUES(?, 0)", (DBCounters.ALERT_HIGH_WATER,))
+                cursor.execute("UPDATE counters SET value=max(value, ?) "
+                               "WHERE name=?",
+                               (newest, DBCounters.ALERT_HIGH_WATER))
+                self._add_to_counter(
+                    cursor, DBCounters.ALERTS_REMOVED, removed)
+            return removed
+
+        removed = self._execute_write(do_it)
+        if removed:
+            _g_logger.info("Removed %d alerts from the database" % removed)
+            self._release_free_pages()
+        return removed
 
 
 class DBCleaner(threading.Thread):
 
-    def __init__(self, db, max_time, max_size, interval):
+    def __init__(self, db, max_time, max_size, interval, max_bytes=None,
+                 alert_max_age=None, alert_max_rows=None):
         super(DBCleaner, self).__init__()
         self._max_time = max_time
         self.max_size = max_size
+        self._max_bytes = max_bytes
+        self._alert_max_age = alert_max_age
+        self._alert_max_rows = alert_max_rows
         self._interval = interval
         self._done = threading.Event()
         self._cond = threading.Condition()
@@ -403,12 +1180,25 @@ class DBCleaner(threading.Thread):
                 cut_off_time = datetime.datetime.now() - datetime.timedelta(
                     microseconds=self._max_time)
                 self._db.clean_all_expired(cut_off_time)
+                self._db.evict_completed(
+                    max_rows=self.max_size, max_bytes=self._max_bytes)
+                self._clean_alerts()
             except Exception as ex:
                 _g_logger.exception("An exception occurred in the db sweeper "
                                     "thread " + str(ex))
             finally:
                 self._cond.release()
 
+    def _clean_alerts(self):
+        if self._alert_max_age is None and self._alert_max_rows is None:
+            return
+        alert_cut_off = None
+        if self._alert_max_age is not None:
+            # alert times are milliseconds since the epoch
+            alert_cut_off = int((time.time() - self._alert_max_age) * 1000)
+        self._db.clean_alerts(cut_off_time=alert_cut_off,
+                              max_rows=self._alert_max_rows)
+
     def done(self):
         self._cond.acquire()
         try:
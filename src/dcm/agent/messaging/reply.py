@@ -364,27 +364,29 @@ class ReplyRPC(object):
         reply is received.  At this point we know that the RPC was
         successful.
         """
-        self._db.update_record(self._request_id,
-                               states.ReplyStates.REPLY_ACKED)
+        self._db.update_state(self._request_id,
+                              states.ReplyStates.REPLY_ACKED)
         self._reply_message_timer.cancel()
         self._reply_message_timer = None
         self._reply_listener.message_done(self)
-        _g_logger.debug("Messaging complete.  State event transition: "
-                        + str(self._sm.get_event_list()))
+        if _g_logger.isEnabledFor(logging.DEBUG):
+            _g_logger.debug("Messaging complete.  State event transition: "
+                            "%s", self._sm.get_event_list())
 
     def _sm_reply_nack_received(self, **kwargs):
         """
         The reply was nacked.  This is probably a result of the a
         retransmission that was not needed.
         """
-        self._db.update_record(self._request_id,
-                               states.ReplyStates.REPLY_NACKED)
+        self._db.update_state(self._request_id,
+                              states.ReplyStates.REPLY_NACKED)
 
         self._reply_message_timer.cancel()
         self._reply_message_timer = None
         self._reply_listener.message_done(self)
-        _g_logger.debug("Reply NACKed, messaging complete.  State event "
-                        "transition: " + str(self._sm.get_event_list()))
+        if _g_logger.isEnabledFor(logging.DEBUG):
+            _g_logger.debug("Reply NACKed, messaging complete.  State event "
+                            "transition: %s", self._sm.get_event_list())
 
     def _sm_reply_ack_timeout(self, **kwargs):
         """
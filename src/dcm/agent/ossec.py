@@ -20,6 +20,8 @@ import threading
 import time
 import uuid
 
+import dcm.agent.events.callback as callback
+import dcm.agent.events.globals as events
 import dcm.agent.messaging.alert_msg as alert_msg
 
 from watchdog.observers.polling import PollingObserver as Observer
@@ -28,6 +30,10 @@ from watchdog.events import FileSystemEventHandler
 
 _g_logger = logging.getLogger(__name__)
 
+# how long to wait before trying again to record acked alerts that could
+# not be written to the db
+_g_record_retry_delay = 5.0
+
 # put this in global space so it is only compiled once
 _g_rule_matcher = re.compile("Rule: (.*?) \(level (.*?)\) -> '(.*?)'")
 
@@ -90,6 +96,8 @@ class AlertSender(FileSystemEventHandler):
         self._db = db
         self._alerts = {}
         self._alert_by_hash = {}
+        self._acked = []
+        self._acked_lock = threading.Lock()
         self._stopping = None
         self._thread = None
         self._cond = threading.Condition()
@@ -134,16 +142,53 @@ class AlertSender(FileSystemEventHandler):
 
         alert = self._alerts[request_id]
         alert.incoming_message()
-        _g_logger.debug("Adding the alert to the db.")
-        self._db.add_alert(alert.doc['alert_timestamp'],
-                           alert.doc['current_timestamp'],
-                           alert.alert_hash,
-                           alert.doc['level'],
-                           alert.doc['rule'],
-                           alert.doc['subject'],
-                           alert.doc['message'])
         del self._alerts[request_id]
-        del self._alert_by_hash[alert.alert_hash]
+        # the acks that arrive together are written to the db in one
+        # transaction on the next pass of the event loop.  the alert stays
+        # in _alert_by_hash until then so that it is not sent again
+        self._acked_lock.acquire()
+        try:
+            self._acked.append(alert)
+            if len(self._acked) == 1:
+                events.global_space.register_callback(
+                    self._record_acked,
+                    priority=callback.CallbackPriority.TELEMETRY)
+        finally:
+            self._acked_lock.release()
+
+    def _record_acked(self):
+        self._acked_lock.acquire()
+        try:
+            acked = self._acked
+            self._acked = []
+        finally:
+            self._acked_lock.release()
+        if not acked:
+            return
+        _g_logger.debug("Adding %d alerts to the db." % len(acked))
+        try:
+            self._db.add_alerts([(alert.doc['alert_timestamp'],
+                                  alert.doc['current_timestamp'],
+                                  alert.alert_hash,
+                                  alert.doc['level'],
+                                  alert.doc['rule'],
+                                  alert.doc['subject'],
+                                  alert.doc['message']) for alert in acked])
+        except Exception as ex:
+            _g_logger.exception("Failed to record %d acked alerts, they will "
+                                "be tried again: %s" % (len(acked), str(ex)))
+            # the alerts stay in _alert_by_hash so they are not sent again
+            self._acked_lock.acquire()
+            try:
+                self._acked = acked + self._acked
+                events.global_space.register_callback(
+                    self._record_acked, delay=_g_record_retry_delay,
+                    priority=callback.CallbackPriority.TELEMETRY)
+            finally:
+                self._acked_lock.release()
+            return
+        for alert in acked:
+            self._alert_by_hash.pop(alert.alert_hash, None)
 
     def stop(self):
         _g_logger.debug("Stopping alert message sender")
@@ -162,6 +207,7 @@ class AlertSender(FileSystemEventHandler):
             finally:
                 self._cond.release()
             self._thread.join()
+        self._record_acked()
 
     def start(self):
         _g_logger.debug("Starting alert message sender %s" % self.dir_to_watch)
@@ -0,0 +1,455 @@
+#
+#  Copyright (C) 2014 Dell, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import collections
+import logging
+import multiprocessing
+import os
+import signal
+import threading
+import time
+
+import dcm.agent.plugins.loader as plugin_loader
+
+from dcm.agent.plugins.api.exceptions import AgentPluginOperationException
+
+
+_g_logger = logging.getLogger(__name__)
+
+# the plugin.conf entry that selects how a plugin is run
+EXECUTION_KEY = "execution"
+EXECUTION_THREAD = "thread"
+EXECUTION_PROCESS = "process"
+
+# the number of canceled request ids remembered for requests that have not
+# reached the pool yet
+_g_max_canceled = 1024
+
+# the plugin processes are forked from a single threaded fork server rather
+# than from the agent, so they never inherit a lock held by an agent thread
+_g_mp_context = multiprocessing.get_context("forkserver")
+
+# the configuration values that change after the agent starts.  They are
+# sent with every request because each process builds its own configuration
+_g_runtime_attributes = ("agent_id", "customer_id", "state")
+
+
+def use_process(conf, items_map):
+    """
+    :return: True if the plugin described by items_map should be run in
+    the plugin process pool.
+    """
+    if items_map.get(EXECUTION_KEY, EXECUTION_THREAD) != EXECUTION_PROCESS:
+        return False
+    if getattr(conf, "plugin_pool", None) is None:
+        _g_logger.debug("The plugin process pool is not running, the "
+                        "plugin will be run in a thread.")
+        return False
+    return True
+
+
+def _serializable_items(items_map):
+    # the dispatcher adds agent objects to the items map.  Only what came
+    # from plugin.conf is sent to the worker
+    return dict((k, v) for k, v in items_map.items() if isinstance(v, str))
+
+
+def _runtime_attributes(conf):
+    return dict((a, getattr(conf, a, None)) for a in _g_runtime_attributes)
+
+
+class PluginProcessWorker(_g_mp_context.Process):
+    """
+    A child process that loads and runs one plugin at a time.  It builds
+    its own configuration object, and so its own database object, from the
+    agent's configuration files.
+    """
+
+    CMD_RUN = "CMD_RUN"
+    READY = "READY"
+    REPLY = "REPLY"
+    ERROR = "ERROR"
+    CANCEL_SIGNAL = signal.SIGUSR1
+
+    def __init__(self, pipe, config_files):
+        super(PluginProcessWorker, self).__init__()
+        self._pipe = pipe
+        self._config_files = config_files
+        self._conf = None
+        self._plugin = None
+        self._canceled = False
+
+    def _cancel_handler(self, signum, frame):
+        self._canceled = True
+        plugin = self._plugin
+        if plugin is not None:
+            plugin.cancel()
+
+    def _run_plugin(self, wrk):
+        (msg_type, request_id, items_map, name, arguments, runtime) = wrk
+        self._canceled = False
+        for attr, value in runtime.items():
+            setattr(self._conf, attr, value)
+        try:
+            plugin = plugin_loader.load_plugin(
+                self._conf, items_map, request_id, name, arguments)
+            self._plugin = plugin
+            if self._canceled:
+                return (PluginProcessWorker.ERROR,
+                        "The command %s was canceled." % name)
+            reply_obj = plugin.run()
+            return (PluginProcessWorker.REPLY, reply_obj.get_reply_doc())
+        except Exception as ex:
+            _g_logger.exception("The plugin %s failed in process %d"
+                                % (name, os.getpid()))
+            return (PluginProcessWorker.ERROR, str(ex))
+        finally:
+            self._plugin = None
+
+    def run(self):
+        # imported here because the configuration module imports this one
+        import dcm.agent.config as config
+
+        # the job runner and the pool belong to the parent.  A plugin
+        # process has no other threads so it can run commands itself
+        self._conf = config.AgentConfig(self._config_files)
+        self._conf.jr = None
+        self._conf.plugin_pool = None
+        self._conf.db = None
+        signal.signal(PluginProcessWorker.CANCEL_SIGNAL, self._cancel_handler)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        _g_logger.info("Plugin process %d starting" % os.getpid())
+        try:
+            # the pool does not signal the process before this is sent
+            self._pipe.send((PluginProcessWorker.READY, None))
+            while True:
+                wrk = self._pipe.recv()
+                if wrk is None:
+                    break
+                if wrk[0] != PluginProcessWorker.CMD_RUN:
+                    _g_logger.error(
+                        "An unknown work type was received %s" % wrk[0])
+                    continue
+                reply = self._run_plugin(wrk)
+                try:
+                    self._pipe.send(reply)
+                except Exception as ex:
+                    # the reply document could not be pickled
+                    self._pipe.send((PluginProcessWorker.ERROR,
+                                     "The reply could not be sent: %s"
+                                     % str(ex)))
+        except (EOFError, OSError):
+            _g_logger.error("The pipe to the plugin process was "
+                            "disconnected")
+        finally:
+            self._conf.close_db()
+            _g_logger.info("Plugin process %d has ended." % os.getpid())
+
+
+class _WorkerSlot(object):
+
+    def __init__(self, conf):
+        self._conf = conf
+        self.conn = None
+        self.process = None
+        self.request_id = None
+        self.cancel_time = None
+        self.ready = False
+        self.start()
+
+    def start(self):
+        self.ready = False
+        self.conn, child_conn = _g_mp_context.Pipe()
+        self.process = PluginProcessWorker(
+            child_conn, self._conf.config_files)
+        self.process.start()
+        # only the child holds its end so a dead child is seen as EOF
+        child_conn.close()
+
+    def kill(self):
+        try:
+            self.conn.close()
+        except Exception:
+            pass
+        if self.process.is_alive():
+            self.process.terminate()
+        self.process.join(5.0)
+        if self.process.is_alive():
+            os.kill(self.process.pid, signal.SIGKILL)
+            self.process.join()
+
+
+class PluginProcessPool(object):
+    """
+    A set of pre-started processes that run the plugins whose plugin.conf
+    section has "execution: process", so that CPU heavy plugins do not hold
+    the GIL the agent threads need.  run() is called from the thread that
+    would otherwise have run the plugin and blocks until the plugin replies.
+    The arguments, the plugin.conf entries and the reply document are
+    pickled across the pipe to the process.  The processes are started by a
+    fork server, so starting or replacing one while the agent threads run
+    is safe.
+
+    cancel() sends the process CANCEL_SIGNAL, which calls the plugin's
+    cancel().  If the plugin has not returned cancel_timeout seconds later
+    the process is killed.  A process that is killed or dies is replaced
+    with a new one.
+    """
+
+    def __init__(self, conf, processes=2, cancel_timeout=10.0,
+                 poll_interval=0.5):
+        self._conf = conf
+        self._processes = max(1, processes)
+        self._cancel_timeout = cancel_timeout
+        self._poll_interval = poll_interval
+        self._cond = threading.Condition()
+        self._slots = []
+        self._idle = []
+        self._running = {}
+        self._canceled = collections.OrderedDict()
+        self._stopping = False
+        self._runs = 0
+        self._crashes = 0
+        self._cancels = 0
+        self._kills = 0
+
+    def start(self):
+        self._cond.acquire()
+        try:
+            self._stopping = False
+            while len(self._slots) < self._processes:
+                self._add_slot()
+        finally:
+            self._cond.release()
+
+    def _add_slot(self):
+        # This should only be called locked
+        slot = _WorkerSlot(self._conf)
+        self._slots.append(slot)
+        self._idle.append(slot)
+        _g_logger.info("Started plugin process %d" % slot.process.pid)
+
+    def _checkout(self, request_id):
+        self._cond.acquire()
+        try:
+            while True:
+                if self._stopping:
+                    raise AgentPluginOperationException(
+                        "The plugin process pool is stopped.")
+                if self._canceled.pop(request_id, None) is not None:
+                    raise AgentPluginOperationException(
+                        "The request %s was canceled." % request_id)
+                if not self._idle and len(self._slots) < self._processes:
+                    self._add_slot()
+                if self._idle:
+                    slot = self._idle.pop()
+                    slot.request_id = request_id
+                    slot.cancel_time = None
+                    self._running[request_id] = slot
+                    return slot
+                self._cond.wait()
+        finally:
+            self._cond.release()
+
+    def _checkin(self, slot):
+        self._cond.acquire()
+        try:
+            self._running.pop(slot.request_id, None)
+            slot.request_id = None
+            slot.cancel_time = None
+            self._idle.append(slot)
+            self._cond.notifyAll()
+        finally:
+            self._cond.release()
+
+    def _replace(self, slot):
+        pid = slot.process.pid
+        slot.kill()
+        if self._stopping:
+            return
+        slot.start()
+        _g_logger.info("Replaced plugin process %d with %d"
+                       % (pid, slot.process.pid))
+
+    def _wait_for_reply(self, slot, name):
+        while True:
+            try:
+                if slot.conn.poll(self._poll_interval):
+                    return slot.conn.recv()
+            except (EOFError, OSError):
+                pass
+            if not slot.process.is_alive():
+                exitcode = slot.process.exitcode
+                self._cond.acquire()
+                try:
+                    self._crashes += 1
+                finally:
+                    self._cond.release()
+                _g_logger.error("The plugin process %d running %s exited "
+                                "with %s" % (slot.process.pid, name,
+                                             str(exitcode)))
+                self._replace(slot)
+                return (PluginProcessWorker.ERROR,
+                        "The process running the command %s exited with %s."
+                        % (name, str(exitcode)))
+            cancel_time = slot.cancel_time
+            if (cancel_time is not None and
+                    time.monotonic() - cancel_time > self._cancel_timeout):
+                self._cond.acquire()
+                try:
+                    self._kills += 1
+                finally:
+                    self._cond.release()
+                _g_logger.warning("The command %s did not stop %.1f seconds "
+                                  "after it was canceled, killing process "
+                                  "%d" % (name, self._cancel_timeout,
+                                          slot.process.pid))
+                self._replace(slot)
+                return (PluginProcessWorker.ERROR,
+                        "The command %s was canceled." % name)
+
+    def _wait_ready(self, slot, name):
+        # a new process sends READY once it can take work and be signaled
+        while not slot.ready:
+            msg = self._wait_for_reply(slot, name)
+            if msg[0] != PluginProcessWorker.READY:
+                return msg
+            self._cond.acquire()
+            try:
+                slot.ready = True
+                if slot.cancel_time is not None:
+                    return (PluginProcessWorker.ERROR,
+                            "The command %s was canceled." % name)
+            finally:
+                self._cond.release()
+        return None
+
+    def run(self, request_id, items_map, name, arguments):
+        """
+        Run a plugin in one of the processes.
+        :return: The reply document of the plugin.
+        :raises AgentPluginOperationException: The plugin failed, was
+        canceled or its process died.
+        """
+        wrk = (PluginProcessWorker.CMD_RUN, request_id,
+               _serializable_items(items_map), name, arguments,
+               _runtime_attributes(self._conf))
+        slot = self._checkout(request_id)
+        try:
+            error = self._wait_ready(slot, name)
+            if error is None:
+                try:
+                    slot.conn.send(wrk)
+                except (OSError, EOFError):
+                    # the process died while it was idle
+                    self._replace(slot)
+                    error = self._wait_ready(slot, name)
+                    if error is None:
+                        slot.conn.send(wrk)
+            if error is None:
+                self._cond.acquire()
+                try:
+                    self._runs += 1
+                finally:
+                    self._cond.release()
+                (reply_type, reply) = self._wait_for_reply(slot, name)
+            else:
+                (reply_type, reply) = error
+        finally:
+            self._checkin(slot)
+        if reply_type != PluginProcessWorker.REPLY:
+            raise AgentPluginOperationException(reply)
+        return reply
+
+    def cancel(self, request_id):
+        """
+        Cancel a request.  If it is running its plugin is told to cancel,
+        otherwise it fails as soon as it reaches the pool.  This does not
+        block.
+        """
+        self._cond.acquire()
+        try:
+            self._cancels += 1
+            slot = self._running.get(request_id)
+            if slot is None:
+                self._canceled[request_id] = True
+                if len(self._canceled) > _g_max_canceled:
+                    self._canceled.popitem(last=False)
+                return
+            if slot.cancel_time is not None:
+                return
+            slot.cancel_time = time.monotonic()
+            if not slot.ready:
+                # the process is still starting.  The request fails when
+                # it is ready
+                return
+            pid = slot.process.pid
+        finally:
+            self._cond.release()
+        _g_logger.info("Canceling request %s in plugin process %d"
+                       % (request_id, pid))
+        try:
+            os.kill(pid, PluginProcessWorker.CANCEL_SIGNAL)
+        except OSError as ex:
+            _g_logger.warning("Could not signal plugin process %d: %s"
+                              % (pid, str(ex)))
+
+    def stop(self):
+        """
+        Cancel the running plugins, wait for them to return and end every
+        process.
+        """
+        self._cond.acquire()
+        try:
+            self._stopping = True
+            running = list(self._running.keys())
+            self._cond.notifyAll()
+        finally:
+            self._cond.release()
+        for request_id in running:
+            self.cancel(request_id)
+
+        self._cond.acquire()
+        try:
+            while self._running:
+                self._cond.wait()
+            slots = self._slots
+            self._slots = []
+            self._idle = []
+        finally:
+            self._cond.release()
+
+        for slot in slots:
+            try:
+                slot.conn.send(None)
+            except (OSError, EOFError):
+                pass
+            slot.process.join(self._cancel_timeout)
+            slot.kill()
+
+    def get_stats(self):
+        self._cond.acquire()
+        try:
+            return {"processes": len(self._slots),
+                    "idle": len(self._idle),
+                    "busy": len(self._running),
+                    "runs": self._runs,
+                    "crashes": self._crashes,
+                    "cancels": self._cancels,
+                    "kills": self._kills}
+        finally:
+            self._cond.release()
@@ -15,7 +15,6 @@
 #
 import os
 
-import dcm.agent.messaging.persistence as persistence
 import dcm.agent.plugins.api.base as plugin_base
 import dcm.agent.plugins.api.utils as plugin_utils
 
@@ -43,7 +42,7 @@ class AddUser(plugin_base.ScriptPlugin):
                                    self.args.lastName,
                                    self.args.administrator.lower()]
         self.ssh_public_key = self.args.authentication
-        self._db = persistence.SQLiteAgentDB(conf.storage_dbfile)
+        self._db = conf.get_db()
 
     def run(self):
         key_file = self.conf.get_temp_file(self.args.userId + ".pub")
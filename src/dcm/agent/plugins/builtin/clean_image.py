@@ -20,7 +20,6 @@ import threading
 
 import dcm.agent.events.globals as events
 import dcm.agent.logger as dcm_logger
-from dcm.agent.messaging import persistence
 import dcm.agent.utils as utils
 import dcm.agent.plugins.api.base as plugin_base
 import dcm.agent.plugins.builtin.remove_user as remove_user
@@ -50,7 +49,7 @@ class CleanImage(plugin_base.Plugin):
             conf, job_id, items_map, name, arguments)
         self._done_event = threading.Event()
         self._topic_error = None
-        self._db = persistence.SQLiteAgentDB(conf.storage_dbfile)
+        self._db = conf.get_db()
 
     def run_scrubber(self, opts):
         exe = os.path.join(os.path.dirname(sys.executable),
@@ -18,6 +18,8 @@ import importlib
 import logging
 import os
 import re
+import threading
+import time
 
 from dcm.agent.plugins.api.exceptions import AgentPluginConfigException
 
@@ -36,19 +38,14 @@ def import_module(module_name):
 # we could use stevedore for this if we are ok with another dependency
 def load_python_module(
         module_name, conf, request_id, items_map, name, arguments):
+    # the module, its load function and the check of its protocol_arguments
+    # come from the preload cache
+    module_info = _get_module_info(module_name)
+    if module_info["error"] is not None:
+        raise AgentPluginConfigException(module_info["error"])
     try:
-        module = import_module(module_name)
-        _g_logger.debug("Module acquired " + str(dir(module)))
-        rc = module.load_plugin(conf, request_id, items_map, name, arguments)
-        return rc
-    except ImportError as iee:
-        raise AgentPluginConfigException(
-            "The module named %s could not be imported." % module_name, iee)
-    except AttributeError as ae:
-        _g_logger.exception("Could not load " + module_name)
-        raise AgentPluginConfigException(
-            "The module named %s does not have the load function."
-            % module_name, ae)
+        return module_info["load_plugin"](
+            conf, request_id, items_map, name, arguments)
     except:
         _g_logger.exception("An exception occurred loading the module")
         raise
@@ -85,88 +82,416 @@ def load_plugin(conf, items_map, request_id, name, arguments):
     return func(conf, request_id, items_map, name, arguments)
 
 
-def get_all_plugins(conf):
+# characters that make a section name a regular expression rather than a
+# plain plugin name
+_g_regex_chars = frozenset(".^$*+?{}[]\\|()")
+
+# how often in seconds a lookup checks if the configuration file changed
+_g_reload_check_interval = 2.0
+
+
+def _items_to_map(parser, section):
+    items_map = {}
+    for i in parser.items(section):
+        items_map[i[0]] = i[1]
+    return items_map
+
+
+class PluginRegistry(object):
+    """
+    The plugin configuration file parsed once into a dict of the plugin
+    sections that are plain names and a list of the few that are regular
+    expressions.  Looking up a command is then a dict lookup.  The file is
+    parsed again when its modification time or size changes (checked at
+    most every _g_reload_check_interval seconds) or after invalidate() is
+    called, which the agent does on SIGHUP.
+    """
+
+    def __init__(self, conffile,
+                 check_interval=_g_reload_check_interval):
+        self.conffile = conffile
+        self._check_interval = check_interval
+        self._lock = threading.Lock()
+        self._signature = None
+        self._next_check = 0.0
+        self._stale = True
+        # section name -> (file position, items_map or error string)
+        self._exact = {}
+        # (file position, compiled regex, section name, items_map or error)
+        self._patterns = []
+        self._plugins = {}
+        self._lookups = 0
+        self._misses = 0
+        self._lookup_time = 0.0
+        self._max_lookup_time = 0.0
+        self._loads = 0
+        self._load_time = 0.0
+
+    def invalidate(self):
+        """
+        Parse the file again at the next lookup.  This only sets a flag so
+        it is safe to call from a signal handler.
+        """
+        self._stale = True
+
+    def _get_signature(self):
+        try:
+            st = os.stat(self.conffile)
+        except OSError:
+            raise AgentPluginConfigException(
+                "The plugin configuration file %s could not be found"
+                % self.conffile)
+        return (st.st_mtime_ns, st.st_size)
+
+    def _check(self):
+        # This should only be called locked
+        now = time.monotonic()
+        if not self._stale and now < self._next_check:
+            return
+        self._next_check = now + self._check_interval
+        signature = self._get_signature()
+        if not self._stale and signature == self._signature:
+            return
+        self._stale = False
+        self._load(signature)
+
+    def _load(self, signature):
+        # This should only be called locked
+        start = time.monotonic()
+        parser = configparser.ConfigParser()
+        parser.read([self.conffile])
+
+        exact = {}
+        patterns = []
+        plugins = {}
+        for pos, s in enumerate(parser.sections()):
+            try:
+                items_map = _items_to_map(parser, s)
+            except configparser.Error as conf_ex:
+                items_map = str(conf_ex)
+            if not s.startswith("plugin:"):
+                pass
+            elif not isinstance(items_map, dict):
+                _g_logger.warn("The section %s could not be read: %s"
+                               % (s, items_map))
+            else:
+                if "type" not in items_map:
+                    _g_logger.warn("The section %s does not have an entry "
+                                   "for type." % s)
+                elif items_map["type"] not in _g_type_to_obj_map:
+                    _g_logger.warn("The module type %s is not valid."
+                                   % items_map["type"])
+                plugins[s[7:]] = items_map
+            if _g_regex_chars.intersection(s):
+                patterns.append((pos, re.compile(s + "$"), s, items_map))
+            else:
+                exact[s] = (pos, items_map)
+
+        self._exact = exact
+        self._patterns = patterns
+        self._plugins = plugins
+        self._signature = signature
+        self._loads += 1
+        self._load_time = time.monotonic() - start
+        _g_logger.info("Loaded %d plugin sections (%d patterns) from %s in "
+                       "%.4f seconds" % (len(exact) + len(patterns),
+                                         len(patterns), self.conffile,
+                                         self._load_time))
+
+    def _find(self, section_name):
+        # This should only be called locked.  The first section in the file
+        # that matches wins, like it did when every section was tried in
+        # order
+        pos, items_map = self._exact.get(section_name, (None, None))
+        for p_pos, p, s, p_items_map in self._patterns:
+            if pos is not None and p_pos > pos:
+                break
+            if p.match(section_name):
+                return s, p_items_map
+        if pos is None:
+            return None, None
+        return section_name, items_map
+
+    def lookup(self, name):
+        """
+        :param name: The command name.
+        :return: A copy of the items of the plugin section matching name.
+        """
+        start = time.monotonic()
+        section_name = 'plugin:' + name
+        self._lock.acquire()
+        try:
+            self._check()
+            s, items_map = self._find(section_name)
+            lookup_time = time.monotonic() - start
+            self._lookups += 1
+            self._lookup_time += lookup_time
+            if lookup_time > self._max_lookup_time:
+                self._max_lookup_time = lookup_time
+            if s is None:
+                self._misses += 1
+        finally:
+            self._lock.release()
+
+        if s is None:
+            raise AgentPluginConfigException(
+                "Plugin %s was not found." % name)
+        _g_logger.debug("load_plugin: found a match %s: %s"
+                        % (s, section_name))
+        if not isinstance(items_map, dict):
+            raise AgentPluginConfigException(items_map)
+        if "type" not in items_map:
+            raise AgentPluginConfigException(
+                "The section %s does not have an entry for type."
+                % section_name)
+        atype = items_map["type"]
+        if atype not in _g_type_to_obj_map:
+            raise AgentPluginConfigException(
+                "The module type %s is not valid." % atype)
+        # the dispatcher adds to the map it is given
+        return items_map.copy()
+
+    def get_all(self):
+        """
+        :return: A dict of every plugin section name, without the plugin:
+        prefix, to a copy of its items.
+        """
+        self._lock.acquire()
+        try:
+            self._check()
+            plugins = self._plugins
+        finally:
+            self._lock.release()
+        return dict((name, items_map.copy())
+                    for name, items_map in plugins.items())
+
+    def get_stats(self):
+        self._lock.acquire()
+        try:
+            return {
+                "loads": self._loads,
+                "load_time": self._load_time,
+                "lookups": self._lookups,
+                "misses": self._misses,
+                "lookup_time_mean": (self._lookup_time /
+                                     max(1, self._lookups)),
+                "lookup_time_max": self._max_lookup_time,
+            }
+        finally:
+            self._lock.release()
+
+
+_g_registries = {}
+_g_registries_lock = threading.Lock()
+
+
+def get_plugin_registry(conf):
+    """
+    :return: The process wide PluginRegistry of the plugin configuration
+    file named in conf.
+    """
     conffile = conf.plugin_configfile
-    if conffile is None or not os.path.exists(conffile):
+    if conffile is None:
         raise AgentPluginConfigException(
             "The plugin configuration file %s could not be found" % conffile)
+    _g_registries_lock.acquire()
+    try:
+        try:
+            return _g_registries[conffile]
+        except KeyError:
+            registry = PluginRegistry(conffile)
+            _g_registries[conffile] = registry
+            return registry
+    finally:
+        _g_registries_lock.release()
 
-    parser = configparser.SafeConfigParser()
-    parser.read([conffile])
-    section = parser.sections()
 
-    all_plugins = {}
-    for s in section:
-        if s.startswith("plugin:"):
-            try:
-                items = parser.items(s)
-                items_map = {}
-                for i in items:
-                    items_map[i[0]] = i[1]
+def invalidate_plugin_registries():
+    """
+    Have every registry parse its file again at its next lookup.
+    """
+    for registry in list(_g_registries.values()):
+        registry.invalidate()
 
-                if "type" not in items_map:
-                    _g_logger.warn("The section %s does not have an entry "
-                                   "for type." % s)
-                atype = items_map["type"]
-                if atype not in _g_type_to_obj_map:
-                    _g_logger.warn(
-                        "The module type %s is not valid." % atype)
-                all_plugins[s[7:]] = items_map
-            except configparser.NoOptionError as conf_ex:
-                raise AgentPluginConfigException(str(conf_ex))
-    return all_plugins
+
+def get_plugin_registry_stats():
+    """
+    :return: A dict of each configuration file to the stats of its registry.
+    """
+    return dict((conffile, registry.get_stats())
+                for conffile, registry in list(_g_registries.items()))
+
+
+def get_all_plugins(conf):
+    return get_plugin_registry(conf).get_all()
 
 
 def parse_plugin_doc(conf, name):
     _g_logger.debug("ENTER load_plugin")
+    return get_plugin_registry(conf).lookup(name)
+
+
+_g_preload_results = {}
+_g_preload_lock = threading.Lock()
+# cleared while a preload is running
+_g_preload_done = threading.Event()
+_g_preload_done.set()
+
+
+def _find_protocol_arguments(module):
+    # the plugin class is found the way gen_docs finds it, preferring the
+    # Plugin subclasses the module defines itself
+    candidates = []
+    for thing in dir(module):
+        o = getattr(module, thing)
+        if getattr(o, 'protocol_arguments', None) is None:
+            continue
+        if getattr(o, '__module__', None) == module.__name__:
+            candidates.insert(0, o)
+        else:
+            candidates.append(o)
+    if not candidates:
+        return {}
+    return candidates[0].protocol_arguments
 
-    conffile = conf.plugin_configfile
-    if conffile is None or not os.path.exists(conffile):
-        raise AgentPluginConfigException(
-            "The plugin configuration file %s could not be found" % conffile)
-
-    parser = configparser.SafeConfigParser()
-    parser.read([conffile])
-    section = parser.sections()
 
-    section_name = 'plugin:' + name
-    for s in section:
-        p = re.compile(s + "$")
-        if p.match(section_name):
-            _g_logger.debug(
-                "load_plugin: found a match %s: %s" % (s, section_name))
+def _validate_protocol_arguments(protocol_arguments):
+    for arg, entry in protocol_arguments.items():
+        if not isinstance(entry, tuple) or len(entry) != 4:
+            return ("The protocol argument %s is not a (help, mandatory, "
+                    "type, default) tuple." % arg)
+        if not callable(entry[2]):
+            return ("The type of the protocol argument %s is not callable."
+                    % arg)
+    return None
 
-            try:
-                items = parser.items(s)
-                items_map = {}
-                for i in items:
-                    items_map[i[0]] = i[1]
 
-                if "type" not in items_map:
-                    raise AgentPluginConfigException(
-                        "The section %s does not have an entry for type."
-                        % section_name)
-                atype = items_map["type"]
-                if atype not in _g_type_to_obj_map:
-                    raise AgentPluginConfigException(
-                        "The module type %s is not valid." % atype)
+def _preload_module(module_name):
+    start = time.monotonic()
+    module = None
+    load_func = None
+    protocol_arguments = None
+    try:
+        module = import_module(module_name)
+        load_func = getattr(module, 'load_plugin', None)
+        if not callable(load_func):
+            error = ("The module named %s does not have the load function."
+                     % module_name)
+        else:
+            protocol_arguments = _find_protocol_arguments(module)
+            error = _validate_protocol_arguments(protocol_arguments)
+    except Exception as ex:
+        error = "The module named %s could not be imported: %s" % (
+            module_name, str(ex))
+    return {"module": module,
+            "load_plugin": load_func,
+            "get_features": getattr(module, 'get_features', None),
+            "protocol_arguments": protocol_arguments,
+            "import_time": time.monotonic() - start,
+            "error": error}
+
+
+def _get_module_info(module_name):
+    # a module that could not be imported is tried again, an extra package
+    # may have been installed since
+    _g_preload_lock.acquire()
+    try:
+        module_info = _g_preload_results.get(module_name)
+    finally:
+        _g_preload_lock.release()
+    if module_info is None or module_info["module"] is None:
+        module_info = _preload_module(module_name)
+        _g_preload_lock.acquire()
+        try:
+            _g_preload_results[module_name] = module_info
+        finally:
+            _g_preload_lock.release()
+    return module_info
+
+
+def preload_plugins(conf):
+    """
+    Import and check the module of every python_module plugin in the plugin
+    configuration so that the first request for each command does not pay
+    for the import.  The module, its protocol_arguments and its import time
+    are cached.  Loading a plugin and building the handshake features read
+    the cache.
+    :return: A dict of each plugin that could not be loaded to the reason.
+    """
+    start = time.monotonic()
+    failures = {}
+    modules = set()
+    for name, items_map in sorted(get_all_plugins(conf).items()):
+        if items_map.get("type") != "python_module":
+            continue
+        module_name = items_map.get("module_name")
+        if module_name is None:
+            failures[name] = ("The configuration for the %s plugin does not "
+                              "contain a module_name entry." % name)
+            continue
+        result = _get_module_info(module_name)
+        modules.add(module_name)
+        if result["error"] is not None:
+            failures[name] = result["error"]
+
+    _g_logger.info("Preloaded %d plugin modules in %.3f seconds, %d plugins "
+                   "failed to load." % (len(modules),
+                                        time.monotonic() - start,
+                                        len(failures)))
+    return failures
+
+
+def begin_preload():
+    """
+    Mark a preload as running.  preload_finished() is False until
+    end_preload() is called.
+    """
+    _g_preload_done.clear()
+
+
+def end_preload():
+    _g_preload_done.set()
+
+
+def preload_finished():
+    return _g_preload_done.is_set()
+
+
+def get_preload_results():
+    """
+    :return: A dict of each preloaded module name to a dict of its
+    import_time, protocol_arguments and error.
+    """
+    _g_preload_lock.acquire()
+    try:
+        return dict((k, {"import_time": v["import_time"],
+                         "protocol_arguments": v["protocol_arguments"],
+                         "error": v["error"]})
+                    for k, v in _g_preload_results.items())
+    finally:
+        _g_preload_lock.release()
 
-                return items_map
-            except configparser.NoOptionError as conf_ex:
-                raise AgentPluginConfigException(str(conf_ex))
 
-    raise AgentPluginConfigException(
-        "Plugin %s was not found." % name)
+def get_protocol_arguments(module_name):
+    """
+    :return: The protocol_arguments of a plugin module, or None if it could
+    not be loaded.
+    """
+    return _get_module_info(module_name)["protocol_arguments"]
 
 
 def get_module_features(conf, plugin_name, items_map):
     if items_map['type'] != 'python_module':
         return {}
+    module_info = _get_module_info(items_map['module_name'])
+    if module_info["module"] is None:
+        _g_logger.error("The agent is miss configured " +
+                        module_info["error"])
+        raise AgentPluginConfigException(module_info["error"])
+    get_features_func = module_info["get_features"]
+    if get_features_func is None:
+        return {}
     try:
-        module = import_module(items_map['module_name'])
-        get_features_func = getattr(module, 'get_features', None)
-        if get_features_func is None:
-            return {}
         return get_features_func(conf)
     except BaseException as ex:
         _g_logger.error("The agent is miss configured " + str(ex))
@@ -0,0 +1,110 @@
+#
+#  Copyright (C) 2014 Dell, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+Compare the EventSpace schedulers with many outstanding timers.  Each run
+registers the timers with delays spread over a minute (like message
+retransmit timers), cancels most of them the way an acked message cancels
+its retransmit, and then times poll() calls that find nothing ready and
+calls that each run a short timer.
+
+    python -m dcm.agent.tests.benchmarks.bench_event_space -n 10000,100000
+"""
+import argparse
+import random
+import sys
+import time
+
+import dcm.agent.events.callback as events
+
+
+_g_schedulers = [
+    ("heap", events.HeapScheduler),
+    ("timing wheel", events.TimingWheel),
+]
+
+
+def _noop():
+    pass
+
+
+def run_scheduler(scheduler_cls, timer_count, cancel_fraction, polls):
+    event_space = events.EventSpace(scheduler=scheduler_cls())
+    rand = random.Random(0)
+    delays = [1.0 + rand.random() * 59.0 for _ in range(timer_count)]
+
+    start = time.perf_counter()
+    handles = [event_space.register_callback(_noop, delay=d)
+               for d in delays]
+    register_time = time.perf_counter() - start
+
+    to_cancel = handles[:int(timer_count * cancel_fraction)]
+    start = time.perf_counter()
+    for ub in to_cancel:
+        event_space.cancel_callback(ub)
+    cancel_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in range(polls):
+        event_space.poll(timeblock=0.0)
+    idle_poll_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in range(polls):
+        event_space.register_callback(_noop)
+        event_space.poll(timeblock=0.0)
+    busy_poll_time = time.perf_counter() - start
+
+    return {
+        "register_us": register_time / timer_count * 1000000.0,
+        "cancel_us": cancel_time / max(1, len(to_cancel)) * 1000000.0,
+        "idle_poll_us": idle_poll_time / polls * 1000000.0,
+        "busy_poll_us": busy_poll_time / polls * 1000000.0,
+    }
+
+
+def _int_list(value):
+    return [int(v) for v in value.split(",") if v]
+
+
+def main(argv=sys.argv[1:]):
+    parser = argparse.ArgumentParser(
+        description="Benchmark the EventSpace schedulers.")
+    parser.add_argument("-n", "--timers", type=_int_list,
+                        default=[10000, 100000],
+                        help="A comma separated list of the number of "
+                             "outstanding timers.")
+    parser.add_argument("-c", "--cancel", type=float, default=0.9,
+                        help="The fraction of the timers that are "
+                             "canceled.")
+    parser.add_argument("-p", "--polls", type=int, default=2000)
+    args = parser.parse_args(argv)
+
+    print("%-14s %8s %12s %12s %14s %14s"
+          % ("scheduler", "timers", "register us", "cancel us",
+             "idle poll us", "busy poll us"))
+    for timer_count in args.timers:
+        for name, scheduler_cls in _g_schedulers:
+            res = run_scheduler(
+                scheduler_cls, timer_count, args.cancel, args.polls)
+            print("%-14s %8d %12.2f %12.2f %14.2f %14.2f"
+                  % (name, timer_count, res["register_us"],
+                     res["cancel_us"], res["idle_poll_us"],
+                     res["busy_poll_us"]))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
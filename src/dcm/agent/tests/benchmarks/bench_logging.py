@@ -0,0 +1,95 @@
+#
+#  Copyright (C) 2014 Dell, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+Measure logging throughput with and without the RequestFilter that adds
+the request fields to every record.  The records are formatted with the
+agent format and thrown away so that only the logging path is timed.  Each
+run also times entering and leaving a RequestTracer the way the messaging
+code does for every ack and reply.  The best of a few runs is reported.
+
+    python -m dcm.agent.tests.benchmarks.bench_logging -n 100000
+"""
+import argparse
+import logging
+import sys
+import time
+
+import dcm.eventlog.tracer as tracer
+
+
+_g_format = ("%(levelname)s %(asctime)s [%(name)s] %(filename)s:%(lineno)d "
+             "[(REQUEST=%(dcm_request_id)s)] %(message)s")
+
+
+class _DiscardHandler(logging.Handler):
+    def emit(self, record):
+        self.format(record)
+
+
+def _make_logger(name, use_filter):
+    logger = logging.getLogger(name)
+    logger.propagate = False
+    logger.setLevel(logging.DEBUG)
+    handler = _DiscardHandler()
+    if use_filter:
+        handler.addFilter(tracer.RequestFilter())
+        handler.setFormatter(logging.Formatter(_g_format))
+    else:
+        handler.setFormatter(logging.Formatter(
+            _g_format.replace("%(dcm_request_id)s", "None")))
+    logger.addHandler(handler)
+    return logger
+
+
+def run_logging(logger, records):
+    start = time.perf_counter()
+    with tracer.RequestTracer("bench-request", command_name="bench"):
+        for i in range(records):
+            logger.debug("record %d", i)
+    return records / (time.perf_counter() - start)
+
+
+def run_tracers(count):
+    start = time.perf_counter()
+    for i in range(count):
+        with tracer.RequestTracer("bench-request", plugin_name="bench"):
+            pass
+    return count / (time.perf_counter() - start)
+
+
+def main(argv=sys.argv[1:]):
+    parser = argparse.ArgumentParser(
+        description="Benchmark logging through the RequestFilter.")
+    parser.add_argument("-n", "--records", type=int, default=100000,
+                        help="The number of records logged in each run.")
+    parser.add_argument("-r", "--repeat", type=int, default=5,
+                        help="The best of this many runs is reported.")
+    args = parser.parse_args(argv)
+
+    print("%-20s %14s" % ("run", "per second"))
+    for name, use_filter in [("filter off", False), ("filter on", True)]:
+        logger = _make_logger("bench_logging." + name.replace(" ", "_"),
+                              use_filter)
+        rate = max(run_logging(logger, args.records)
+                   for _ in range(args.repeat))
+        print("%-20s %14.0f" % (name, rate))
+    rate = max(run_tracers(args.records) for _ in range(args.repeat))
+    print("%-20s %14.0f" % ("tracer enter/exit", rate))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
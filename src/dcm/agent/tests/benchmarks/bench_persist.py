@@ -0,0 +1,105 @@
+#
+#  Copyright (C) 2014 Dell, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+Measure the throughput of the request state transitions that ReplyRPC
+drives through the agent database (ack, reply, reply acked plus a lookup
+for every message) with many threads at once.  Each connection and commit
+mode of SQLiteAgentDB is run against its own temporary file.
+
+    python -m dcm.agent.tests.benchmarks.bench_persist -t 8 -r 200
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+import dcm.agent.messaging.persistence as persistence
+import dcm.agent.messaging.states as messaging_states
+
+
+def _remove_db_files(db_file):
+    for f in [db_file, db_file + "-wal", db_file + "-shm"]:
+        if os.path.exists(f):
+            os.remove(f)
+
+
+def _request_life_cycle(db, agent_id, count):
+    for _ in range(count):
+        request_id = str(uuid.uuid4())
+        request_doc = {"request_id": request_id,
+                       "payload": {"command": "heartbeat",
+                                   "arguments": {}}}
+        db.new_record(request_id, request_doc, None,
+                      messaging_states.ReplyStates.ACKED, agent_id)
+        db.lookup_req(request_id)
+        db.update_record(request_id, messaging_states.ReplyStates.REPLY,
+                         reply_doc={"return_code": 0})
+        db.lookup_req(request_id)
+        db.update_state(request_id,
+                        messaging_states.ReplyStates.REPLY_ACKED)
+
+
+_g_db_modes = [
+    ("single connection", {}),
+    ("thread connections", {"thread_connections": True}),
+    ("group commit", {"group_commit_window": 0.002}),
+    ("group commit wal", {"thread_connections": True,
+                          "group_commit_window": 0.002}),
+]
+
+
+def run_ack_reply(db_kwargs, thread_count, requests_per_thread):
+    _, db_file = tempfile.mkstemp("bench_db")
+    try:
+        db = persistence.SQLiteAgentDB(db_file, **db_kwargs)
+        agent_id = str(uuid.uuid4())
+        threads = [threading.Thread(target=_request_life_cycle,
+                                    args=(db, agent_id, requests_per_thread))
+                   for _ in range(thread_count)]
+        start = time.time()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.time() - start
+        db.close()
+    finally:
+        _remove_db_files(db_file)
+    return thread_count * requests_per_thread / elapsed
+
+
+def main(argv=sys.argv[1:]):
+    parser = argparse.ArgumentParser(
+        description="Benchmark concurrent ack/reply throughput of the "
+                    "agent database.")
+    parser.add_argument("-t", "--threads", type=int, default=8)
+    parser.add_argument("-r", "--requests", type=int, default=200,
+                        help="The number of requests each thread runs "
+                             "through the ack/reply cycle.")
+    args = parser.parse_args(argv)
+
+    for name, db_kwargs in _g_db_modes:
+        rate = run_ack_reply(db_kwargs, args.threads, args.requests)
+        print("%-20s %4d threads %10.1f requests/sec"
+              % (name, args.threads, rate))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,301 @@
+#
+#  Copyright (C) 2014 Dell, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+Measure the single operations of SQLiteAgentDB against a temporary file
+that has been filled to a given number of requests and alerts.  Every
+operation is run by 1, 4 and 16 threads at once and the throughput and
+latency percentiles are written out as JSON so that runs from different
+agent releases can be compared.
+
+    python -m dcm.agent.tests.benchmarks.bench_persist_ops \
+        -s 1000,100000 -n 200 -o persist.json
+
+The filled tables hold 1% of the requests in the REPLY state and the rest
+REPLY_ACKED, which is close to what a long running agent has.
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+import dcm.agent
+import dcm.agent.messaging.persistence as persistence
+import dcm.agent.messaging.states as messaging_states
+
+
+_g_operations = ["new_record", "update_record", "lookup_req",
+                 "get_all_reply", "clean_all_expired", "add_alert"]
+_g_fill_batch = 10000
+
+
+def _remove_db_files(db_file):
+    for f in [db_file, db_file + "-wal", db_file + "-shm"]:
+        if os.path.exists(f):
+            os.remove(f)
+
+
+def _request_id(i):
+    return "request-%d" % i
+
+
+def _fill_db(db, rows, agent_id, start_time):
+    """
+    Load rows requests and rows alerts in large transactions.  Going
+    through new_record would take hours for the biggest tables.  The
+    last_update_time of request i is start_time plus i milliseconds.
+    """
+    insert_req = ("INSERT INTO requests(request_id, creation_time, "
+                  "reply_doc, state, agent_id, last_update_time) "
+                  "VALUES(?, ?, ?, ?, ?, ?)")
+    insert_doc = ("INSERT INTO request_docs(request_id, request_doc) "
+                  "VALUES(?, ?)")
+    insert_alert = ("INSERT INTO alerts(alert_time, added_time, alert_hash, "
+                    "level, rule, subject, message) "
+                    "VALUES(?, ?, ?, ?, ?, ?, ?)")
+    reply_doc = json.dumps({"return_code": 0, "message": "done"})
+
+    for first in range(0, rows, _g_fill_batch):
+        batch = range(first, min(first + _g_fill_batch, rows))
+
+        def do_it(cursor):
+            reqs = []
+            docs = []
+            alerts = []
+            for i in batch:
+                request_id = _request_id(i)
+                tm = start_time + datetime.timedelta(milliseconds=i)
+                if i % 100 == 0:
+                    state = messaging_states.ReplyStates.REPLY
+                else:
+                    state = messaging_states.ReplyStates.REPLY_ACKED
+                reqs.append((request_id, tm, reply_doc, state, agent_id, tm))
+                docs.append((request_id, json.dumps(
+                    {"request_id": request_id,
+                     "payload": {"command": "get_agent_data",
+                                 "arguments": {}}})))
+                alerts.append((i, i, "fill-%d" % i, 3, 5501,
+                               "Login session opened.", "message"))
+            cursor.executemany(insert_req, reqs)
+            cursor.executemany(insert_doc, docs)
+            cursor.executemany(insert_alert, alerts)
+        db._execute_write(do_it)
+
+
+class _OpRunner(object):
+    """
+    Build the callable for one operation.  Each call is a single use of
+    the db method with arguments that make sense for a table of rows
+    requests.
+    """
+
+    def __init__(self, db, rows, agent_id, start_time):
+        self._db = db
+        self._rows = rows
+        self._agent_id = agent_id
+        self._start_time = start_time
+        self._lock = threading.Lock()
+        self._clean_count = 0
+
+    def new_record(self):
+        request_id = str(uuid.uuid4())
+        request_doc = {"request_id": request_id,
+                       "payload": {"command": "heartbeat", "arguments": {}}}
+        self._db.new_record(request_id, request_doc, None,
+                            messaging_states.ReplyStates.ACKED,
+                            self._agent_id)
+
+    def _existing_id(self):
+        return _request_id(random.randint(0, self._rows - 1))
+
+    def update_record(self):
+        self._db.update_record(self._existing_id(),
+                               messaging_states.ReplyStates.REPLY,
+                               reply_doc={"return_code": 0})
+
+    def lookup_req(self):
+        self._db.lookup_req(self._existing_id())
+
+    def get_all_reply(self):
+        self._db.get_all_reply()
+
+    def clean_all_expired(self):
+        # every call moves the cut off forward so that each sweep finds
+        # about one old request to delete, like the periodic cleaner
+        self._lock.acquire()
+        try:
+            self._clean_count += 1
+            count = self._clean_count
+        finally:
+            self._lock.release()
+        cut_off = self._start_time + datetime.timedelta(milliseconds=count)
+        self._db.clean_all_expired(cut_off)
+
+    def add_alert(self):
+        tm = int(time.time() * 1000)
+        self._db.add_alert(tm, tm, str(uuid.uuid4()), 3, 5501,
+                           "Login session opened.", "message")
+
+
+def _percentile(sorted_values, fraction):
+    i = int(round(fraction * (len(sorted_values) - 1)))
+    return sorted_values[i]
+
+
+def run_operation(op_func, thread_count, ops_per_thread):
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+
+    def _worker():
+        mine = []
+        try:
+            for _ in range(ops_per_thread):
+                start = time.perf_counter()
+                op_func()
+                mine.append(time.perf_counter() - start)
+        except Exception as ex:
+            errors.append(ex)
+        lock.acquire()
+        try:
+            latencies.extend(mine)
+        finally:
+            lock.release()
+
+    threads = [threading.Thread(target=_worker) for _ in range(thread_count)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+    if errors:
+        raise errors[0]
+
+    latencies.sort()
+    return {
+        "ops": len(latencies),
+        "seconds": elapsed,
+        "ops_per_sec": len(latencies) / elapsed,
+        "p50_ms": _percentile(latencies, 0.50) * 1000.0,
+        "p99_ms": _percentile(latencies, 0.99) * 1000.0,
+    }
+
+
+def run_table_size(rows, thread_counts, ops_per_thread, operations,
+                   db_kwargs):
+    _, db_file = tempfile.mkstemp("bench_db")
+    results = []
+    try:
+        db = persistence.SQLiteAgentDB(db_file, **db_kwargs)
+        agent_id = str(uuid.uuid4())
+        start_time = datetime.datetime.now() - datetime.timedelta(days=1)
+        fill_start = time.perf_counter()
+        _fill_db(db, rows, agent_id, start_time)
+        sys.stderr.write("filled %d rows in %.1f seconds\n"
+                         % (rows, time.perf_counter() - fill_start))
+
+        runner = _OpRunner(db, rows, agent_id, start_time)
+        for op_name in operations:
+            for thread_count in thread_counts:
+                res = run_operation(getattr(runner, op_name),
+                                    thread_count, ops_per_thread)
+                res.update({"operation": op_name,
+                            "rows": rows,
+                            "threads": thread_count})
+                sys.stderr.write(
+                    "%-18s %8d rows %3d threads %10.1f ops/sec "
+                    "p50 %8.3f ms p99 %8.3f ms\n"
+                    % (op_name, rows, thread_count, res["ops_per_sec"],
+                       res["p50_ms"], res["p99_ms"]))
+                results.append(res)
+        db.close()
+    finally:
+        _remove_db_files(db_file)
+    return results
+
+
+def _int_list(value):
+    return [int(v) for v in value.split(",") if v]
+
+
+def main(argv=sys.argv[1:]):
+    parser = argparse.ArgumentParser(
+        description="Benchmark the operations of the agent database and "
+                    "write the results as JSON.")
+    parser.add_argument("-s", "--sizes", type=_int_list,
+                        default=[1000, 100000, 1000000],
+                        help="A comma separated list of table sizes.")
+    parser.add_argument("-t", "--threads", type=_int_list,
+                        default=[1, 4, 16],
+                        help="A comma separated list of thread counts.")
+    parser.add_argument("-n", "--ops", type=int, default=200,
+                        help="The number of operations each thread runs.")
+    parser.add_argument("-p", "--operations", default=",".join(_g_operations),
+                        help="A comma separated list of the operations to "
+                             "run.  The choices are %s."
+                             % ", ".join(_g_operations))
+    parser.add_argument("--thread-connections", action="store_true")
+    parser.add_argument("--group-commit-ms", type=float, default=None)
+    parser.add_argument("--cache-size", type=int, default=0)
+    parser.add_argument("-o", "--output", default=None,
+                        help="Write the JSON results to this file instead "
+                             "of stdout.")
+    args = parser.parse_args(argv)
+
+    operations = [o for o in args.operations.split(",") if o]
+    for op_name in operations:
+        if op_name not in _g_operations:
+            parser.error("Unknown operation %s" % op_name)
+
+    db_kwargs = {"thread_connections": args.thread_connections,
+                 "cache_size": args.cache_size}
+    if args.group_commit_ms is not None:
+        db_kwargs["group_commit_window"] = args.group_commit_ms / 1000.0
+
+    results = []
+    for rows in args.sizes:
+        results.extend(run_table_size(
+            rows, args.threads, args.ops, operations, db_kwargs))
+
+    report = {
+        "benchmark": "persistence",
+        "agent_version": dcm.agent.g_version,
+        "python_version": platform.python_version(),
+        "sqlite_version": sqlite3.sqlite_version,
+        "time": datetime.datetime.utcnow().isoformat() + "Z",
+        "db_kwargs": db_kwargs,
+        "ops_per_thread": args.ops,
+        "results": results,
+    }
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output is None:
+        print(output)
+    else:
+        with open(args.output, "w") as fptr:
+            fptr.write(output + "\n")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
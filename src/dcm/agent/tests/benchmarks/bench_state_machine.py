@@ -0,0 +1,82 @@
+#
+#  Copyright (C) 2014 Dell, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+Measure StateMachine transitions per second.  The machine cycles through
+the same states a reply does (new, acked, replied, done) with a small
+handler on each transition, once with debug logging off as the agent
+normally runs and once with it on.
+
+    python -m dcm.agent.tests.benchmarks.bench_state_machine -n 200000
+"""
+import argparse
+import logging
+import sys
+import time
+
+import dcm.agent.events.state_machine as state_machine
+
+
+_g_cycle = [("NEW", "ack", "ACKED"),
+            ("ACKED", "reply", "REPLIED"),
+            ("REPLIED", "reply_ack", "DONE"),
+            ("DONE", "restart", "NEW")]
+
+
+class _DiscardHandler(logging.Handler):
+    def emit(self, record):
+        self.format(record)
+
+
+def _handler(**kwargs):
+    pass
+
+
+def run_transitions(logger, transitions):
+    sm = state_machine.StateMachine("NEW", logger=logger)
+    for state, event, new_state in _g_cycle:
+        sm.add_transition(state, event, new_state, _handler)
+    events = [event for _, event, _ in _g_cycle]
+
+    start = time.perf_counter()
+    for i in range(transitions // len(events)):
+        for event in events:
+            sm.event_occurred(event, message_id="1234")
+    return transitions / (time.perf_counter() - start)
+
+
+def main(argv=sys.argv[1:]):
+    parser = argparse.ArgumentParser(
+        description="Benchmark StateMachine transitions.")
+    parser.add_argument("-n", "--transitions", type=int, default=200000)
+    parser.add_argument("-r", "--repeat", type=int, default=5,
+                        help="The best of this many runs is reported.")
+    args = parser.parse_args(argv)
+
+    logger = logging.getLogger("bench_state_machine")
+    logger.propagate = False
+    logger.addHandler(_DiscardHandler())
+
+    print("%-14s %16s" % ("debug", "transitions/sec"))
+    for name, level in [("off", logging.INFO), ("on", logging.DEBUG)]:
+        logger.setLevel(level)
+        rate = max(run_transitions(logger, args.transitions)
+                   for _ in range(args.repeat))
+        print("%-14s %16.0f" % (name, rate))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -169,6 +169,12 @@ class TestProgramOptions(unittest.TestCase):
             def get_all_reply_nacked(self):
                 return []
 
+            def get_counters(self):
+                return {}
+
+            def get_db_size(self):
+                return 0
+
         fake_db.return_value = FakeDB()
         id_platform.return_value = ("ubuntu", "14.04")
         guess_effective_cloud_mock.return_value = "Other"
@@ -202,6 +208,12 @@ class TestProgramOptions(unittest.TestCase):
             def get_all_reply_nacked(self):
                 return []
 
+            def get_counters(self):
+                return {}
+
+            def get_db_size(self):
+                return 0
+
         fake_db.return_value = FakeDB()
         id_platform.return_value = ("ubuntu", "14.04")
         guess_effective_cloud_mock.return_value = "Other"
@@ -235,6 +247,12 @@ class TestProgramOptions(unittest.TestCase):
             def get_all_reply_nacked(self):
                 return []
 
+            def get_counters(self):
+                return {}
+
+            def get_db_size(self):
+                return 0
+
         fake_db.return_value = FakeDB()
         id_platform.return_value = ("ubuntu", "14.04")
         guess_effective_cloud_mock.return_value = "Other"
@@ -268,6 +286,12 @@ class TestProgramOptions(unittest.TestCase):
             def get_all_reply_nacked(self):
                 return []
 
+            def get_counters(self):
+                return {}
+
+            def get_db_size(self):
+                return 0
+
         fake_db.return_value = FakeDB()
         id_platform.return_value = ("ubuntu", "14.04")
         guess_effective_cloud_mock.return_value = "Other"
@@ -301,6 +325,12 @@ class TestProgramOptions(unittest.TestCase):
             def get_all_reply_nacked(self):
                 return []
 
+            def get_counters(self):
+                return {}
+
+            def get_db_size(self):
+                return 0
+
         fake_db.return_value = FakeDB()
         id_platform.return_value = ("ubuntu", "14.04")
         guess_effective_cloud_mock.return_value = "Other"
@@ -334,6 +364,12 @@ class TestProgramOptions(unittest.TestCase):
             def get_all_reply_nacked(self):
                 return [FakeRequest({'command': 'initialize'})]
 
+            def get_counters(self):
+                return {}
+
+            def get_db_size(self):
+                return 0
+
         fake_db.return_value = FakeDB()
         id_platform.return_value = ("ubuntu", "14.04")
         guess_effective_cloud_mock.return_value = "Other"
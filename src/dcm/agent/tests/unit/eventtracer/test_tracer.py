@@ -28,3 +28,57 @@ class TestEventTracer(unittest.TestCase):
         logger.addFilter(filter)
         with tracer.RequestTracer("12345"):
             logger.error("A log record")
+
+    def test_record_fields(self):
+        records = []
+
+        class _Handler(logging.Handler):
+            def emit(self, record):
+                records.append(record)
+
+        logger = logging.getLogger(__name__ + ".fields")
+        logger.propagate = False
+        logger.setLevel(logging.DEBUG)
+        logger.addFilter(tracer.RequestFilter())
+        logger.addHandler(_Handler())
+
+        logger.info("outside")
+        with tracer.RequestTracer("outer", command_name="cmd"):
+            logger.info("outer")
+            with tracer.RequestTracer("inner", message_doc={
+                    "type": "COMMAND", "message_id": "m1"}):
+                logger.info("inner")
+            logger.info("outer again")
+
+        self.assertEqual(
+            ["None", "outer", "inner", "outer"],
+            [r.dcm_request_id for r in records])
+        self.assertEqual("cmd", records[1].dcm_command_name)
+        self.assertEqual("COMMAND", records[2].dcm_message_type)
+        self.assertEqual("m1", records[2].dcm_message_id)
+        self.assertEqual("None", records[3].dcm_message_id)
+
+    def test_trace_records_only_when_enabled(self):
+        records = []
+
+        class _Handler(logging.Handler):
+            def emit(self, record):
+                records.append(record)
+
+        event_logger = logging.getLogger("dcm.eventlog.tracer")
+        handler = _Handler(level=tracer.TRACE_LEVEL)
+        old_level = event_logger.level
+        event_logger.addHandler(handler)
+        try:
+            event_logger.setLevel(logging.DEBUG)
+            with tracer.RequestTracer("12345"):
+                pass
+            self.assertEqual([], records)
+
+            event_logger.setLevel(tracer.TRACE_LEVEL)
+            with tracer.RequestTracer("12345"):
+                pass
+            self.assertEqual(2, len(records))
+        finally:
+            event_logger.removeHandler(handler)
+            event_logger.setLevel(old_level)
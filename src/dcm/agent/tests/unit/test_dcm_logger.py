@@ -16,7 +16,11 @@
 import getpass
 import logging
 import os
+import shutil
+import signal
 import tempfile
+import threading
+import time
 import unittest
 import urllib.parse
 import uuid
@@ -59,6 +63,8 @@ class TestLoggingClear(unittest.TestCase):
 
     def test_basic_log_clear(self):
         self._logger.info("TEST LOG LINE")
+        # the file handlers write from a background thread
+        logger.flush_logs()
         start_size = os.stat(self.base_log_file).st_size
         self.assertGreater(start_size, 0)
         logger.delete_logs()
@@ -66,6 +72,7 @@ class TestLoggingClear(unittest.TestCase):
         self.assertEqual(end_size, 0)
         # then keep logging
         self._logger.info("MORE TEST LOG LINES")
+        logger.flush_logs()
         final_size = os.stat(self.base_log_file).st_size
         self.assertGreater(final_size, 0)
 
@@ -108,3 +115,276 @@ class TestLoggingClear(unittest.TestCase):
         self.assertEqual(log_dict['type'], "LOG")
         self.assertEqual(log_dict['level'], "ERROR")
         self.assertEqual(urllib.parse.unquote(log_dict['message']), msg)
+
+
+class TestDcmLoggerBatching(unittest.TestCase):
+
+    def setUp(self):
+        self._logger = logging.getLogger(str(uuid.uuid4()))
+        self._logger.propagate = False
+        self._logger.setLevel(logging.DEBUG)
+        self._conn = mock.Mock()
+
+    def _handler(self, **kwargs):
+        handler = logger.dcmLogger(**kwargs)
+        self._logger.addHandler(handler)
+        self.addCleanup(self._logger.removeHandler, handler)
+        self.addCleanup(handler.set_conn, None, None)
+        return handler
+
+    def _sent(self):
+        return [args[0] for args, _ in self._conn.send.call_args_list]
+
+    def test_records_sent_in_one_message(self):
+        handler = self._handler(rate_limits={})
+        handler.set_conn(mock.Mock(), self._conn)
+        for i in range(5):
+            self._logger.info("message %d", i)
+        self._logger.error("the error")
+        handler.flush()
+        dcm_events.poll(timeblock=0.0)
+
+        sent = self._sent()
+        self.assertEqual(len(sent), 1)
+        log_dict = sent[0]
+        self.assertEqual(log_dict['type'], "LOG")
+        self.assertEqual(log_dict['level'], "ERROR")
+        self.assertEqual(len(log_dict['records']), 6)
+        self.assertEqual(
+            urllib.parse.unquote(log_dict['message']).split("\n"),
+            ["message %d" % i for i in range(5)] + ["the error"])
+        self.assertEqual(handler.get_stats()["sent_records"], 6)
+
+    def test_batch_size_flush(self):
+        handler = self._handler(batch_size=10, flush_interval=60,
+                                rate_limits={})
+        handler.set_conn(mock.Mock(), self._conn)
+        for i in range(25):
+            self._logger.info("message %d", i)
+        dcm_events.poll(timeblock=0.0)
+        sent = self._sent()
+        self.assertEqual([len(s['records']) for s in sent], [10, 10, 5])
+
+    def test_flush_interval(self):
+        handler = self._handler(flush_interval=0.05)
+        handler.set_conn(mock.Mock(), self._conn)
+        self._logger.warning("a warning")
+        dcm_events.poll(timeblock=0.0)
+        self.assertEqual(self._sent(), [])
+        dcm_events.poll(timeblock=0.2)
+        self.assertEqual(len(self._sent()), 1)
+
+    def test_duplicates_coalesced(self):
+        handler = self._handler()
+        for _ in range(50):
+            self._logger.warning("disk is full")
+        self._logger.warning("disk is ok")
+        handler.set_conn(mock.Mock(), self._conn)
+        dcm_events.poll(timeblock=0.0)
+
+        records = self._sent()[0]['records']
+        self.assertEqual([(r['message'], r['count']) for r in records],
+                         [("disk%20is%20full", 50), ("disk%20is%20ok", 1)])
+        self.assertIn("disk is full (repeated 50 times)",
+                      urllib.parse.unquote(self._sent()[0]['message']))
+        self.assertEqual(handler.get_stats()["coalesced"], 49)
+
+    def test_ring_buffer_and_rate_limit_drops(self):
+        handler = self._handler(max_records=10, rate_limits={"DEBUG": 5})
+        for i in range(20):
+            self._logger.info("info %d", i)
+        for i in range(20):
+            self._logger.debug("debug %d", i)
+        stats = handler.get_stats()
+        self.assertEqual(stats["buffered"], 10)
+        self.assertEqual(stats["dropped_rate_limited"], {"DEBUG": 15})
+        self.assertEqual(stats["dropped_overflow"], 15)
+
+        handler.set_conn(mock.Mock(), self._conn)
+        dcm_events.poll(timeblock=0.0)
+        records = self._sent()[0]['records']
+        messages = [urllib.parse.unquote(r['message']) for r in records]
+        # the oldest records were pushed out
+        self.assertEqual(messages[:10],
+                         ["info 15", "info 16", "info 17", "info 18",
+                          "info 19", "debug 0", "debug 1", "debug 2",
+                          "debug 3", "debug 4"])
+        self.assertEqual(messages[10],
+                         "30 log records were dropped by the agent")
+
+
+    def test_single_record_shape(self):
+        handler = self._handler()
+        handler.set_conn(mock.Mock(), self._conn)
+        self._logger.error("just one")
+        handler.flush()
+        dcm_events.poll(timeblock=0.0)
+        self.assertEqual(self._sent(), [{"type": "LOG",
+                                         "token": "",
+                                         "level": "ERROR",
+                                         "message": "just%20one"}])
+
+    def test_console_messages_not_limited(self):
+        handler = self._handler(rate_limits={"INFO": 1})
+        console = logging.getLogger(logger._g_console_logger_name)
+        console.addHandler(handler)
+        self.addCleanup(console.removeHandler, handler)
+        self.addCleanup(console.setLevel, console.level)
+        console.setLevel(logging.INFO)
+        for _ in range(5):
+            logger.log_to_dcm_console_job_started(
+                job_name="run_script", request_id="r1")
+        stats = handler.get_stats()
+        self.assertEqual(stats["buffered"], 5)
+        self.assertEqual(stats["coalesced"], 0)
+        self.assertEqual(stats["dropped_rate_limited"], {})
+
+
+class TestQueuedFileLogging(unittest.TestCase):
+
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        self._log_file = os.path.join(self._dir, "agent.log")
+        self._logger = logging.getLogger(str(uuid.uuid4()))
+        self._logger.propagate = False
+        self._logger.setLevel(logging.DEBUG)
+        self.addCleanup(shutil.rmtree, self._dir)
+
+    def tearDown(self):
+        logger.stop_log_writer()
+        logger.start_log_writer()
+
+    def _handler(self, **kwargs):
+        handler = logger.DCMAgentLogger(
+            self._log_file, owner=getpass.getuser(), queued=True, **kwargs)
+        self._logger.addHandler(handler)
+        self.addCleanup(handler.close)
+        self.addCleanup(self._logger.removeHandler, handler)
+        return handler
+
+    def _lines(self):
+        with open(self._log_file, "r") as fptr:
+            return fptr.read().splitlines()
+
+    def test_written_by_writer_thread(self):
+        handler = self._handler()
+        writer_threads = []
+        real_write = handler._write
+
+        def _write(record):
+            writer_threads.append(threading.current_thread())
+            real_write(record)
+
+        handler._write = _write
+        args = [1]
+        self._logger.info("value %s", args)
+        # the record must not see changes made after the log call
+        args.append(2)
+        try:
+            raise ValueError("broken")
+        except ValueError:
+            self._logger.exception("failed")
+        handler.flush()
+
+        lines = self._lines()
+        self.assertEqual(lines[0], "value [1]")
+        self.assertEqual(lines[1], "failed")
+        self.assertIn("ValueError: broken", lines[-1])
+        self.assertEqual(len(writer_threads), 2)
+        self.assertNotIn(threading.current_thread(), writer_threads)
+
+    def test_rotation(self):
+        handler = self._handler(maxBytes=100, backupCount=3)
+        for i in range(20):
+            self._logger.info("line number %d of the log", i)
+        handler.flush()
+        self.assertTrue(os.path.exists(self._log_file + ".1"))
+        self.assertEqual(self._lines()[-1], "line number 19 of the log")
+
+    def test_stop_flushes_and_writes_directly(self):
+        handler = self._handler()
+        for i in range(100):
+            self._logger.info("before %d", i)
+        logger.stop_log_writer()
+        self.assertEqual(len(self._lines()), 100)
+        self._logger.info("after")
+        handler.flush()
+        self.assertEqual(self._lines()[-1], "after")
+
+    def test_dropped_records_reported(self):
+        handler = self._handler()
+        writer = logger._LogWriter(2)
+        handler._writer = lambda: writer
+        for i in range(5):
+            self._logger.info("line %d", i)
+        self.assertEqual(writer.dropped, 3)
+        writer.start()
+        writer.drain(5.0)
+        writer.stop()
+        self.assertEqual(self._lines(), [
+            "line 0",
+            "3 log records were dropped because the log writer queue "
+            "was full",
+            "line 1"])
+
+    def test_drop_reports_rate_limited(self):
+        handler = self._handler()
+        writer = logger._LogWriter(1)
+        writer._last_drop_report = time.monotonic()
+        handler._writer = lambda: writer
+        self._logger.info("first")
+        self._logger.info("dropped")
+        writer.start()
+        writer.drain(5.0)
+        self.assertEqual(self._lines(), ["first"])
+        # what is left is written when the thread stops
+        writer.stop()
+        self.assertEqual(self._lines(), [
+            "first",
+            "1 log records were dropped because the log writer queue "
+            "was full"])
+
+    def test_forked_child_writes_directly(self):
+        handler = self._handler()
+        self._logger.info("parent")
+        handler.flush()
+        # a fork while another thread holds the write lock
+        locked = threading.Event()
+        release = threading.Event()
+
+        def _hold_lock():
+            handler._write_lock.acquire()
+            try:
+                locked.set()
+                release.wait()
+            finally:
+                handler._write_lock.release()
+
+        t = threading.Thread(target=_hold_lock)
+        t.start()
+        locked.wait()
+        try:
+            pid = os.fork()
+            if pid == 0:
+                code = 1
+                try:
+                    self._logger.info("child")
+                    handler.flush()
+                    if logger._get_log_writer() is None:
+                        code = 0
+                finally:
+                    os._exit(code)
+        finally:
+            release.set()
+            t.join()
+        end = time.monotonic() + 10.0
+        (done, status) = os.waitpid(pid, os.WNOHANG)
+        while done == 0 and time.monotonic() < end:
+            time.sleep(0.05)
+            (done, status) = os.waitpid(pid, os.WNOHANG)
+        if done == 0:
+            os.kill(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+            self.fail("The forked child hung writing to the log")
+        self.assertEqual(0, os.WEXITSTATUS(status))
+        self.assertEqual(self._lines(), ["parent", "child"])
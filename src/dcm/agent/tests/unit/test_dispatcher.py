@@ -0,0 +1,285 @@
+#
+#  Copyright (C) 2014 Dell, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import threading
+import time
+import unittest
+
+import mock
+
+import dcm.agent.dispatcher as dispatcher
+import dcm.agent.plugins.loader as plugin_loader
+
+from dcm.agent.events.globals import global_space as dcm_events
+
+
+class TestWorkerPool(unittest.TestCase):
+
+    def setUp(self):
+        self.ran = []
+        self.release = threading.Event()
+        self.addCleanup(dcm_events.reset)
+
+    def _run(self, workload):
+        if workload.payload["command"] == "slow":
+            self.release.wait(10)
+        self.ran.append(workload.request_id)
+
+    def _pool(self, **kwargs):
+        pool = dispatcher.WorkerPool(self._run, **kwargs)
+        self.addCleanup(pool.stop)
+        self.addCleanup(self.release.set)
+        pool.start()
+        return pool
+
+    def _submit(self, pool, request_id, command="quick", items_map=None):
+        if items_map is None:
+            items_map = {}
+        payload = {"command": command, "arguments": {}}
+        pool.submit(dispatcher.WorkLoad(request_id, payload, items_map))
+
+    def _poll_until(self, check, timeout=5.0):
+        end = time.monotonic() + timeout
+        while not check() and time.monotonic() < end:
+            dcm_events.poll(timeblock=0.01)
+        return check()
+
+    def test_runs_workloads(self):
+        pool = self._pool(min_workers=2, max_workers=2)
+        for i in range(10):
+            self._submit(pool, str(i))
+        self.assertTrue(self._poll_until(lambda: len(self.ran) == 10))
+        stats = pool.get_stats()
+        self.assertEqual(2, stats["workers"])
+        self.assertEqual(10, stats["completed"])
+        self.assertEqual(0, stats["grown"])
+
+    def test_grows_when_work_waits(self):
+        pool = self._pool(min_workers=1, max_workers=4, scale_up_wait=0.05)
+        self._submit(pool, "slow", command="slow")
+        for i in range(3):
+            self._submit(pool, str(i))
+        # the quick ones finish while the slow one still holds the first
+        # worker
+        self.assertTrue(self._poll_until(lambda: len(self.ran) == 3))
+        self.assertNotIn("slow", self.ran)
+        stats = pool.get_stats()
+        self.assertGreater(stats["grown"], 0)
+        self.assertLessEqual(stats["workers"], 4)
+        self.assertEqual(1, stats["busy"])
+        self.release.set()
+        self.assertTrue(self._poll_until(lambda: len(self.ran) == 4))
+
+    def test_never_grows_past_max(self):
+        pool = self._pool(min_workers=1, max_workers=2, scale_up_wait=0.01)
+        for i in range(4):
+            self._submit(pool, "slow%d" % i, command="slow")
+        self.assertTrue(self._poll_until(
+            lambda: pool.get_stats()["busy"] == 2))
+        dcm_events.poll(timeblock=0.1)
+        stats = pool.get_stats()
+        self.assertEqual(2, stats["workers"])
+        self.assertEqual(2, stats["queued"])
+        self.assertGreater(stats["oldest_wait"], 0.0)
+
+    def test_idle_workers_exit(self):
+        pool = self._pool(min_workers=1, max_workers=3, scale_up_wait=0.01,
+                          idle_timeout=0.1)
+        for i in range(3):
+            self._submit(pool, "slow%d" % i, command="slow")
+        self.assertTrue(self._poll_until(
+            lambda: pool.get_stats()["workers"] == 3))
+        self.release.set()
+        self.assertTrue(self._poll_until(
+            lambda: pool.get_stats()["workers"] == 1))
+        self.assertEqual(2, pool.get_stats()["shrunk"])
+
+    def test_stop_runs_queued_work(self):
+        pool = self._pool(min_workers=1, max_workers=1)
+        for i in range(5):
+            self._submit(pool, str(i))
+        pool.stop()
+        self.assertEqual([str(i) for i in range(5)], self.ran)
+        self.assertEqual(0, pool.get_stats()["workers"])
+
+
+class TestWorkerPoolFairness(unittest.TestCase):
+
+    def setUp(self):
+        self.ran = []
+        self.release = threading.Event()
+        self.lock = threading.Lock()
+        self.running = {}
+        self.max_running = {}
+        self.addCleanup(dcm_events.reset)
+
+    def _run(self, workload):
+        command = workload.payload["command"]
+        with self.lock:
+            self.running[command] = self.running.get(command, 0) + 1
+            self.max_running[command] = max(
+                self.max_running.get(command, 0), self.running[command])
+        try:
+            if command == "hold":
+                self.release.wait(10)
+            sleep_time = workload.payload["arguments"].get("sleep")
+            if sleep_time:
+                time.sleep(sleep_time)
+        finally:
+            with self.lock:
+                self.running[command] -= 1
+                self.ran.append(workload.request_id)
+
+    def _pool(self, **kwargs):
+        pool = dispatcher.WorkerPool(self._run, **kwargs)
+        self.addCleanup(pool.stop)
+        self.addCleanup(self.release.set)
+        pool.start()
+        return pool
+
+    def _submit(self, pool, request_id, command, items_map=None, **args):
+        if items_map is None:
+            items_map = {}
+        payload = {"command": command, "arguments": args}
+        pool.submit(dispatcher.WorkLoad(request_id, payload, items_map))
+
+    def _poll_until(self, check, timeout=5.0):
+        end = time.monotonic() + timeout
+        while not check() and time.monotonic() < end:
+            dcm_events.poll(timeblock=0.01)
+        return check()
+
+    def test_round_robin(self):
+        pool = self._pool(min_workers=1, max_workers=1)
+        self._submit(pool, "hold", "hold")
+        for i in range(5):
+            self._submit(pool, "flood%d" % i, "flood")
+        for i in range(2):
+            self._submit(pool, "cheap%d" % i, "cheap")
+        self.release.set()
+        self.assertTrue(self._poll_until(lambda: len(self.ran) == 8))
+        self.assertEqual(
+            ["hold", "flood0", "cheap0", "flood1", "cheap1", "flood2",
+             "flood3", "flood4"],
+            self.ran)
+
+    def test_weight(self):
+        pool = self._pool(min_workers=1, max_workers=1)
+        self._submit(pool, "hold", "hold")
+        for i in range(4):
+            self._submit(pool, "heavy%d" % i, "heavy",
+                         items_map={"weight": "2"})
+        for i in range(3):
+            self._submit(pool, "light%d" % i, "light")
+        self.release.set()
+        self.assertTrue(self._poll_until(lambda: len(self.ran) == 8))
+        self.assertEqual(
+            ["hold", "heavy0", "heavy1", "light0", "heavy2", "heavy3",
+             "light1", "light2"],
+            self.ran)
+
+    def test_max_concurrency(self):
+        pool = self._pool(min_workers=4, max_workers=4)
+        for i in range(6):
+            self._submit(pool, "mount%d" % i, "mount",
+                         items_map={"max_concurrency": "2"}, sleep=0.02)
+        self.assertTrue(self._poll_until(lambda: len(self.ran) == 6))
+        self.assertEqual(2, self.max_running["mount"])
+
+    def test_bad_limits_are_ignored(self):
+        pool = self._pool(min_workers=2, max_workers=2)
+        for i in range(4):
+            self._submit(pool, "cmd%d" % i, "cmd",
+                         items_map={"max_concurrency": "lots",
+                                    "weight": "0"}, sleep=0.02)
+        self.assertTrue(self._poll_until(lambda: len(self.ran) == 4))
+        self.assertEqual(2, self.max_running["cmd"])
+
+    def test_cheap_latency_under_flood(self):
+        pool = self._pool(min_workers=3, max_workers=3)
+        flood_map = {"max_concurrency": "2"}
+        for i in range(20):
+            self._submit(pool, "flood%d" % i, "configure_server",
+                         items_map=flood_map, sleep=0.05)
+        # the flood needs at least half a second of its two workers but
+        # the cheap commands only wait for the third
+        latencies = []
+        for i in range(5):
+            start = time.monotonic()
+            request_id = "cheap%d" % i
+            self._submit(pool, request_id, "heartbeat")
+            self.assertTrue(self._poll_until(lambda: request_id in self.ran))
+            latencies.append(time.monotonic() - start)
+        self.assertLess(max(latencies), 0.25)
+        self.assertTrue(self._poll_until(lambda: len(self.ran) == 25))
+        self.assertEqual(2, self.max_running["configure_server"])
+
+
+class TestPreloadHold(unittest.TestCase):
+
+    def setUp(self):
+        self.addCleanup(dcm_events.reset)
+        self.addCleanup(plugin_loader.end_preload)
+        conf = mock.Mock()
+        conf.workers_count = 1
+        conf.workers_max_count = 1
+        conf.workers_scale_up_wait = 2.0
+        conf.workers_idle_timeout = 60.0
+        conf.workers_long_runner_threads = 0
+        conf.plugin_preload_wait = 30.0
+        self.conf = conf
+        self.disp = dispatcher.Dispatcher(conf)
+        self.started = []
+        self.disp._start_request = \
+            lambda request_id, payload, items_map: \
+            self.started.append(request_id)
+
+    def _hold(self, request_id):
+        if not self.disp._hold_for_preload(request_id, {}, {}):
+            self.disp._start_request(request_id, {}, {})
+
+    def _poll(self, seconds):
+        end = time.monotonic() + seconds
+        while time.monotonic() < end:
+            dcm_events.poll(timeblock=0.01)
+
+    def test_not_held_without_preload(self):
+        self._hold("r1")
+        self.assertEqual(["r1"], self.started)
+
+    def test_held_in_order_until_preloaded(self):
+        plugin_loader.begin_preload()
+        self._hold("r1")
+        self._hold("r2")
+        self._poll(0.3)
+        self.assertEqual([], self.started)
+
+        plugin_loader.end_preload()
+        # a request that comes in before the held ones are released waits
+        # behind them
+        self._hold("r3")
+        self._poll(0.3)
+        self.assertEqual(["r1", "r2", "r3"], self.started)
+        self._hold("r4")
+        self.assertEqual(["r1", "r2", "r3", "r4"], self.started)
+
+    def test_hold_expires(self):
+        self.conf.plugin_preload_wait = 0.1
+        plugin_loader.begin_preload()
+        self._hold("r1")
+        self._poll(0.5)
+        self.assertEqual(["r1"], self.started)
+        self._hold("r2")
+        self.assertEqual(["r1", "r2"], self.started)
@@ -19,8 +19,13 @@ import time
 import unittest
 import uuid
 
+import mock
+
+import dcm.agent.exceptions as exceptions
 import dcm.agent.tests.utils.general as test_utils
+import dcm.agent.events.asyncio_callback as asyncio_callback
 import dcm.agent.events.callback as events
+import dcm.agent.events.globals as global_events
 
 
 class TestEventSpace(unittest.TestCase):
@@ -29,8 +34,13 @@ class TestEventSpace(unittest.TestCase):
     def setUpClass(cls):
         test_utils.connect_to_debugger()
 
+    def _event_space(self, **kwargs):
+        event_space = events.EventSpace(**kwargs)
+        self.addCleanup(event_space.reset)
+        return event_space
+
     def test_simple_callback(self):
-        event_space = events.EventSpace()
+        event_space = self._event_space()
         x_val = 1
         y_val = []
         apple_val = "sauce"
@@ -50,7 +60,7 @@ class TestEventSpace(unittest.TestCase):
 
     def test_callback_delay(self):
         """Make sure that the delayed callback is called second"""
-        event_space = events.EventSpace()
+        event_space = self._event_space()
         x_val = []
 
         def test_callback1(x_param):
@@ -72,7 +82,7 @@ class TestEventSpace(unittest.TestCase):
 
     def test_delay_before_calling(self):
         """Make sure that the delay happens"""
-        event_space = events.EventSpace()
+        event_space = self._event_space()
         x_val = []
 
         def test_callback1(x_param):
@@ -90,7 +100,7 @@ class TestEventSpace(unittest.TestCase):
     def test_shutdown_while_running(self):
         """shutdow" the event space with pending events, verify they are
         not called"""
-        event_space = events.EventSpace()
+        event_space = self._event_space()
         x_val = []
 
         def test_callback1(x_param):
@@ -108,7 +118,7 @@ class TestEventSpace(unittest.TestCase):
 
     def test_cancel_a_callback(self):
         """cancel a callback and verify it did not run"""
-        event_space = events.EventSpace()
+        event_space = self._event_space()
         x_val = []
         d = 0.1
 
@@ -129,7 +139,7 @@ class TestEventSpace(unittest.TestCase):
 
     def test_cancel_already_run_callback(self):
         """cancel an already called callback and verify return code"""
-        event_space = events.EventSpace()
+        event_space = self._event_space()
         x_val = []
         d = 0.1
 
@@ -143,7 +153,7 @@ class TestEventSpace(unittest.TestCase):
         self.assertFalse(x)
 
     def test_return_code(self):
-        event_space = events.EventSpace()
+        event_space = self._event_space()
         apple_val = "sauce"
 
         def test_callback():
@@ -157,7 +167,7 @@ class TestEventSpace(unittest.TestCase):
         self.assertIsNone(ub.get_exception())
 
     def test_raise_exception(self):
-        event_space = events.EventSpace()
+        event_space = self._event_space()
         exception_message = str(uuid.uuid4())
 
         def test_callback():
@@ -172,7 +182,7 @@ class TestEventSpace(unittest.TestCase):
 
     def test_wakeup_on_register(self):
         # test that callback happens when it is registered after the poll
-        event_space = events.EventSpace()
+        event_space = self._event_space()
         param = []
         start_time = []
         delay = 0.1
@@ -194,7 +204,7 @@ class TestEventSpace(unittest.TestCase):
         t.join()
 
     def test_register_events_in_callback(self):
-        event_space = events.EventSpace()
+        event_space = self._event_space()
         param = []
 
         def test_callback1(param):
@@ -216,7 +226,7 @@ class TestEventSpace(unittest.TestCase):
         self.assertIn(2, param)
 
     def test_register_threaded_event(self):
-        event_space = events.EventSpace()
+        event_space = self._event_space()
         x_val = 1
         y_val = []
         apple_val = "sauce"
@@ -241,7 +251,7 @@ class TestEventSpace(unittest.TestCase):
 
     def test_callback_delay_threaded(self):
         """Make sure that the delayed callback is called second"""
-        event_space = events.EventSpace()
+        event_space = self._event_space()
         x_val = []
 
         def test_callback1(x_param):
@@ -265,7 +275,7 @@ class TestEventSpace(unittest.TestCase):
 
     def test_cancel_a_callback_threaded(self):
         """cancel a callback and verify it did not run"""
-        event_space = events.EventSpace()
+        event_space = self._event_space()
         x_val = []
         d = 0.1
 
@@ -284,7 +294,7 @@ class TestEventSpace(unittest.TestCase):
 
     def test_rest(self):
 
-        event_space = events.EventSpace()
+        event_space = self._event_space()
         x_val = []
         d = 0.1
 
@@ -305,3 +315,380 @@ class TestEventSpace(unittest.TestCase):
 
         event_space.poll(timeblock=d*2)
         self.assertEqual(len(x_val), 0)
+
+    def test_priority_order(self):
+        event_space = self._event_space()
+        order = []
+        priorities = [events.CallbackPriority.TELEMETRY,
+                      events.CallbackPriority.WORK_COMPLETE,
+                      events.CallbackPriority.CONTROL]
+        for i, priority in enumerate(priorities * 3):
+            event_space.register_callback(
+                order.append, args=[(priority, i)], priority=priority)
+        event_space.poll(timeblock=0.05)
+        self.assertEqual([p for p, _ in order], sorted(p for p, _ in order))
+        # the callbacks in one class keep the order they came ready in
+        self.assertEqual(order, sorted(order))
+
+    def test_high_priority_gets_between_cycles(self):
+        event_space = self._event_space()
+        order = []
+
+        def log_callback(i):
+            order.append(("log", i))
+            if i == 0:
+                event_space.register_callback(
+                    order.append, args=[("reply", 0)],
+                    priority=events.CallbackPriority.WORK_COMPLETE)
+
+        for i in range(100):
+            event_space.register_callback(
+                log_callback, args=[i],
+                priority=events.CallbackPriority.TELEMETRY)
+        event_space.poll(timeblock=0.1)
+        self.assertEqual(len(order), 101)
+        self.assertLess(order.index(("reply", 0)), 50)
+
+    def test_low_priority_is_not_starved(self):
+        event_space = self._event_space(priority_aging=0.05)
+        order = []
+        d = 0.01
+
+        def control_callback():
+            # always keep a ready control callback around
+            order.append("control")
+            time.sleep(d)
+            event_space.register_callback(control_callback)
+
+        for _ in range(2):
+            event_space.register_callback(control_callback)
+        event_space.register_callback(
+            order.append, args=["log"],
+            priority=events.CallbackPriority.TELEMETRY)
+        event_space.poll(timeblock=0.5)
+        self.assertIn("log", order)
+        self.assertLess(order.index("log"), 30)
+
+    def test_poll_stats(self):
+        event_space = self._event_space()
+        cycles = []
+        event_space.set_poll_observer(cycles.append)
+        d = 0.05
+
+        def slow_callback():
+            time.sleep(d)
+
+        def fast_callback():
+            pass
+
+        event_space.register_callback(fast_callback)
+        event_space.register_callback(slow_callback)
+        canceled = event_space.register_callback(fast_callback, delay=d)
+        event_space.cancel_callback(canceled)
+        event_space.poll(timeblock=0.0)
+
+        self.assertEqual(len(cycles), 1)
+        self.assertEqual(cycles[0]["callbacks"], 2)
+        self.assertGreaterEqual(cycles[0]["slowest_callback_time"], d)
+        self.assertIn("slow_callback", cycles[0]["slowest_callback"])
+        self.assertGreaterEqual(cycles[0]["callback_time"],
+                                cycles[0]["slowest_callback_time"])
+        # the fast callback waited behind the slow one or the other way
+        self.assertGreaterEqual(cycles[0]["max_lag"], 0.0)
+
+        # a callback that comes due while another is running runs late
+        event_space.register_callback(slow_callback)
+        event_space.register_callback(fast_callback, delay=d / 5)
+        event_space.poll(timeblock=d * 2)
+        stats = event_space.get_poll_stats()
+        self.assertEqual(stats["callbacks"], 4)
+        self.assertGreaterEqual(stats["cycles"], 2)
+        self.assertGreaterEqual(stats["max_lag"], d / 2)
+        self.assertIn("slow_callback", stats["slowest_callback"])
+        self.assertEqual(stats["last_cycle"], cycles[-1])
+
+
+class TestEventSpaceTimingWheel(TestEventSpace):
+
+    def _event_space(self, **kwargs):
+        event_space = events.EventSpace(scheduler=events.TimingWheel(),
+                                        **kwargs)
+        self.addCleanup(event_space.reset)
+        return event_space
+
+
+class TestAsyncioEventSpace(TestEventSpace):
+
+    def _event_space(self, **kwargs):
+        event_space = asyncio_callback.AsyncioEventSpace(**kwargs)
+        self.addCleanup(event_space.get_loop().close)
+        self.addCleanup(event_space.reset)
+        return event_space
+
+    def test_callback_scheduled_from_coroutine_loop(self):
+        event_space = self._event_space()
+        loop = event_space.get_loop()
+        x_val = []
+
+        def test_callback():
+            future = loop.create_future()
+            future.add_done_callback(lambda f: x_val.append(f.result()))
+            loop.call_soon(future.set_result, 1)
+
+        event_space.register_callback(test_callback)
+        event_space.poll(timeblock=0.1)
+        self.assertEqual(x_val, [1])
+
+
+class TestGlobalEventSpace(unittest.TestCase):
+
+    def test_use_event_space(self):
+        self.addCleanup(global_events.use_event_space, "poll")
+        pubsub_space = global_events.global_pubsub._event_space
+        self.assertIs(pubsub_space, global_events.global_space)
+
+        global_events.use_event_space("asyncio")
+        self.assertIsInstance(global_events.global_space.event_space,
+                              asyncio_callback.AsyncioEventSpace)
+        x_val = []
+        global_events.global_pubsub.subscribe("test_topic", x_val.append)
+        self.addCleanup(global_events.global_pubsub.unsubscribe,
+                        "test_topic", x_val.append)
+        global_events.global_pubsub.publish("test_topic", topic_args=[1])
+        global_events.global_space.poll(timeblock=0.0)
+        self.assertEqual(x_val, [1])
+
+        global_events.use_event_space("poll")
+        self.assertNotIsInstance(global_events.global_space.event_space,
+                                 asyncio_callback.AsyncioEventSpace)
+        self.assertRaises(exceptions.AgentOptionValueException,
+                          global_events.use_event_space, "select")
+
+
+class _FakeClock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestTimingWheel(unittest.TestCase):
+
+    def _callback(self, delay):
+        return events.UserCallback(lambda: None, None, None, delay, False)
+
+    def _drain(self, wheel, until):
+        ready = []
+        now = time.monotonic()
+        while now < until:
+            for ub in wheel.pop_ready(now):
+                self.assertTrue(ub.is_ready(tm=now))
+                ready.append(ub)
+            time.sleep(0.001)
+            now = time.monotonic()
+        ready.extend(wheel.pop_ready(now))
+        return ready
+
+    def _timed_callbacks(self, clock, delays):
+        # the callbacks read their ready time from time.monotonic()
+        with mock.patch("time.monotonic", return_value=clock.now):
+            return [self._callback(d) for d in delays]
+
+    def _step(self, wheel, clock, step, until):
+        ready = []
+        while clock.now < until:
+            clock.now += step
+            for ub in wheel.pop_ready(clock.now):
+                self.assertTrue(ub.is_ready(tm=clock.now))
+                ready.append(ub)
+        return ready
+
+    # tiny levels so that callbacks go through every level and the
+    # overflow list
+    _delays = [0.0, 0.002, 0.005, 0.011, 0.017, 0.023, 0.031, 0.05]
+
+    def test_cascades_in_order(self):
+        clock = _FakeClock()
+        wheel = events.TimingWheel(
+            tick=0.001, levels=2, slot_bits=2, clock=clock)
+        callbacks = self._timed_callbacks(clock, self._delays)
+        for ub in reversed(callbacks):
+            wheel.push(ub)
+        self.assertEqual(len(wheel), len(self._delays))
+
+        ready = self._step(wheel, clock, 0.001, clock.now + 0.1)
+        self.assertEqual(len(wheel), 0)
+        self.assertEqual(ready, callbacks)
+
+    def test_late_poll_catches_up_in_order(self):
+        # each poll covers several ticks and the cascades in them
+        for step in [0.003, 0.007, 0.02, 0.1]:
+            clock = _FakeClock()
+            wheel = events.TimingWheel(
+                tick=0.001, levels=2, slot_bits=2, clock=clock)
+            callbacks = self._timed_callbacks(clock, self._delays)
+            for ub in reversed(callbacks):
+                wheel.push(ub)
+            ready = self._step(wheel, clock, step, clock.now + 0.1)
+            self.assertEqual(len(wheel), 0)
+            self.assertEqual(ready, callbacks)
+
+    def test_late_poll_with_ready_push(self):
+        clock = _FakeClock()
+        wheel = events.TimingWheel(
+            tick=0.001, levels=2, slot_bits=2, clock=clock)
+        early = self._timed_callbacks(clock, [0.002, 0.013])
+        for ub in early:
+            wheel.push(ub)
+        clock.now += 0.02
+        # pushed already ready, but due after the two in the wheel
+        late = self._timed_callbacks(clock, [0.0])
+        wheel.push(late[0])
+        self.assertEqual(wheel.pop_ready(clock.now), early + late)
+
+    def test_remove(self):
+        wheel = events.TimingWheel(tick=0.001, levels=2, slot_bits=2)
+        keep = self._callback(0.003)
+        removed = [self._callback(d) for d in [0.0, 0.003, 0.02, 1.0]]
+        wheel.push(keep)
+        for ub in removed:
+            wheel.push(ub)
+        for ub in removed:
+            wheel.remove(ub)
+        wheel.remove(removed[0])
+        self.assertEqual(len(wheel), 1)
+        self.assertEqual(wheel.callbacks(), [keep])
+
+        ready = self._drain(wheel, time.monotonic() + 0.05)
+        self.assertEqual(ready, [keep])
+
+    def test_next_time(self):
+        wheel = events.TimingWheel()
+        self.assertIsNone(wheel.next_time())
+        ub = self._callback(0.5)
+        wheel.push(ub)
+        next_time = wheel.next_time()
+        self.assertGreaterEqual(next_time, ub.get_time_ready())
+        self.assertLess(next_time, ub.get_time_ready() + 0.011)
+
+        far = events.TimingWheel()
+        far.push(self._callback(60))
+        # only the time the first level turns over is known
+        self.assertLessEqual(far.next_time(), time.monotonic() + 2.57)
+
+    def test_cancel_removes_from_space(self):
+        wheel = events.TimingWheel()
+        event_space = events.EventSpace(scheduler=wheel)
+        handles = [event_space.register_callback(lambda: None, delay=30)
+                   for _ in range(100)]
+        for ub in handles:
+            self.assertTrue(event_space.cancel_callback(ub))
+        self.assertEqual(len(wheel), 0)
+
+
+class TestCallbackWorkerPool(unittest.TestCase):
+
+    space_cls = events.EventSpace
+
+    def _event_space(self, max_workers, max_queue):
+        pool = events.CallbackWorkerPool(
+            max_workers=max_workers, max_queue=max_queue)
+        event_space = self.space_cls(worker_pool=pool)
+        self.addCleanup(event_space.reset)
+        return event_space
+
+    def _poll_until(self, event_space, check, timeout=5.0):
+        end_time = time.time() + timeout
+        while not check() and time.time() < end_time:
+            event_space.poll(timeblock=0.05)
+        self.assertTrue(check())
+
+    def test_threads_are_reused(self):
+        event_space = self._event_space(2, 64)
+        thread_ids = []
+        lock = threading.Lock()
+
+        def test_callback(i):
+            with lock:
+                thread_ids.append(threading.currentThread().ident)
+
+        for i in range(20):
+            event_space.register_callback(
+                test_callback, args=[i], in_thread=True)
+        self._poll_until(event_space, lambda: len(thread_ids) == 20)
+        self.assertLessEqual(len(set(thread_ids)), 2)
+        self.assertNotIn(threading.currentThread().ident, thread_ids)
+        stats = event_space.get_worker_stats()
+        self.assertLessEqual(stats["workers"], 2)
+        self.assertEqual(stats["completed"], 20)
+
+    def test_full_queue_defers_in_order(self):
+        event_space = self._event_space(1, 1)
+        blocker = threading.Event()
+        order = []
+
+        def blocking_callback():
+            blocker.wait(5.0)
+            order.append(0)
+
+        def test_callback(i):
+            order.append(i)
+
+        event_space.register_callback(blocking_callback, in_thread=True)
+        for i in range(1, 5):
+            event_space.register_callback(
+                test_callback, args=[i], in_thread=True)
+        event_space.poll(timeblock=0.0)
+        stats = event_space.get_worker_stats()
+        self.assertLessEqual(stats["queued"], 1)
+        self.assertGreaterEqual(stats["deferred"], 3)
+        self.assertGreater(stats["rejected"], 0)
+
+        blocker.set()
+        self._poll_until(event_space, lambda: len(order) == 5)
+        self.assertEqual(order, [0, 1, 2, 3, 4])
+        self.assertEqual(event_space.get_worker_stats()["deferred"], 0)
+
+    def test_wait_time_recorded(self):
+        event_space = self._event_space(1, 8)
+        d = 0.1
+        called = []
+
+        def slow_callback():
+            time.sleep(d)
+            called.append(1)
+
+        event_space.register_callback(slow_callback, in_thread=True)
+        event_space.register_callback(slow_callback, in_thread=True)
+        self._poll_until(event_space, lambda: len(called) == 2)
+        stats = event_space.get_worker_stats()
+        self.assertGreaterEqual(stats["wait_max"], d * 0.5)
+        self.assertGreater(stats["wait_mean"], 0.0)
+
+    def test_reset_waits_for_running_callbacks(self):
+        event_space = self._event_space(2, 8)
+        started = threading.Event()
+        x_val = []
+
+        def slow_callback():
+            started.set()
+            time.sleep(0.2)
+            x_val.append(1)
+
+        event_space.register_callback(slow_callback, in_thread=True)
+        event_space.poll(timeblock=0.0)
+        self.assertTrue(started.wait(5.0))
+        event_space.reset()
+        self.assertEqual(x_val, [1])
+        self.assertEqual(event_space.get_worker_stats()["workers"], 0)
+
+        # the space and its pool can be used again after a reset
+        event_space.register_callback(x_val.append, args=[2], in_thread=True)
+        self._poll_until(event_space, lambda: len(x_val) == 2)
+
+
+class TestAsyncioCallbackWorkerPool(TestCallbackWorkerPool):
+
+    space_cls = asyncio_callback.AsyncioEventSpace
@@ -17,6 +17,8 @@ import unittest
 import os
 from mock import call
 from mock import MagicMock
+import dcm.agent.events.globals as events
+import dcm.agent.messaging.persistence as persistence
 import dcm.agent.tests.utils.general as test_utils
 
 from dcm.agent.ossec import AlertSender
@@ -78,3 +80,51 @@ class TestOssec(unittest.TestCase):
         parse_file("/tmp/alerts.log", 1446578476433, self.alert_sender)
         assert EXPECTED_CALLS[0] not in self.alert_sender.send_alert.call_args_list
 
+    def test_ack_burst_recorded_together(self):
+        db = persistence.SQLiteAgentDB(":memory:")
+        db.add_alerts = MagicMock(wraps=db.add_alerts)
+        sender = AlertSender(MagicMock(), db)
+        for i in range(3):
+            alert = MagicMock()
+            alert.alert_hash = "hash%d" % i
+            alert.doc = {'alert_timestamp': 1000 + i,
+                         'current_timestamp': 2000,
+                         'level': 3, 'rule': 5501,
+                         'subject': 'subject', 'message': 'message'}
+            sender._alerts["req%d" % i] = alert
+            sender._alert_by_hash[alert.alert_hash] = alert
+
+        for i in range(3):
+            sender.incoming_message({'request_id': "req%d" % i})
+        self.assertEqual(sender._alerts, {})
+        self.assertEqual(len(sender._alert_by_hash), 3)
+        self.assertEqual(db.get_latest_alert_time(), 0)
+
+        events.global_space.poll(timeblock=0.1)
+        self.assertEqual(db.add_alerts.call_count, 1)
+        self.assertEqual(db.get_latest_alert_time(), 1002)
+        self.assertEqual(sender._alert_by_hash, {})
+
+    def test_failed_record_is_kept(self):
+        db = persistence.SQLiteAgentDB(":memory:")
+        db.add_alerts = MagicMock(side_effect=Exception("database is locked"))
+        sender = AlertSender(MagicMock(), db)
+        alert = MagicMock()
+        alert.alert_hash = "hash0"
+        alert.doc = {'alert_timestamp': 1000,
+                     'current_timestamp': 2000,
+                     'level': 3, 'rule': 5501,
+                     'subject': 'subject', 'message': 'message'}
+        sender._alert_by_hash[alert.alert_hash] = alert
+        sender._acked = [alert]
+
+        sender._record_acked()
+        self.assertEqual(sender._acked, [alert])
+        self.assertIn("hash0", sender._alert_by_hash)
+
+        db.add_alerts = MagicMock()
+        sender._record_acked()
+        self.assertEqual(db.add_alerts.call_count, 1)
+        self.assertEqual(sender._acked, [])
+        self.assertEqual(sender._alert_by_hash, {})
+        events.global_space.reset()
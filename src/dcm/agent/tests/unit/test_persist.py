@@ -16,6 +16,8 @@
 import datetime
 import json
 import os
+import re
+import sqlite3
 import tempfile
 import time
 import threading
@@ -23,6 +25,7 @@ import unittest
 import uuid
 
 import dcm.agent.exceptions as exceptions
+import dcm.agent.messaging.journal as journal
 import dcm.agent.messaging.persistence as persistence
 import dcm.agent.messaging.states as messaging_states
 
@@ -200,6 +203,15 @@ class TestPersistDisk(unittest.TestCase):
     def tearDown(self):
         os.remove(self.db_file)
 
+    def _reopen(self):
+        return persistence.SQLiteAgentDB(self.db_file)
+
+    def _alert_count(self, db):
+        def do_it(cursor):
+            cursor.execute("SELECT count(*) FROM alerts")
+            return cursor.fetchone()[0]
+        return db._execute(do_it)
+
     def test_record_sweeper(self):
         request_id = str(uuid.uuid4())
         agent_id = str(uuid.uuid4())
@@ -240,6 +252,22 @@ class TestPersistDisk(unittest.TestCase):
         latest_time = self.db.get_latest_alert_time()
         self.assertEqual(latest_time, alert_time2)
 
+    def test_add_alerts_batch(self):
+        self.assertEqual(self.db.get_latest_alert_time(), 0)
+        alerts = [(1000 + i, 5000, "hash%d" % i, 3, 5000, "subject", "msg")
+                  for i in range(10)]
+        self.db.add_alerts(alerts)
+        self.assertEqual(self.db.get_latest_alert_time(), 1009)
+
+        # an alert that was already recorded does not fail the batch
+        self.db.add_alerts([(2000, 5000, "hash0", 3, 5000, "s", "m"),
+                            (1500, 5000, "hash10", 3, 5000, "s", "m")])
+        self.assertEqual(self.db.get_latest_alert_time(), 1500)
+
+        db = self._reopen()
+        self.assertEqual(db.get_latest_alert_time(), 1500)
+        self.assertEqual(self._alert_count(db), 11)
+
 
 
 class TestPersistMultiThread(unittest.TestCase):
@@ -360,3 +388,910 @@ class TestPersistMultiThread(unittest.TestCase):
         self.assertTrue(res is not None)
         res = self.db.lookup_req(request_id2)
         self.assertTrue(res is not None)
+
+
+class TestPersistThreadConnections(TestPersistMultiThread):
+
+    def setUp(self):
+        _, self.db_file = tempfile.mkstemp("test_db")
+        self.db = persistence.SQLiteAgentDB(
+            self.db_file, thread_connections=True)
+
+    def tearDown(self):
+        for f in [self.db_file, self.db_file + "-wal", self.db_file + "-shm"]:
+            if os.path.exists(f):
+                os.remove(f)
+
+    def test_wal_journal_mode(self):
+        def do_it(cursor):
+            cursor.execute("PRAGMA journal_mode")
+            return cursor.fetchone()[0]
+        self.assertEqual(self.db._execute(do_it).lower(), "wal")
+
+    def test_connection_per_thread(self):
+        conns = []
+
+        def _get_conn():
+            conns.append(self.db._get_conn())
+
+        t = threading.Thread(target=_get_conn)
+        t.start()
+        t.join()
+        _get_conn()
+        self.assertEqual(len(conns), 2)
+        self.assertIsNot(conns[0], conns[1])
+
+    def test_close_closes_thread_connections(self):
+        conns = []
+
+        def _get_conn():
+            conns.append(self.db._get_conn())
+
+        t = threading.Thread(target=_get_conn)
+        t.start()
+        t.join()
+        _get_conn()
+        self.db.close()
+        for conn in conns:
+            self.assertRaises(sqlite3.ProgrammingError,
+                              conn.execute, "SELECT 1")
+
+    def test_read_while_writer_locked(self):
+        request_id = str(uuid.uuid4())
+        agent_id = str(uuid.uuid4())
+        request_doc = {"request_id": request_id}
+        state = messaging_states.ReplyStates.ACKED
+        self.db.new_record(request_id, request_doc, None, state, agent_id)
+
+        found = []
+
+        def _thread_lookup():
+            found.append(self.db.lookup_req(request_id))
+            found.append(self.db.get_all_ack())
+
+        self.db.lock()
+        try:
+            t = threading.Thread(target=_thread_lookup)
+            t.start()
+            t.join(5.0)
+            self.assertFalse(t.is_alive())
+        finally:
+            self.db.unlock()
+        self.assertEqual(found[0].request_id, request_id)
+        self.assertEqual(len(found[1]), 1)
+
+    def test_concurrent_writers(self):
+        agent_id = str(uuid.uuid4())
+        failed = []
+
+        def _writer():
+            try:
+                for _ in range(20):
+                    request_id = str(uuid.uuid4())
+                    self.db.new_record(
+                        request_id, {"request_id": request_id}, None,
+                        messaging_states.ReplyStates.ACKED, agent_id)
+                    self.db.update_record(
+                        request_id, messaging_states.ReplyStates.REPLY,
+                        reply_doc={"return_code": 0})
+            except Exception as ex:
+                print(str(ex))
+                failed.append(True)
+
+        threads = [threading.Thread(target=_writer) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(len(failed), 0)
+        self.assertEqual(len(self.db.get_all_reply()), 80)
+
+    def test_memory_falls_back_to_single_connection(self):
+        db = persistence.SQLiteAgentDB(":memory:", thread_connections=True)
+        self.assertFalse(db._thread_connections)
+
+
+class TestPersistSchema(unittest.TestCase):
+
+    def setUp(self):
+        _, self.db_file = tempfile.mkstemp("test_db")
+
+    def tearDown(self):
+        os.remove(self.db_file)
+
+    def _query_plan(self, db, stmt, parms):
+        def do_it(cursor):
+            cursor.execute("EXPLAIN QUERY PLAN " + stmt, parms)
+            return [row[-1] for row in cursor.fetchall()]
+        return db._execute(do_it)
+
+    def test_hot_queries_use_indexes(self):
+        db = persistence.SQLiteAgentDB(self.db_file)
+        now = datetime.datetime.now()
+        hot_queries = [
+            (persistence._g_select_state_stmt,
+             (messaging_states.ReplyStates.REPLY,)),
+            (persistence._g_lookup_req_stmt, ("arequestid",)),
+            (persistence._g_starting_agent_stmt,
+             (messaging_states.ReplyStates.REPLY, "{}",
+              messaging_states.ReplyStates.ACKED)),
+            (persistence._g_check_agent_id_stmt, ("anagent", "anagent")),
+            (persistence._g_clean_expired_stmt, (now,)),
+            (persistence._g_latest_alert_stmt,
+             (persistence.DBCounters.ALERT_HIGH_WATER,)),
+            (persistence._g_clean_old_alerts_stmt, (1000,)),
+        ]
+        table_scan = re.compile("^SCAN (TABLE )?(request|alerts)")
+        for stmt, parms in hot_queries:
+            plan = self._query_plan(db, stmt, parms)
+            self.assertTrue(plan)
+            for detail in plan:
+                self.assertIsNone(
+                    table_scan.match(detail),
+                    "%s does a table scan: %s" % (stmt, str(plan)))
+
+    def test_migrate_old_schema(self):
+        conn = sqlite3.connect(self.db_file)
+        conn.executescript(persistence._g_sqllite_ddl)
+        conn.close()
+
+        persistence.SQLiteAgentDB(self.db_file)
+
+        conn = sqlite3.connect(self.db_file)
+        try:
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            indexes = [r[0] for r in conn.execute(
+                "SELECT name FROM sqlite_master WHERE type='index' "
+                "AND tbl_name='requests'")]
+        finally:
+            conn.close()
+        self.assertEqual(version, persistence._g_schema_migrations[-1][0])
+        self.assertIn("requests_state_idx", indexes)
+        self.assertIn("requests_last_update_time_idx", indexes)
+        self.assertIn("requests_agent_id_idx", indexes)
+
+    def test_vacuum_is_not_a_migration(self):
+        conn = sqlite3.connect(self.db_file)
+        conn.executescript(persistence._g_sqllite_ddl)
+        conn.close()
+
+        # opening an old file does not rewrite it
+        db = persistence.SQLiteAgentDB(self.db_file)
+        self.assertEqual(db.get_auto_vacuum(), 0)
+        db.vacuum()
+        self.assertEqual(db.get_auto_vacuum(), 2)
+
+    def test_read_only_leaves_the_schema(self):
+        conn = sqlite3.connect(self.db_file)
+        conn.executescript(persistence._g_sqllite_ddl)
+        conn.close()
+
+        db = persistence.SQLiteAgentDB(self.db_file, read_only=True)
+        db.close()
+
+        conn = sqlite3.connect(self.db_file)
+        try:
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+        finally:
+            conn.close()
+        self.assertEqual(version, 0)
+
+    def test_read_only(self):
+        db = persistence.SQLiteAgentDB(self.db_file)
+        db.new_record("r1", {"request_id": "r1"}, None,
+                      messaging_states.ReplyStates.ACKED, "agent")
+        db.close()
+
+        db = persistence.SQLiteAgentDB(
+            self.db_file, group_commit_window=0.01, read_only=True)
+        try:
+            self.assertIsNotNone(db.lookup_req("r1"))
+            self.assertIsNone(db._group_committer)
+            self.assertRaises(sqlite3.OperationalError,
+                              db.check_agent_id, "anagent")
+        finally:
+            db.close()
+
+    def test_reopen_migrated_db(self):
+        persistence.SQLiteAgentDB(self.db_file)
+        db = persistence.SQLiteAgentDB(self.db_file)
+        self.assertEqual(db.get_all_reply(), [])
+
+    def test_state_with_quote(self):
+        db = persistence.SQLiteAgentDB(self.db_file)
+        self.assertEqual(db._get_all_state('RE"PLY'), [])
+
+
+class TestPersistGroupCommit(TestPersistThreadConnections):
+
+    def setUp(self):
+        _, self.db_file = tempfile.mkstemp("test_db")
+        self.db = persistence.SQLiteAgentDB(
+            self.db_file, thread_connections=True,
+            group_commit_window=0.002, group_commit_max_ops=64)
+
+    def tearDown(self):
+        self.db.close()
+        super(TestPersistGroupCommit, self).tearDown()
+
+    def test_writes_are_batched(self):
+        agent_id = str(uuid.uuid4())
+        start = threading.Event()
+
+        def _writer():
+            start.wait()
+            for _ in range(10):
+                request_id = str(uuid.uuid4())
+                self.db.new_record(
+                    request_id, {"request_id": request_id}, None,
+                    messaging_states.ReplyStates.ACKED, agent_id)
+
+        threads = [threading.Thread(target=_writer) for _ in range(8)]
+        for t in threads:
+            t.start()
+        start.set()
+        for t in threads:
+            t.join()
+        committer = self.db._group_committer
+        self.assertEqual(committer.writes_committed, 80)
+        self.assertLess(committer.batches_committed, 80)
+
+    def test_write_is_durable_on_return(self):
+        request_id = str(uuid.uuid4())
+        self.db.new_record(request_id, {"request_id": request_id}, None,
+                           messaging_states.ReplyStates.ACKED, "agent")
+        conn = sqlite3.connect(self.db_file)
+        try:
+            row = conn.execute(
+                "SELECT state FROM requests WHERE request_id=?",
+                (request_id,)).fetchone()
+        finally:
+            conn.close()
+        self.assertEqual(row[0], messaging_states.ReplyStates.ACKED)
+
+    def test_committer_syncs_every_commit(self):
+        conn = self.db._connect(synchronous="FULL")
+        try:
+            # 2 is FULL
+            self.assertEqual(
+                conn.execute("PRAGMA synchronous").fetchone()[0], 2)
+        finally:
+            conn.close()
+        # the thread connections only read
+        self.assertEqual(
+            self.db._get_conn().execute("PRAGMA synchronous").fetchone()[0],
+            1)
+
+    def test_lone_write_is_not_delayed(self):
+        self.db.close()
+        self.db = persistence.SQLiteAgentDB(
+            self.db_file, thread_connections=True,
+            group_commit_window=5.0, group_commit_max_ops=64)
+        start = time.monotonic()
+        for _ in range(3):
+            request_id = str(uuid.uuid4())
+            self.db.new_record(request_id, {"request_id": request_id}, None,
+                               messaging_states.ReplyStates.ACKED, "agent")
+        self.assertLess(time.monotonic() - start, 2.5)
+        self.assertEqual(self.db._group_committer.batches_committed, 3)
+
+    def test_failed_write_does_not_spoil_batch(self):
+        request_id = str(uuid.uuid4())
+        results = []
+
+        def _bad_update():
+            try:
+                self.db.update_record("Nope", "ASTATE")
+                results.append(False)
+            except exceptions.PersistenceException:
+                results.append(True)
+
+        def _good_insert():
+            self.db.new_record(request_id, {"request_id": request_id}, None,
+                               messaging_states.ReplyStates.ACKED, "agent")
+
+        threads = [threading.Thread(target=_bad_update),
+                   threading.Thread(target=_good_insert)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(results, [True])
+        self.assertIsNotNone(self.db.lookup_req(request_id))
+
+    def test_write_after_close(self):
+        self.db.close()
+        passed = False
+        try:
+            self.db.check_agent_id("anagent")
+        except exceptions.PersistenceException:
+            passed = True
+        self.assertTrue(passed, "An exception did not happen")
+
+
+class TestPersistRetention(unittest.TestCase):
+
+    def setUp(self):
+        _, self.db_file = tempfile.mkstemp("test_db")
+        self.db = persistence.SQLiteAgentDB(self.db_file)
+        self.agent_id = str(uuid.uuid4())
+
+    def tearDown(self):
+        os.remove(self.db_file)
+
+    def _add_records(self, count, state, size=10):
+        request_ids = []
+        for _ in range(count):
+            request_id = str(uuid.uuid4())
+            request_doc = {"request_id": request_id, "data": "x" * size}
+            self.db.new_record(
+                request_id, request_doc, None, state, self.agent_id)
+            request_ids.append(request_id)
+        return request_ids
+
+    def test_incremental_auto_vacuum(self):
+        def do_it(cursor):
+            cursor.execute("PRAGMA auto_vacuum")
+            return cursor.fetchone()[0]
+        # 2 is INCREMENTAL
+        self.assertEqual(self.db._execute(do_it), 2)
+
+    def test_evict_oldest_completed_by_count(self):
+        old_ids = self._add_records(
+            5, messaging_states.ReplyStates.REPLY_ACKED)
+        new_ids = self._add_records(
+            5, messaging_states.ReplyStates.REPLY_NACKED)
+
+        by_count, by_size = self.db.evict_completed(max_rows=5)
+        self.assertEqual(by_count, 5)
+        self.assertEqual(by_size, 0)
+        for request_id in old_ids:
+            self.assertIsNone(self.db.lookup_req(request_id))
+        for request_id in new_ids:
+            self.assertIsNotNone(self.db.lookup_req(request_id))
+        self.assertEqual(
+            self.db.get_counters()[persistence.DBCounters.EVICTED_BY_COUNT],
+            5)
+
+    def test_evict_skips_active_requests(self):
+        active_ids = self._add_records(
+            5, messaging_states.ReplyStates.ACKED)
+        active_ids.extend(self._add_records(
+            5, messaging_states.ReplyStates.REPLY))
+        self._add_records(5, messaging_states.ReplyStates.REPLY_ACKED)
+
+        by_count, _ = self.db.evict_completed(max_rows=0)
+        self.assertEqual(by_count, 5)
+        for request_id in active_ids:
+            self.assertIsNotNone(self.db.lookup_req(request_id))
+
+    def test_evict_by_size_shrinks_file(self):
+        self._add_records(
+            200, messaging_states.ReplyStates.REPLY_ACKED, size=4096)
+        big_size = self.db.get_db_size()
+        max_bytes = big_size // 4
+
+        by_count, by_size = self.db.evict_completed(max_bytes=max_bytes)
+        self.assertEqual(by_count, 0)
+        self.assertGreater(by_size, 0)
+        self.assertLessEqual(self.db.get_db_size(), max_bytes)
+        self.assertEqual(
+            self.db.get_counters()[persistence.DBCounters.EVICTED_BY_SIZE],
+            by_size)
+
+    def test_under_limits_evicts_nothing(self):
+        self._add_records(5, messaging_states.ReplyStates.REPLY_ACKED)
+        rc = self.db.evict_completed(max_rows=10, max_bytes=1024*1024)
+        self.assertEqual(rc, (0, 0))
+        self.assertEqual(self.db.get_counters(), {})
+
+    def test_cleaner_enforces_row_limit(self):
+        self._add_records(10, messaging_states.ReplyStates.REPLY_ACKED)
+
+        cleaner = persistence.DBCleaner(
+            self.db, 60*60*1000*1000, 4, 0.05)
+        cleaner.start()
+        time.sleep(0.3)
+        cleaner.done()
+        cleaner.join()
+        self.assertEqual(len(self.db.get_all_complete()), 4)
+
+    def _add_alerts(self, alert_times):
+        self.db.add_alerts(
+            [(t, t, "hash%d" % t, 3, 5501, "subject", "message")
+             for t in alert_times])
+
+    def _alert_times(self):
+        def do_it(cursor):
+            cursor.execute("SELECT alert_time FROM alerts "
+                           "ORDER BY alert_time")
+            return [r[0] for r in cursor.fetchall()]
+        return self.db._execute(do_it)
+
+    def test_clean_alerts_by_age(self):
+        self._add_alerts(range(1000, 1010))
+        removed = self.db.clean_alerts(cut_off_time=1005)
+        self.assertEqual(removed, 5)
+        self.assertEqual(self._alert_times(), list(range(1005, 1010)))
+        self.assertEqual(
+            self.db.get_counters()[persistence.DBCounters.ALERTS_REMOVED], 5)
+
+    def test_clean_alerts_by_count(self):
+        self._add_alerts(range(1000, 1010))
+        removed = self.db.clean_alerts(max_rows=3)
+        self.assertEqual(removed, 7)
+        self.assertEqual(self._alert_times(), [1007, 1008, 1009])
+
+    def test_clean_alerts_keeps_high_water_mark(self):
+        self._add_alerts(range(1000, 1010))
+        self.db.clean_alerts(max_rows=0)
+        self.assertEqual(self._alert_times(), [])
+
+        db = persistence.SQLiteAgentDB(self.db_file)
+        self.assertEqual(db.get_latest_alert_time(), 1009)
+        db.add_alerts([(1020, 1020, "hash1020", 3, 5501, "s", "m")])
+        self.assertEqual(db.get_latest_alert_time(), 1020)
+
+    def test_clean_alerts_nothing_to_do(self):
+        self._add_alerts(range(1000, 1010))
+        self.assertEqual(
+            self.db.clean_alerts(cut_off_time=500, max_rows=100), 0)
+        self.assertEqual(len(self._alert_times()), 10)
+
+    def test_cleaner_removes_old_alerts(self):
+        now = int(time.time() * 1000)
+        day = 24 * 60 * 60 * 1000
+        self._add_alerts([now - 3 * day, now - 2 * day, now - 1000, now])
+
+        cleaner = persistence.DBCleaner(
+            self.db, 60*60*1000*1000, 100, 0.05,
+            alert_max_age=24 * 60 * 60, alert_max_rows=1)
+        cleaner.start()
+        time.sleep(0.3)
+        cleaner.done()
+        cleaner.join()
+        self.assertEqual(self._alert_times(), [now])
+
+
+class TestPersistDocEncoding(unittest.TestCase):
+
+    def setUp(self):
+        _, self.db_file = tempfile.mkstemp("test_db")
+        self.db = persistence.SQLiteAgentDB(
+            self.db_file, doc_encoding=persistence.DocEncodings.ZLIB)
+
+    def tearDown(self):
+        os.remove(self.db_file)
+
+    def _raw_docs(self, request_id):
+        conn = sqlite3.connect(self.db_file)
+        try:
+            return conn.execute(
+                "SELECT request_docs.request_doc, requests.reply_doc "
+                "FROM requests, request_docs WHERE "
+                "requests.request_id=request_docs.request_id AND "
+                "requests.request_id=?", (request_id,)).fetchone()
+        finally:
+            conn.close()
+
+    def test_large_docs_compressed(self):
+        request_id = str(uuid.uuid4())
+        request_doc = {"request_id": request_id,
+                       "payload": {"b64script": "QUFB" * 10000}}
+        reply_doc = {"return_code": 0, "message": "done " * 1000}
+        self.db.new_record(request_id, request_doc, None,
+                           messaging_states.ReplyStates.ACKED, "agent")
+        self.db.update_record(request_id, messaging_states.ReplyStates.REPLY,
+                              reply_doc=reply_doc)
+
+        raw_request, raw_reply = self._raw_docs(request_id)
+        self.assertTrue(raw_request.startswith(persistence._g_zlib_marker))
+        self.assertTrue(raw_reply.startswith(persistence._g_zlib_marker))
+        self.assertLess(len(raw_request), len(json.dumps(request_doc)))
+
+        res = self.db.lookup_req(request_id)
+        self.assertEqual(json.loads(res.request_doc), request_doc)
+        self.assertEqual(json.loads(res.reply_doc), reply_doc)
+
+    def test_small_docs_stay_text(self):
+        request_id = str(uuid.uuid4())
+        request_doc = {"request_id": request_id}
+        self.db.new_record(request_id, request_doc, None,
+                           messaging_states.ReplyStates.ACKED, "agent")
+        raw_request, _ = self._raw_docs(request_id)
+        self.assertEqual(json.loads(raw_request), request_doc)
+        res = self.db.get_all_ack()
+        self.assertEqual(json.loads(res[0].request_doc), request_doc)
+
+    def test_read_json_rows_from_old_schema(self):
+        request_id = str(uuid.uuid4())
+        request_doc = {"request_id": request_id, "old": "x" * 1000}
+        reply_doc = {"return_code": 0}
+
+        _, old_db_file = tempfile.mkstemp("test_db")
+        try:
+            conn = sqlite3.connect(old_db_file)
+            conn.executescript(persistence._g_sqllite_ddl)
+            conn.execute(
+                "INSERT INTO requests(request_id, creation_time, "
+                "request_doc, reply_doc, state, agent_id, "
+                "last_update_time) VALUES(?, ?, ?, ?, ?, ?, ?)",
+                (request_id, datetime.datetime.now(),
+                 json.dumps(request_doc), json.dumps(reply_doc),
+                 messaging_states.ReplyStates.REPLY, "agent",
+                 datetime.datetime.now()))
+            conn.commit()
+            conn.close()
+
+            db = persistence.SQLiteAgentDB(
+                old_db_file, doc_encoding=persistence.DocEncodings.ZLIB)
+            res = db.lookup_req(request_id)
+            self.assertEqual(json.loads(res.request_doc), request_doc)
+            self.assertEqual(json.loads(res.reply_doc), reply_doc)
+
+            db.check_agent_id("another")
+            self.assertIsNone(db.lookup_req(request_id))
+
+            def do_it(cursor):
+                cursor.execute("SELECT count(*) FROM request_docs")
+                return cursor.fetchone()[0]
+            self.assertEqual(db._execute(do_it), 0)
+        finally:
+            os.remove(old_db_file)
+
+    def test_update_state_keeps_docs(self):
+        request_id = str(uuid.uuid4())
+        request_doc = {"request_id": request_id}
+        reply_doc = {"return_code": 0}
+        self.db.new_record(request_id, request_doc, None,
+                           messaging_states.ReplyStates.ACKED, "agent")
+        self.db.update_record(request_id, messaging_states.ReplyStates.REPLY,
+                              reply_doc=reply_doc)
+        self.db.update_state(request_id,
+                             messaging_states.ReplyStates.REPLY_ACKED)
+
+        res = self.db.lookup_req(request_id)
+        self.assertEqual(res.state, messaging_states.ReplyStates.REPLY_ACKED)
+        self.assertEqual(json.loads(res.request_doc), request_doc)
+        self.assertEqual(json.loads(res.reply_doc), reply_doc)
+
+    def test_update_state_not_there(self):
+        passed = False
+        try:
+            self.db.update_state("Nope", "ASTATE")
+        except exceptions.PersistenceException:
+            passed = True
+        self.assertTrue(passed, "An exception did not happen")
+
+
+class TestPersistMemoryCached(TestPersistMemory):
+
+    def setUp(self):
+        self.db = persistence.SQLiteAgentDB(":memory:", cache_size=10)
+
+
+class TestPersistCache(unittest.TestCase):
+
+    def setUp(self):
+        _, self.db_file = tempfile.mkstemp("test_db")
+        self.db = persistence.SQLiteAgentDB(self.db_file, cache_size=4)
+
+    def tearDown(self):
+        os.remove(self.db_file)
+
+    def _new_request(self, agent_id="agent"):
+        request_id = str(uuid.uuid4())
+        self.db.new_record(request_id, {"request_id": request_id}, None,
+                           messaging_states.ReplyStates.ACKED, agent_id)
+        return request_id
+
+    def _db_lookups(self):
+        calls = []
+        real_execute = self.db._execute
+
+        def counting_execute(func):
+            calls.append(func)
+            return real_execute(func)
+        self.db._execute = counting_execute
+        return calls
+
+    def test_new_record_is_cached(self):
+        request_id = self._new_request()
+        calls = self._db_lookups()
+        res = self.db.lookup_req(request_id)
+        self.assertEqual(calls, [])
+        self.assertEqual(res.request_id, request_id)
+        self.assertEqual(json.loads(res.request_doc),
+                         {"request_id": request_id})
+        self.assertEqual(res.state, messaging_states.ReplyStates.ACKED)
+        self.assertIsNone(res.reply_doc)
+
+    def test_cached_record_matches_db(self):
+        request_id = self._new_request()
+        self.db.update_record(request_id, messaging_states.ReplyStates.REPLY,
+                              reply_doc={"return_code": 0})
+        cached = self.db.lookup_req(request_id)
+        self.db._cache.clear()
+        stored = self.db.lookup_req(request_id)
+        self.assertEqual(vars(cached), vars(stored))
+
+    def test_negative_lookup_cached(self):
+        calls = self._db_lookups()
+        for _ in range(10):
+            self.assertIsNone(self.db.lookup_req("NotThere"))
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(self.db.get_cache_stats()["hits"], 9)
+
+    def test_new_record_clears_negative_lookup(self):
+        request_id = str(uuid.uuid4())
+        self.assertIsNone(self.db.lookup_req(request_id))
+        self.db.new_record(request_id, {"request_id": request_id}, None,
+                           messaging_states.ReplyStates.ACKED, "agent")
+        res = self.db.lookup_req(request_id)
+        self.assertEqual(res.request_id, request_id)
+
+    def test_updates_write_through(self):
+        request_id = self._new_request()
+        self.db.update_record(request_id, messaging_states.ReplyStates.REPLY,
+                              reply_doc={"return_code": 0})
+        res = self.db.lookup_req(request_id)
+        self.assertEqual(res.state, messaging_states.ReplyStates.REPLY)
+        self.assertEqual(json.loads(res.reply_doc), {"return_code": 0})
+
+        self.db.update_state(request_id,
+                             messaging_states.ReplyStates.REPLY_ACKED)
+        res = self.db.lookup_req(request_id)
+        self.assertEqual(res.state, messaging_states.ReplyStates.REPLY_ACKED)
+        self.assertEqual(json.loads(res.reply_doc), {"return_code": 0})
+
+    def test_returned_record_is_a_copy(self):
+        request_id = self._new_request()
+        res = self.db.lookup_req(request_id)
+        res.state = "changed"
+        res = self.db.lookup_req(request_id)
+        self.assertEqual(res.state, messaging_states.ReplyStates.ACKED)
+
+    def test_check_agent_id_invalidates(self):
+        request_id = self._new_request("agent1")
+        self.assertIsNotNone(self.db.lookup_req(request_id))
+        self.db.check_agent_id("agent2")
+        self.assertIsNone(self.db.lookup_req(request_id))
+
+    def test_clean_all_expired_invalidates(self):
+        request_id = self._new_request()
+        self.assertIsNotNone(self.db.lookup_req(request_id))
+        self.db.clean_all_expired(
+            datetime.datetime.now() + datetime.timedelta(seconds=1))
+        self.assertIsNone(self.db.lookup_req(request_id))
+
+    def test_lru_is_bounded(self):
+        request_ids = [self._new_request() for _ in range(6)]
+        self.db.lookup_req(request_ids[2])
+        self.assertEqual(len(self.db._cache), 4)
+
+        calls = self._db_lookups()
+        self.db.lookup_req(request_ids[2])
+        self.db.lookup_req(request_ids[5])
+        self.assertEqual(calls, [])
+        res = self.db.lookup_req(request_ids[0])
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(res.request_id, request_ids[0])
+
+    def test_stale_fill_is_dropped(self):
+        request_id = self._new_request()
+        self.db._cache.clear()
+        found, _, generation = self.db._cache.get(request_id)
+        self.assertFalse(found)
+        self.db.update_state(request_id,
+                             messaging_states.ReplyStates.REPLY_ACKED)
+        stale = persistence.SQLiteRequestObject(
+            (request_id, None, None, None,
+             messaging_states.ReplyStates.ACKED, "agent", None))
+        self.db._cache.fill(request_id, stale, generation)
+        res = self.db.lookup_req(request_id)
+        self.assertEqual(res.state, messaging_states.ReplyStates.REPLY_ACKED)
+
+
+def _remove_journal_files(db_file):
+    for f in [db_file, db_file + ".snap", db_file + ".tmp",
+              db_file + ".snap.tmp"]:
+        if os.path.exists(f):
+            os.remove(f)
+
+
+class TestJournalMemory(TestPersistMemory):
+
+    def setUp(self):
+        self.db = journal.JournalAgentDB(":memory:")
+
+
+class TestJournalDisk(TestPersistDisk):
+
+    def setUp(self):
+        _, self.db_file = tempfile.mkstemp("test_db")
+        self.db = journal.JournalAgentDB(self.db_file)
+
+    def tearDown(self):
+        self.db.close()
+        _remove_journal_files(self.db_file)
+
+    def _reopen(self):
+        return journal.JournalAgentDB(self.db_file, read_only=True)
+
+    def _alert_count(self, db):
+        return len(db._alerts)
+
+
+class TestJournalMultiThread(TestPersistMultiThread):
+
+    def setUp(self):
+        _, self.db_file = tempfile.mkstemp("test_db")
+        self.db = journal.JournalAgentDB(self.db_file)
+
+    def tearDown(self):
+        self.db.close()
+        _remove_journal_files(self.db_file)
+
+
+class TestJournalRecovery(unittest.TestCase):
+
+    def setUp(self):
+        _, self.db_file = tempfile.mkstemp("test_db")
+        self.db = journal.JournalAgentDB(self.db_file, compact_ops=20)
+        self.agent_id = str(uuid.uuid4())
+
+    def tearDown(self):
+        self.db.close()
+        _remove_journal_files(self.db_file)
+
+    def _crash_and_reopen(self):
+        # nothing is flushed or closed on purpose, the journal is written
+        # through on every call
+        self.db = journal.JournalAgentDB(self.db_file, compact_ops=20)
+        return self.db
+
+    def _add_records(self, count, state):
+        request_ids = []
+        for _ in range(count):
+            request_id = str(uuid.uuid4())
+            self.db.new_record(request_id, {"request_id": request_id}, None,
+                               state, self.agent_id)
+            request_ids.append(request_id)
+        return request_ids
+
+    def test_records_survive_crash(self):
+        acked = self._add_records(3, messaging_states.ReplyStates.ACKED)
+        replied = self._add_records(2, messaging_states.ReplyStates.ACKED)
+        for request_id in replied:
+            self.db.update_record(request_id,
+                                  messaging_states.ReplyStates.REPLY,
+                                  reply_doc={"return_code": 0})
+
+        db = self._crash_and_reopen()
+        self.assertEqual(sorted(r.request_id for r in db.get_all_ack()),
+                         sorted(acked))
+        res = db.lookup_req(replied[0])
+        self.assertEqual(res.state, messaging_states.ReplyStates.REPLY)
+        self.assertEqual(json.loads(res.reply_doc), {"return_code": 0})
+        self.assertEqual(json.loads(res.request_doc),
+                         {"request_id": replied[0]})
+
+    def test_starting_agent_after_crash(self):
+        acked = self._add_records(2, messaging_states.ReplyStates.ACKED)
+        done = self._add_records(1, messaging_states.ReplyStates.REPLY_ACKED)
+
+        db = self._crash_and_reopen()
+        db.starting_agent()
+        for request_id in acked:
+            res = db.lookup_req(request_id)
+            self.assertEqual(res.state, messaging_states.ReplyStates.REPLY)
+            self.assertEqual(json.loads(res.reply_doc)["return_code"], 1)
+        self.assertEqual(db.lookup_req(done[0]).state,
+                         messaging_states.ReplyStates.REPLY_ACKED)
+        self.assertEqual(db.get_all_ack(), [])
+
+        db = self._crash_and_reopen()
+        self.assertEqual(len(db.get_all_reply()), 2)
+
+    def test_torn_write_dropped(self):
+        request_ids = self._add_records(2, messaging_states.ReplyStates.ACKED)
+        with open(self.db_file, "ab") as fptr:
+            fptr.write(b'{"o": "new", "r": ["half')
+
+        db = self._crash_and_reopen()
+        self.assertEqual(len(db.get_all_ack()), 2)
+        more = self._add_records(1, messaging_states.ReplyStates.ACKED)
+
+        db = self._crash_and_reopen()
+        self.assertEqual(sorted(r.request_id for r in db.get_all_ack()),
+                         sorted(request_ids + more))
+
+    def test_compaction(self):
+        request_ids = self._add_records(5, messaging_states.ReplyStates.ACKED)
+        for _ in range(10):
+            for request_id in request_ids:
+                self.db.update_state(request_id,
+                                     messaging_states.ReplyStates.REPLY)
+        self.assertTrue(os.path.exists(self.db_file + ".snap"))
+        with open(self.db_file, "r") as fptr:
+            self.assertLessEqual(len(fptr.readlines()), 21)
+
+        db = self._crash_and_reopen()
+        self.assertEqual(len(db.get_all_reply()), 5)
+
+    def test_eviction_is_journaled(self):
+        done = self._add_records(3, messaging_states.ReplyStates.REPLY_ACKED)
+        generation = self.db._generation
+        by_count, _ = self.db.evict_completed(max_rows=1)
+        self.assertEqual(by_count, 2)
+        # the eviction is appended to the journal, not a new snapshot
+        self.assertEqual(self.db._generation, generation)
+
+        db = self._crash_and_reopen()
+        self.assertEqual([r.request_id for r in db.get_all_complete()],
+                         done[2:])
+
+    def test_stale_journal_ignored(self):
+        request_ids = self._add_records(2, messaging_states.ReplyStates.ACKED)
+        with open(self.db_file, "rb") as fptr:
+            old_journal = fptr.read()
+        self.db.clean_all(request_ids[0])
+        self.db.compact()
+        # a crash after the snapshot was written but before the journal
+        # was started over leaves the journal from the older generation
+        with open(self.db_file, "wb") as fptr:
+            fptr.write(old_journal)
+
+        db = self._crash_and_reopen()
+        self.assertIsNotNone(db.lookup_req(request_ids[0]))
+        self.assertIsNone(db.lookup_req(request_ids[1]))
+
+    def test_read_only_leaves_files(self):
+        self._add_records(1, messaging_states.ReplyStates.ACKED)
+        with open(self.db_file, "ab") as fptr:
+            fptr.write(b'{"o": "ne')
+        size = os.path.getsize(self.db_file)
+        db = journal.JournalAgentDB(self.db_file, read_only=True)
+        self.assertEqual(len(db.get_all_ack()), 1)
+        self.assertEqual(os.path.getsize(self.db_file), size)
+        self.assertRaises(exceptions.PersistenceException,
+                          db.starting_agent)
+
+    def test_not_a_journal(self):
+        _, sqlite_file = tempfile.mkstemp("test_db")
+        try:
+            persistence.SQLiteAgentDB(sqlite_file)
+            self.assertRaises(exceptions.PersistenceException,
+                              journal.JournalAgentDB, sqlite_file)
+        finally:
+            os.remove(sqlite_file)
+
+    def test_evict_and_alert_retention(self):
+        old_ids = self._add_records(
+            4, messaging_states.ReplyStates.REPLY_ACKED)
+        self._add_records(2, messaging_states.ReplyStates.ACKED)
+        self.assertEqual(self.db.evict_completed(max_rows=3), (3, 0))
+        self.assertEqual(len(self.db.get_all_complete()), 1)
+        self.assertIsNotNone(self.db.lookup_req(old_ids[-1]))
+        self.assertEqual(self.db.get_counters()[
+            persistence.DBCounters.EVICTED_BY_COUNT], 3)
+
+        self.db.add_alerts([(t, t, "hash%d" % t, 3, 5501, "s", "m")
+                            for t in range(1000, 1010)])
+        self.assertEqual(self.db.clean_alerts(cut_off_time=1005,
+                                              max_rows=2), 8)
+        db = self._crash_and_reopen()
+        self.assertEqual(sorted(db._alerts), ["hash1008", "hash1009"])
+        db.clean_alerts(max_rows=0)
+        db = self._crash_and_reopen()
+        self.assertEqual(db.get_latest_alert_time(), 1009)
+        self.assertEqual(len(db.get_all_complete()), 1)
+
+    def test_owner(self):
+        self.assertRaises(exceptions.PersistenceException,
+                          self.db.get_owner, self.agent_id, None, None, None)
+        self.db.add_user(self.agent_id, "first", "key1", True)
+        self.db.add_user(self.agent_id, "second", "key2", False)
+        db = self._crash_and_reopen()
+        self.assertEqual(db.get_owner(self.agent_id, None, None, None),
+                         ("first", "key1"))
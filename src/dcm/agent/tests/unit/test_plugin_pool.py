@@ -0,0 +1,216 @@
+#
+#  Copyright (C) 2014 Dell, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import os
+import threading
+import time
+import unittest
+
+import dcm.agent.config as config
+import dcm.agent.plugin_pool as plugin_pool
+import dcm.agent.plugins.api.base as plugin_base
+
+from dcm.agent.plugins.api.exceptions import AgentPluginOperationException
+
+
+class _TestPlugin(plugin_base.Plugin):
+    # run in the plugin processes.  The command name picks what it does
+
+    protocol_arguments = {
+        "value": ("A value echoed back", False, str, None),
+        "seconds": ("How long to sleep", False, float, 10.0),
+    }
+
+    def __init__(self, conf, request_id, items_map, name, arguments):
+        super(_TestPlugin, self).__init__(
+            conf, request_id, items_map, name, arguments)
+        self._canceled = threading.Event()
+
+    def cancel(self, *args, **kwargs):
+        self._canceled.set()
+
+    def run(self):
+        if self.name == "echo":
+            return plugin_base.PluginReply(
+                0, reply_type="echo",
+                reply_object={"value": self.args.value, "pid": os.getpid(),
+                              "agent_id": self.conf.agent_id,
+                              "has_db": self.conf.db is not None})
+        if self.name == "fail":
+            raise Exception("The plugin failed on purpose")
+        if self.name == "crash":
+            os._exit(3)
+        if self.name == "wait_for_cancel":
+            if self._canceled.wait(self.args.seconds):
+                return plugin_base.PluginReply(1, error_message="canceled")
+            return plugin_base.PluginReply(0)
+        if self.name == "ignore_cancel":
+            end = time.monotonic() + self.args.seconds
+            while time.monotonic() < end:
+                time.sleep(0.05)
+            return plugin_base.PluginReply(0)
+
+
+def load_plugin(conf, request_id, items_map, name, arguments):
+    return _TestPlugin(conf, request_id, items_map, name, arguments)
+
+
+class _FakeConf(object):
+    def __init__(self):
+        self.jr = None
+        self.plugin_pool = None
+        self.config_files = []
+        self.agent_id = None
+        self.customer_id = None
+        self.state = "STARTING"
+
+
+_g_items_map = {"type": "python_module",
+                "module_name": __name__,
+                "execution": "process"}
+
+
+class TestPluginProcessPool(unittest.TestCase):
+
+    def setUp(self):
+        self.conf = _FakeConf()
+        self.pool = plugin_pool.PluginProcessPool(
+            self.conf, processes=2, cancel_timeout=0.5, poll_interval=0.05)
+        self.conf.plugin_pool = self.pool
+        self.pool.start()
+        self.addCleanup(self.pool.stop)
+
+    def _wait_ready(self):
+        # the idle processes are reused last in first out, so this is the
+        # process the next request runs in
+        self.pool.run("ready", _g_items_map, "echo", {"value": "x"})
+
+    def test_use_process(self):
+        self.assertTrue(plugin_pool.use_process(self.conf, _g_items_map))
+        self.assertFalse(plugin_pool.use_process(
+            self.conf, {"type": "python_module"}))
+        self.assertFalse(plugin_pool.use_process(_FakeConf(), _g_items_map))
+
+    def test_run_in_another_process(self):
+        items_map = dict(_g_items_map)
+        # objects the dispatcher adds are not sent to the process
+        items_map["long_runner"] = object()
+        reply_doc = self.pool.run("r1", items_map, "echo", {"value": "hi"})
+        self.assertEqual(0, reply_doc["return_code"])
+        self.assertEqual("hi", reply_doc["reply_object"]["value"])
+        self.assertNotEqual(os.getpid(), reply_doc["reply_object"]["pid"])
+        self.assertEqual(2, self.pool.get_stats()["processes"])
+
+    def test_process_builds_its_own_conf(self):
+        self.conf.agent_id = "agent1"
+        self.conf.db = object()
+        reply_doc = self.pool.run("r1", _g_items_map, "echo", {"value": "x"})
+        # values set after the agent started are passed along but the
+        # database object is not
+        self.assertEqual("agent1", reply_doc["reply_object"]["agent_id"])
+        self.assertFalse(reply_doc["reply_object"]["has_db"])
+
+    def test_plugin_error(self):
+        self.assertRaises(AgentPluginOperationException,
+                          self.pool.run, "r1", _g_items_map, "fail", {})
+        reply_doc = self.pool.run("r2", _g_items_map, "echo", {"value": "x"})
+        self.assertEqual("x", reply_doc["reply_object"]["value"])
+
+    def test_crashed_process_is_replaced(self):
+        self.assertRaises(AgentPluginOperationException,
+                          self.pool.run, "r1", _g_items_map, "crash", {})
+        stats = self.pool.get_stats()
+        self.assertEqual(1, stats["crashes"])
+        self.assertEqual(2, stats["processes"])
+        # both processes still work
+        pids = set()
+        for i in range(4):
+            reply_doc = self.pool.run(
+                "r%d" % i, _g_items_map, "echo", {"value": "x"})
+            pids.add(reply_doc["reply_object"]["pid"])
+        self.assertTrue(1 <= len(pids) <= 2)
+
+    def test_cancel_running(self):
+        result = {}
+
+        def _run():
+            result["reply"] = self.pool.run(
+                "r1", _g_items_map, "wait_for_cancel", {"seconds": "10"})
+
+        self._wait_ready()
+        t = threading.Thread(target=_run)
+        t.start()
+        end = time.monotonic() + 5.0
+        while (self.pool.get_stats()["busy"] == 0 and
+               time.monotonic() < end):
+            time.sleep(0.01)
+        # give the process time to get into run()
+        time.sleep(0.2)
+        self.pool.cancel("r1")
+        t.join(5.0)
+        self.assertFalse(t.is_alive())
+        self.assertEqual(1, result["reply"]["return_code"])
+        self.assertEqual(0, self.pool.get_stats()["kills"])
+
+    def test_cancel_kills_stuck_plugin(self):
+        errors = []
+
+        def _run():
+            try:
+                self.pool.run("r1", _g_items_map, "ignore_cancel",
+                              {"seconds": "30"})
+            except AgentPluginOperationException as ex:
+                errors.append(ex)
+
+        self._wait_ready()
+        t = threading.Thread(target=_run)
+        t.start()
+        end = time.monotonic() + 5.0
+        while (self.pool.get_stats()["busy"] == 0 and
+               time.monotonic() < end):
+            time.sleep(0.01)
+        self.pool.cancel("r1")
+        t.join(10.0)
+        self.assertFalse(t.is_alive())
+        self.assertEqual(1, len(errors))
+        stats = self.pool.get_stats()
+        self.assertEqual(1, stats["kills"])
+        self.assertEqual(2, stats["processes"])
+        reply_doc = self.pool.run("r2", _g_items_map, "echo", {"value": "x"})
+        self.assertEqual("x", reply_doc["reply_object"]["value"])
+
+    def test_cancel_before_run(self):
+        self.pool.cancel("r1")
+        self.assertRaises(AgentPluginOperationException,
+                          self.pool.run, "r1", _g_items_map, "echo", {})
+        # the cancel is only used once
+        self.pool.run("r1", _g_items_map, "echo", {"value": "x"})
+
+    def test_stop(self):
+        self.pool.stop()
+        self.assertEqual(0, self.pool.get_stats()["processes"])
+        self.assertRaises(AgentPluginOperationException,
+                          self.pool.run, "r1", _g_items_map, "echo", {})
+
+
+class TestPluginPoolConfig(unittest.TestCase):
+
+    def test_not_started_with_journal_backend(self):
+        conf = config.AgentConfig([])
+        conf.storage_db_backend = "journal"
+        conf.workers_plugin_processes = 2
+        conf.start_plugin_pool()
+        self.assertIsNone(conf.plugin_pool)
+        self.assertFalse(plugin_pool.use_process(conf, _g_items_map))
@@ -0,0 +1,238 @@
+#
+#  Copyright (C) 2014 Dell, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import mock
+import os
+import shutil
+import tempfile
+import unittest
+
+import dcm.agent.plugins.loader as plugin_loader
+
+from dcm.agent.plugins.api.exceptions import AgentPluginConfigException
+
+
+_g_conf = """[default]
+exe_path = /dcm/bin
+
+[plugin:add_user]
+type: python_module
+module_name: dcm.agent.plugins.builtin.add_user
+
+[plugin:unmount.*]
+type: python_module
+module_name: dcm.agent.plugins.builtin.unmount_volume
+
+[plugin:unmount_now]
+type: python_module
+module_name: dcm.agent.plugins.builtin.other
+
+[plugin:no_type]
+module_name: dcm.agent.plugins.builtin.other
+
+[plugin:bad_type]
+type: not_a_type
+"""
+
+
+class TestPluginRegistry(unittest.TestCase):
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.conffile = os.path.join(self.test_dir, "plugin.conf")
+        self._write(_g_conf)
+        self.registry = plugin_loader.PluginRegistry(
+            self.conffile, check_interval=0.0)
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def _write(self, text):
+        with open(self.conffile, "w") as fptr:
+            fptr.write(text)
+
+    def test_exact_lookup(self):
+        items_map = self.registry.lookup("add_user")
+        self.assertEqual("python_module", items_map["type"])
+        self.assertEqual("dcm.agent.plugins.builtin.add_user",
+                         items_map["module_name"])
+
+    def test_lookup_returns_a_copy(self):
+        items_map = self.registry.lookup("add_user")
+        items_map["long_runner"] = "x"
+        self.assertNotIn("long_runner", self.registry.lookup("add_user"))
+
+    def test_pattern_lookup(self):
+        items_map = self.registry.lookup("unmount_volume")
+        self.assertEqual("dcm.agent.plugins.builtin.unmount_volume",
+                         items_map["module_name"])
+
+    def test_earlier_pattern_wins(self):
+        # unmount_now also matches the unmount.* section before it
+        items_map = self.registry.lookup("unmount_now")
+        self.assertEqual("dcm.agent.plugins.builtin.unmount_volume",
+                         items_map["module_name"])
+
+    def test_bad_sections(self):
+        self.assertRaises(AgentPluginConfigException,
+                          self.registry.lookup, "not_there")
+        self.assertRaises(AgentPluginConfigException,
+                          self.registry.lookup, "no_type")
+        self.assertRaises(AgentPluginConfigException,
+                          self.registry.lookup, "bad_type")
+        stats = self.registry.get_stats()
+        self.assertEqual(3, stats["lookups"])
+        self.assertEqual(1, stats["misses"])
+
+    def test_get_all(self):
+        all_plugins = self.registry.get_all()
+        self.assertEqual(
+            set(["add_user", "unmount.*", "unmount_now", "no_type",
+                 "bad_type"]),
+            set(all_plugins.keys()))
+
+    def test_parsed_once(self):
+        for i in range(10):
+            self.registry.lookup("add_user")
+        stats = self.registry.get_stats()
+        self.assertEqual(1, stats["loads"])
+        self.assertEqual(10, stats["lookups"])
+
+    def test_reload_on_change(self):
+        self.registry.lookup("add_user")
+        self._write(_g_conf + """
+[plugin:new_command]
+type: python_module
+module_name: new.module
+""")
+        self.assertEqual("new.module",
+                         self.registry.lookup("new_command")["module_name"])
+        self.assertEqual(2, self.registry.get_stats()["loads"])
+
+    def test_invalidate(self):
+        registry = plugin_loader.PluginRegistry(
+            self.conffile, check_interval=3600.0)
+        registry.lookup("add_user")
+        registry.lookup("add_user")
+        self.assertEqual(1, registry.get_stats()["loads"])
+        registry.invalidate()
+        registry.lookup("add_user")
+        self.assertEqual(2, registry.get_stats()["loads"])
+
+    def test_missing_file(self):
+        registry = plugin_loader.PluginRegistry(
+            os.path.join(self.test_dir, "nothere.conf"))
+        self.assertRaises(AgentPluginConfigException,
+                          registry.lookup, "add_user")
+
+
+_g_preload_conf = """[plugin:heartbeat]
+type: python_module
+module_name: dcm.agent.plugins.builtin.heartbeat
+
+[plugin:add_user]
+type: python_module
+module_name: dcm.agent.plugins.builtin.add_user
+
+[plugin:missing]
+type: python_module
+module_name: dcm.agent.plugins.builtin.not_a_module
+
+[plugin:not_a_plugin]
+type: python_module
+module_name: dcm.agent.plugins.api.exceptions
+
+[plugin:no_module]
+type: python_module
+
+[plugin:echo]
+type: exe
+path: /bin/echo
+"""
+
+
+class TestPluginPreload(unittest.TestCase):
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        conffile = os.path.join(self.test_dir, "plugin.conf")
+        with open(conffile, "w") as fptr:
+            fptr.write(_g_preload_conf)
+        self.conf = mock.Mock()
+        self.conf.plugin_configfile = conffile
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def test_preload(self):
+        failures = plugin_loader.preload_plugins(self.conf)
+        self.assertEqual(set(["missing", "not_a_plugin", "no_module"]),
+                         set(failures.keys()))
+        self.assertIn("could not be imported", failures["missing"])
+        self.assertIn("load function", failures["not_a_plugin"])
+
+        results = plugin_loader.get_preload_results()
+        heartbeat = results["dcm.agent.plugins.builtin.heartbeat"]
+        self.assertIsNone(heartbeat["error"])
+        self.assertGreaterEqual(heartbeat["import_time"], 0.0)
+        self.assertIn("dcm.agent.plugins.builtin.heartbeat",
+                      plugin_loader._g_module_map)
+
+        add_user = plugin_loader.get_protocol_arguments(
+            "dcm.agent.plugins.builtin.add_user")
+        self.assertIn("userId", add_user)
+        self.assertIs(add_user, results[
+            "dcm.agent.plugins.builtin.add_user"]["protocol_arguments"])
+        self.assertIsNone(plugin_loader.get_protocol_arguments(
+            "dcm.agent.plugins.builtin.not_a_module"))
+
+    def test_load_reads_the_cache(self):
+        plugin_loader.preload_plugins(self.conf)
+        module_name = "dcm.agent.plugins.builtin.heartbeat"
+        module_info = plugin_loader._g_preload_results[module_name]
+        load_func = mock.Mock()
+        features_func = mock.Mock(return_value={"f": True})
+        with mock.patch.dict(module_info, {"load_plugin": load_func,
+                                           "get_features": features_func}):
+            plugin_loader.load_python_module(
+                module_name, self.conf, "r1", {}, "heartbeat", {})
+            features = plugin_loader.get_module_features(
+                self.conf, "heartbeat",
+                {"type": "python_module", "module_name": module_name})
+        load_func.assert_called_once_with(
+            self.conf, "r1", {}, "heartbeat", {})
+        self.assertEqual({"f": True}, features)
+
+    def test_load_failed_module(self):
+        plugin_loader.preload_plugins(self.conf)
+        self.assertRaises(AgentPluginConfigException,
+                          plugin_loader.load_python_module,
+                          "dcm.agent.plugins.builtin.not_a_module",
+                          self.conf, "r1", {}, "missing", {})
+
+    def test_preload_finished(self):
+        self.assertTrue(plugin_loader.preload_finished())
+        plugin_loader.begin_preload()
+        self.assertFalse(plugin_loader.preload_finished())
+        plugin_loader.end_preload()
+        self.assertTrue(plugin_loader.preload_finished())
+
+    def test_bad_protocol_arguments(self):
+        self.assertIsNone(plugin_loader._validate_protocol_arguments(
+            {"a": ("help", True, str, None)}))
+        self.assertIsNotNone(plugin_loader._validate_protocol_arguments(
+            {"a": ("help", True, str)}))
+        self.assertIsNotNone(plugin_loader._validate_protocol_arguments(
+            {"a": ("help", True, "str", None)}))
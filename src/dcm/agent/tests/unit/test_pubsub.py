@@ -13,6 +13,8 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 #
+import threading
+import time
 import unittest
 import uuid
 
@@ -31,6 +33,15 @@ class TestPubSub(unittest.TestCase):
         self._event_space = events.EventSpace()
         self._pub_sub = pubsub.PubSubEvent(self._event_space)
 
+    def tearDown(self):
+        self._event_space.reset()
+
+    def _poll_until(self, check, timeout=5.0):
+        end_time = time.time() + timeout
+        while not check() and time.time() < end_time:
+            self._event_space.poll(timeblock=0.05)
+        self.assertTrue(check())
+
     def test_simple_publish(self):
         topic = str(uuid.uuid4())
         x_val = 1
@@ -155,3 +166,93 @@ class TestPubSub(unittest.TestCase):
 
         self._event_space.poll(timeblock=0.0)
         self.assertIn('done', x_val)
+
+    def test_all_errors_collected(self):
+        topic = str(uuid.uuid4())
+        x_val = []
+
+        def test_callback1():
+            raise ValueError("one")
+
+        def test_callback2():
+            x_val.append(2)
+            return "two"
+
+        def test_callback3():
+            raise KeyError("three")
+
+        def done_cb(topic_error):
+            x_val.append(topic_error)
+
+        for cb in [test_callback1, test_callback2, test_callback3]:
+            self._pub_sub.subscribe(topic, cb)
+        delivery = self._pub_sub.publish(topic, done_cb=done_cb)
+        self._event_space.poll(timeblock=0.0)
+
+        self.assertTrue(delivery.is_done())
+        self.assertEqual(x_val[0], 2)
+        topic_error = x_val[1]
+        self.assertIsInstance(topic_error, pubsub.TopicError)
+        self.assertEqual([s for s, _ in topic_error.errors],
+                         [test_callback1, test_callback3])
+        self.assertEqual(delivery.results, [(test_callback2, "two")])
+
+    def test_inline_delivery(self):
+        topic = str(uuid.uuid4())
+        x_val = []
+        self._pub_sub.subscribe(topic, x_val.append,
+                                mode=pubsub.DeliveryMode.INLINE)
+        delivery = self._pub_sub.publish(topic, topic_args=[1])
+        # called before publish returns and without polling
+        self.assertEqual(x_val, [1])
+        self.assertTrue(delivery.is_done())
+
+    def test_executor_delivery(self):
+        topic = str(uuid.uuid4())
+        threads = []
+        done = []
+        release = threading.Event()
+
+        def blocking_callback():
+            threads.append(threading.current_thread())
+            release.wait(5.0)
+
+        def test_callback():
+            threads.append(threading.current_thread())
+
+        def done_cb(topic_error):
+            done.append((topic_error, threading.current_thread()))
+
+        self._pub_sub.subscribe(topic, blocking_callback,
+                                mode=pubsub.DeliveryMode.EXECUTOR)
+        self._pub_sub.subscribe(topic, test_callback)
+        delivery = self._pub_sub.publish(topic, done_cb=done_cb)
+
+        # the event loop subscriber is not held up by the blocking one
+        self._poll_until(lambda: len(threads) == 2)
+        self.assertIn(threading.current_thread(), threads)
+        self.assertFalse(delivery.is_done())
+
+        release.set()
+        self._poll_until(lambda: len(done) == 1)
+        self.assertEqual(done[0], (None, threading.current_thread()))
+
+    def test_wildcard(self):
+        x_val = []
+
+        def test_callback(name):
+            x_val.append(name)
+
+        self._pub_sub.subscribe("job.*", test_callback)
+        self._pub_sub.subscribe("*", test_callback)
+        self._pub_sub.publish("job.done", topic_args=["job.done"])
+        self._pub_sub.publish("alert", topic_args=["alert"])
+        self._event_space.poll(timeblock=0.0)
+        self.assertEqual(sorted(x_val), ["alert", "job.done", "job.done"])
+
+        self._pub_sub.unsubscribe("*", test_callback)
+        self._pub_sub.publish("job.start", topic_args=["job.start"])
+        self._pub_sub.publish("alert", topic_args=["alert"])
+        self._event_space.poll(timeblock=0.0)
+        self.assertEqual(x_val.count("job.start"), 1)
+        self.assertEqual(x_val.count("alert"), 1)
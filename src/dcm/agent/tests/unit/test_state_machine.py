@@ -0,0 +1,90 @@
+#
+#  Copyright (C) 2014 Dell, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import mock
+import unittest
+
+import dcm.agent.events.state_machine as state_machine
+import dcm.agent.exceptions as exceptions
+
+
+class TestStateMachine(unittest.TestCase):
+
+    def _ping_pong(self, **kwargs):
+        calls = []
+
+        def _moved(**kw):
+            calls.append(kw)
+
+        sm = state_machine.StateMachine("PING", **kwargs)
+        sm.add_transition("PING", "hit", "PONG", _moved)
+        sm.add_transition("PONG", "hit", "PING", None)
+        return sm, calls
+
+    def test_transitions(self):
+        sm, calls = self._ping_pong()
+        sm.event_occurred("hit", value=1)
+        sm.event_occurred("hit")
+        sm.event_occurred("hit", value=2)
+        self.assertEqual([{"value": 1}, {"value": 2}], calls)
+        self.assertEqual(
+            [("hit", "PING", "PONG"), ("hit", "PONG", "PING"),
+             ("hit", "PING", "PONG")],
+            sm.get_event_list())
+
+    def test_illegal_transition(self):
+        sm, calls = self._ping_pong()
+        self.assertRaises(exceptions.IllegalStateTransitionException,
+                          sm.event_occurred, "miss")
+        sm.event_occurred("hit")
+        self.assertEqual([("hit", "PING", "PONG")], sm.get_event_list())
+
+    def test_transition_added_to_current_state(self):
+        sm = state_machine.StateMachine("START")
+        sm.add_transition("START", "go", "END", None)
+        sm.event_occurred("go")
+        sm.add_transition("END", "back", "START", None)
+        sm.event_occurred("back")
+        self.assertEqual(2, len(sm.get_event_list()))
+
+    def test_do_not_change_state(self):
+        def _refuse(**kw):
+            raise exceptions.DoNotChangeStateException("not now")
+
+        sm = state_machine.StateMachine("START")
+        sm.add_transition("START", "go", "END", _refuse)
+        sm.add_transition("END", "go", "START", None)
+        sm.event_occurred("go")
+        sm.event_occurred("go")
+        self.assertEqual("START", sm.get_event_list()[1][1])
+
+    def test_history_is_bounded(self):
+        sm, calls = self._ping_pong(history_size=4)
+        for i in range(101):
+            sm.event_occurred("hit")
+        events = sm.get_event_list()
+        self.assertEqual(4, len(events))
+        self.assertEqual(("hit", "PING", "PONG"), events[-1])
+
+    def test_no_debug_formatting(self):
+        logger = mock.Mock()
+        logger.isEnabledFor.return_value = False
+        sm, calls = self._ping_pong(logger=logger)
+        sm.event_occurred("hit")
+        self.assertFalse(logger.debug.called)
+
+        logger.isEnabledFor.return_value = True
+        sm.event_occurred("hit")
+        self.assertTrue(logger.debug.called)
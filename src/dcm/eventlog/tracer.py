@@ -22,6 +22,10 @@ _g_thread_local_stack = threading.local()
 _g_event_log_set = ()
 _g_event_logger = logging.getLogger(__name__)
 
+# the level of the records that trace entering and leaving a request.  They
+# are only made when the eventlog logger is enabled for it
+TRACE_LEVEL = 1
+
 
 def _get_record_defaults(doc):
     kw_str = ""
@@ -38,6 +42,10 @@ def _get_record_defaults(doc):
     return record
 
 
+# the fields given to records logged outside of any request
+_g_default_record = _get_record_defaults({})
+
+
 class RequestFilter(logging.Filter):
     """
     Fliter records if this event is not in the logset
@@ -47,21 +55,13 @@ class RequestFilter(logging.Filter):
             # filter out the log if it is not in the level set
             return False
 
-        if not hasattr(_g_thread_local_stack, _g_tl_key):
-            # load up the record with default data
-            rec = _get_record_defaults({})
-            record.__dict__.update(rec)
-            return True
-
         stack = getattr(_g_thread_local_stack, _g_tl_key, None)
         if not stack:
-            rec = _get_record_defaults({})
-            record.__dict__.update(rec)
+            # load up the record with default data
+            record.__dict__.update(_g_default_record)
             return True
 
-        request_id_info = stack[-1]
-        rec = _get_record_defaults(request_id_info)
-        record.__dict__.update(rec)
+        record.__dict__.update(stack[-1].get_record_fields())
         return True
 
 
@@ -82,17 +82,29 @@ class RequestTracer():
             record['message_type'] = message_doc['type']
             record['message_id'] = message_doc['message_id']
         self._record = record
+        self._record_fields = None
+
+    def get_record_fields(self):
+        # made the first time a record is logged in this request and then
+        # reused for every later one
+        if self._record_fields is None:
+            self._record_fields = _get_record_defaults(self._record)
+        return self._record_fields
 
     def __enter__(self):
         thread_stack = getattr(_g_thread_local_stack, _g_tl_key)
-        thread_stack.append(self._record)
-        _g_event_logger.log(1, "Setup new request tracer state.")
+        thread_stack.append(self)
+        if _g_event_logger.isEnabledFor(TRACE_LEVEL):
+            _g_event_logger.log(TRACE_LEVEL, "Setup new request tracer state.")
 
     def __exit__(self, type, value, traceback):
         thread_stack = getattr(_g_thread_local_stack, _g_tl_key)
         thread_stack.pop()
-        _g_event_logger.log(1, "End request tracer state.")
+        if not _g_event_logger.isEnabledFor(TRACE_LEVEL):
+            return
+        _g_event_logger.log(TRACE_LEVEL, "End request tracer state.")
         if value is not None:
-            _g_event_logger.log(1, "Request context manager ended with an "
-                                   "exception: %s." % value)
+            _g_event_logger.log(TRACE_LEVEL,
+                                "Request context manager ended with an "
+                                "exception: %s." % value)
             # TODO log the traceback